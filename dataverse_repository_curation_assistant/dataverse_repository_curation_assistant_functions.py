@@ -1,28 +1,46 @@
 # Functions for the curation app
+import asyncio
+import concurrent.futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import contextlib
 import csv
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 from dateutil import tz
 from dateutil.parser import parse
-from functools import reduce
+from email.utils import parsedate_to_datetime
+from functools import partial, reduce
 from fuzzywuzzy import fuzz, process
+import itertools
 import json
 import joblib
 from joblib import Parallel, delayed
 import glob
+import gzip
+import hashlib
+import heapq
 import os
 from os import listdir
 import math
+from operator import itemgetter
+import random
 import pandas as pd
 from pathlib import Path
+import queue
 import re
 import requests
+import shutil
+import sqlite3
+import sys
+import tempfile
+from requests.adapters import HTTPAdapter
+import threading
 import time
 from tkinter import Tk, ttk, Frame, Label, IntVar, Checkbutton, filedialog, NORMAL, DISABLED
 from tkinter import Listbox, MULTIPLE, StringVar, END, INSERT, N, E, S, W
 from tkinter.ttk import Entry, Progressbar, OptionMenu, Combobox
 from tqdm import tqdm
 from urllib.parse import urlparse
+from xml.etree import ElementTree
 import yaml
 
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
@@ -85,6 +103,522 @@ def tqdm_joblib(tqdm_object):
         tqdm_object.close()
 
 
+# Default settings of the HTTP client that functions in this script use to make API calls.
+# Use set_http_client_defaults to change them for all installations or
+# set_installation_defaults to change them for a single installation
+httpClientDefaults = {
+    'poolSize': 32,
+    'timeout': 60,
+    'verify': True,
+    'headers': {},
+    # Calls to each installation are rate limited by a token bucket that refills at requestsPerSecond
+    # and holds up to burst calls. A requestsPerSecond of 0 means calls aren't rate limited
+    'requestsPerSecond': 0,
+    'burst': 10
+}
+
+# Calls that fail with a retryable status code or a connection error or timeout are resent up to maxRetries
+# times. Before each retry the call waits a random time between 0 and backoffBase * 2^retry seconds
+# (up to backoffMax), unless the installation's Retry-After header asks for a wait of up to maxRetryAfter seconds.
+# Calls with methods that aren't idempotent, like POST, are resent only when the installation throttles them
+retryPolicyDefaults = {
+    'maxRetries': 4,
+    'backoffBase': 1,
+    'backoffMax': 60,
+    'maxRetryAfter': 300,
+    'retryableStatusCodes': (429, 500, 502, 503, 504),
+    'idempotentMethods': ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+}
+
+# When this many calls in a row to an installation fail because it can't be reached, times out or responds
+# with 502, 503 or 504 errors, calls to the installation fail right away for resetTimeout seconds.
+# Then one trial call is let through, and if it succeeds calls to the installation are made again
+circuitBreakerDefaults = {
+    'failureThreshold': 5,
+    'resetTimeout': 120
+}
+
+# Each installation (or hostname) gets its own requests Session, so that connections to the
+# installation are kept alive and reused instead of opening a new TCP and TLS connection for each API call
+installationSessions = {}
+installationSettings = {}
+httpClientLock = threading.Lock()
+
+# Default settings of the controllers that set how many calls can be in flight to each installation.
+# Each installation starts at initialLimit calls and gets about one more for each round of responses,
+# up to maxLimit (or the installation's pool size if that's smaller). When the installation responds with
+# 429 or 503 errors, times out, or its recent responses from an endpoint get more than latencyTolerance times slower
+# than that endpoint's baseline latency, the limit is multiplied by decreaseFactor, down to minLimit.
+# The baseline of each endpoint moves toward each new latency by baselineDecay of the difference, so it follows
+# lasting changes slowly, and a few unusually fast or slow responses don't make every later response look slow or fast
+adaptiveConcurrencyDefaults = {
+    'initialLimit': 4,
+    'minLimit': 1,
+    'maxLimit': 64,
+    'latencyTolerance': 3,
+    'decreaseFactor': 0.5,
+    'baselineDecay': 0.02
+}
+
+# HTTP status codes that mean an installation is overloaded
+overloadedStatusCodes = (429, 503)
+
+installationConcurrencyLimiters = {}
+installationRateLimiters = {}
+installationCircuitBreakers = {}
+
+
+# Raised when calls to an installation are failing right away because the installation seems to be down
+class InstallationUnavailableError(requests.exceptions.ConnectionError):
+    pass
+
+
+def get_hostname(url):
+    return urlparse(url).netloc.lower()
+
+
+# Change default HTTP client settings used for all installations
+def set_http_client_defaults(
+    poolSize=None, timeout=None, verify=None, userAgent=None, headers=None,
+    requestsPerSecond=None, burst=None):
+
+    with httpClientLock:
+        if poolSize is not None:
+            httpClientDefaults['poolSize'] = poolSize
+            # Recreate sessions so that they use the new pool size
+            for session in installationSessions.values():
+                session.close()
+            installationSessions.clear()
+            installationConcurrencyLimiters.clear()
+        if timeout is not None:
+            httpClientDefaults['timeout'] = timeout
+        if verify is not None:
+            httpClientDefaults['verify'] = verify
+        if headers is not None:
+            httpClientDefaults['headers'].update(headers)
+        if userAgent is not None:
+            httpClientDefaults['headers']['User-Agent'] = userAgent
+        if requestsPerSecond is not None or burst is not None:
+            if requestsPerSecond is not None:
+                httpClientDefaults['requestsPerSecond'] = requestsPerSecond
+            if burst is not None:
+                httpClientDefaults['burst'] = burst
+            installationRateLimiters.clear()
+
+
+# Change HTTP client settings used for a given installation, such as the API token
+# that should be sent with every call to that installation
+def set_installation_defaults(
+    url, apiKey=None, userAgent=None, headers=None, verify=None, timeout=None, poolSize=None,
+    requestsPerSecond=None, burst=None):
+
+    hostname = get_hostname(url)
+
+    with httpClientLock:
+        settings = installationSettings.setdefault(hostname, {'headers': {}})
+        if apiKey is not None:
+            if apiKey:
+                settings['headers']['X-Dataverse-key'] = apiKey
+            else:
+                settings['headers'].pop('X-Dataverse-key', None)
+        if userAgent is not None:
+            settings['headers']['User-Agent'] = userAgent
+        if headers is not None:
+            settings['headers'].update(headers)
+        if verify is not None:
+            settings['verify'] = verify
+        if timeout is not None:
+            settings['timeout'] = timeout
+        if poolSize is not None and poolSize != settings.get('poolSize'):
+            settings['poolSize'] = poolSize
+            session = installationSessions.pop(hostname, None)
+            if session is not None:
+                session.close()
+            installationConcurrencyLimiters.pop(hostname, None)
+        if requestsPerSecond is not None or burst is not None:
+            if requestsPerSecond is not None:
+                settings['requestsPerSecond'] = requestsPerSecond
+            if burst is not None:
+                settings['burst'] = burst
+            installationRateLimiters.pop(hostname, None)
+
+
+# Return the setting for a given installation, or the default setting if the installation doesn't have its own
+def get_installation_setting(url, setting):
+    settings = installationSettings.get(get_hostname(url), {})
+    return settings.get(setting, httpClientDefaults[setting])
+
+
+# Return the requests Session that holds the connection pool of the given URL's installation,
+# creating it the first time the installation is called
+def get_installation_session(url):
+    hostname = get_hostname(url)
+
+    with httpClientLock:
+        session = installationSessions.get(hostname)
+        if session is None:
+            poolSize = installationSettings.get(hostname, {}).get('poolSize', httpClientDefaults['poolSize'])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            installationSessions[hostname] = session
+
+    return session
+
+
+# Additive increase, multiplicative decrease (AIMD) controller of how many calls can be in flight to an installation
+class AdaptiveConcurrencyLimiter:
+
+    def __init__(
+        self, initialLimit=4, minLimit=1, maxLimit=64, latencyTolerance=3, decreaseFactor=0.5,
+        baselineDecay=0.02):
+        self.limit = float(initialLimit)
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.latencyTolerance = latencyTolerance
+        self.decreaseFactor = decreaseFactor
+        self.baselineDecay = baselineDecay
+        self.inFlight = 0
+        # Latencies of each endpoint, since endpoints like the Search API and dataset exports
+        # take very different times: {endpoint: [baselineLatency, smoothedLatency]}
+        self.endpointLatencies = {}
+        self.smoothedLatency = None
+        self.lastDecreaseTime = 0
+        self.condition = threading.Condition()
+
+    # Wait until fewer calls than the limit are in flight
+    def acquire(self):
+        with self.condition:
+            while self.inFlight >= int(self.limit):
+                self.condition.wait()
+            self.inFlight += 1
+
+    # Record the outcome of a call. Pass latency (in seconds) when the installation responded,
+    # the endpoint that was called (see get_endpoint_class),
+    # and overloaded=True when the installation responded with a 429 or 503 error or timed out
+    def release(self, latency=None, overloaded=False, endpoint=None):
+        with self.condition:
+            self.inFlight -= 1
+            now = time.monotonic()
+
+            slow = False
+            endpointLatency = None
+            if latency is not None and overloaded is False:
+                if self.smoothedLatency is None:
+                    self.smoothedLatency = latency
+                else:
+                    self.smoothedLatency = 0.8 * self.smoothedLatency + 0.2 * latency
+
+                endpointLatency = self.endpointLatencies.get(endpoint)
+                if endpointLatency is None:
+                    endpointLatency = self.endpointLatencies[endpoint] = [latency, latency]
+                else:
+                    baselineLatency, smoothedLatency = endpointLatency
+                    endpointLatency[0] = baselineLatency + self.baselineDecay * (latency - baselineLatency)
+                    endpointLatency[1] = 0.8 * smoothedLatency + 0.2 * latency
+                slow = endpointLatency[1] > endpointLatency[0] * self.latencyTolerance
+
+            decreased = False
+            if overloaded is True or slow is True:
+                # Decrease at most once per round trip, so that many calls that were sent
+                # before the installation slowed down count as one signal
+                roundTripTime = self.smoothedLatency or 1
+                if now - self.lastDecreaseTime > roundTripTime:
+                    self.limit = max(self.minLimit, self.limit * self.decreaseFactor)
+                    self.lastDecreaseTime = now
+                    decreased = True
+                    # Don't keep backing off because of responses that were slow before the decrease
+                    if slow is True:
+                        endpointLatency[1] = endpointLatency[0] * self.latencyTolerance
+
+            # Responses that aren't errors increase the limit, unless they just decreased it
+            if decreased is False and latency is not None and overloaded is False:
+                self.limit = min(self.maxLimit, self.limit + 1 / self.limit)
+
+            self.condition.notify_all()
+
+
+# Return the endpoint of an API URL that AdaptiveConcurrencyLimiter compares latencies of, e.g. /api/datasets/:id/versions,
+# with database IDs replaced so that calls about different datasets and collections count as the same endpoint
+def get_endpoint_class(url):
+    pathSegments = urlparse(url).path.rstrip('/').split('/')
+    return '/'.join(':id' if segment.isdigit() else segment for segment in pathSegments)
+
+
+# Return the most calls that can be in flight to the given URL's installation at the same time
+def get_max_concurrency(url):
+    return min(adaptiveConcurrencyDefaults['maxLimit'], get_installation_setting(url, 'poolSize'))
+
+
+# Return the concurrency controller of the given URL's installation, creating it the first time the installation is called
+def get_concurrency_limiter(url):
+    hostname = get_hostname(url)
+
+    with httpClientLock:
+        limiter = installationConcurrencyLimiters.get(hostname)
+        if limiter is None:
+            settings = dict(adaptiveConcurrencyDefaults)
+            settings['maxLimit'] = min(
+                settings['maxLimit'],
+                installationSettings.get(hostname, {}).get('poolSize', httpClientDefaults['poolSize']))
+            settings['initialLimit'] = min(settings['initialLimit'], settings['maxLimit'])
+            limiter = AdaptiveConcurrencyLimiter(**settings)
+            installationConcurrencyLimiters[hostname] = limiter
+
+    return limiter
+
+
+# Token bucket that limits the rate of calls to an installation. Calls wait for a token, and the bucket
+# refills at requestsPerSecond up to burst tokens. pause stops all calls for a given number of seconds,
+# e.g. when the installation's Retry-After header asks for that
+class TokenBucket:
+
+    def __init__(self, requestsPerSecond=0, burst=10):
+        self.requestsPerSecond = requestsPerSecond
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updatedTime = time.monotonic()
+        self.pausedUntil = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.pausedUntil - now
+
+                if wait <= 0:
+                    if not self.requestsPerSecond:
+                        return
+                    self.tokens = min(
+                        self.burst, self.tokens + (now - self.updatedTime) * self.requestsPerSecond)
+                    self.updatedTime = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.requestsPerSecond
+
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            self.pausedUntil = max(self.pausedUntil, now + seconds)
+            # Start refilling the bucket from empty when the pause ends
+            self.tokens = 0
+            self.updatedTime = self.pausedUntil
+
+
+# Return the token bucket of the given URL's installation, creating it the first time the installation is called
+def get_rate_limiter(url):
+    hostname = get_hostname(url)
+
+    with httpClientLock:
+        rateLimiter = installationRateLimiters.get(hostname)
+        if rateLimiter is None:
+            settings = installationSettings.get(hostname, {})
+            rateLimiter = TokenBucket(
+                requestsPerSecond=settings.get('requestsPerSecond', httpClientDefaults['requestsPerSecond']),
+                burst=settings.get('burst', httpClientDefaults['burst']))
+            installationRateLimiters[hostname] = rateLimiter
+
+    return rateLimiter
+
+
+# Return how many seconds a response's Retry-After header asks to wait, or None if there's no valid header.
+# The header can be a number of seconds or an HTTP date
+def get_retry_after_seconds(response):
+    retryAfter = response.headers.get('Retry-After')
+    if retryAfter is None:
+        return None
+
+    try:
+        seconds = float(retryAfter)
+    except ValueError:
+        try:
+            retryAfterDate = parsedate_to_datetime(retryAfter)
+            seconds = (retryAfterDate - datetime.now(retryAfterDate.tzinfo)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+
+    return min(max(seconds, 0), retryPolicyDefaults['maxRetryAfter'])
+
+
+# Return how many seconds to wait before the given retry (the first retry is 0), using exponential backoff with full jitter
+def get_backoff_seconds(retry):
+    backoffSeconds = min(
+        retryPolicyDefaults['backoffMax'], retryPolicyDefaults['backoffBase'] * 2 ** retry)
+    return random.uniform(0, backoffSeconds)
+
+
+# Circuit breaker that stops calls to an installation that seems to be down. The circuit is "closed" while calls
+# are made normally, "open" while calls fail right away, and "half_open" while one trial call is in flight
+class CircuitBreaker:
+
+    def __init__(self, failureThreshold=5, resetTimeout=120):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.state = 'closed'
+        self.failureCount = 0
+        self.openedTime = 0
+        self.lock = threading.Lock()
+
+    # Return True if a call can be made to the installation
+    def allow_call(self):
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.openedTime >= self.resetTimeout:
+                self.state = 'half_open'
+                return True
+            return False
+
+    def record_result(self, failed):
+        with self.lock:
+            if failed is False:
+                self.state = 'closed'
+                self.failureCount = 0
+            else:
+                self.failureCount += 1
+                if self.state == 'half_open' or self.failureCount >= self.failureThreshold:
+                    self.state = 'open'
+                    self.openedTime = time.monotonic()
+
+
+# Return the circuit breaker of the given URL's installation, creating it the first time the installation is called
+def get_circuit_breaker(url):
+    hostname = get_hostname(url)
+
+    with httpClientLock:
+        circuitBreaker = installationCircuitBreakers.get(hostname)
+        if circuitBreaker is None:
+            circuitBreaker = CircuitBreaker(**circuitBreakerDefaults)
+            installationCircuitBreakers[hostname] = circuitBreaker
+
+    return circuitBreaker
+
+
+# Return True if calls to the given URL's installation are failing right away because the installation seems to be down
+def is_installation_unavailable(url):
+    circuitBreaker = installationCircuitBreakers.get(get_hostname(url))
+    return circuitBreaker is not None and circuitBreaker.state == 'open'
+
+
+# Close the connection pools of all installations
+def close_installation_sessions():
+    with httpClientLock:
+        for session in installationSessions.values():
+            session.close()
+        installationSessions.clear()
+
+
+# Make an API call using the connection pool of the URL's installation.
+# Headers, timeout and verify default to the installation's settings and
+# headers passed to the function are added to (or replace) the installation's default headers
+def api_request(
+    method, url, params=None, headers=None, apiKey=None, timeout=None, verify=None,
+    maxRetries=None, **kwargs):
+
+    requestHeaders = dict(httpClientDefaults['headers'])
+    requestHeaders.update(installationSettings.get(get_hostname(url), {}).get('headers', {}))
+    if headers:
+        requestHeaders.update(headers)
+    if apiKey:
+        requestHeaders['X-Dataverse-key'] = apiKey
+
+    if timeout is None:
+        timeout = get_installation_setting(url, 'timeout')
+    if verify is None:
+        verify = get_installation_setting(url, 'verify')
+    if maxRetries is None:
+        maxRetries = retryPolicyDefaults['maxRetries']
+    idempotent = method.upper() in retryPolicyDefaults['idempotentMethods']
+
+    session = get_installation_session(url)
+    limiter = get_concurrency_limiter(url)
+    rateLimiter = get_rate_limiter(url)
+    circuitBreaker = get_circuit_breaker(url)
+
+    retry = 0
+    while True:
+        if circuitBreaker.allow_call() is False:
+            raise InstallationUnavailableError(
+                f'Calls to {get_hostname(url)} are paused because the installation seems to be down')
+
+        rateLimiter.acquire()
+        limiter.acquire()
+        startTime = time.monotonic()
+        try:
+            response = session.request(
+                method, url, params=params, headers=requestHeaders,
+                timeout=timeout, verify=verify, **kwargs)
+
+        # Don't retry calls that fail because the installation's SSL certificate can't be verified
+        except requests.exceptions.SSLError:
+            limiter.release()
+            circuitBreaker.record_result(failed=False)
+            raise
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            limiter.release(overloaded=isinstance(e, requests.exceptions.Timeout))
+            circuitBreaker.record_result(failed=True)
+            if idempotent is False or retry >= maxRetries:
+                raise
+            time.sleep(get_backoff_seconds(retry))
+            retry += 1
+            continue
+
+        except Exception:
+            limiter.release()
+            circuitBreaker.record_result(failed=False)
+            raise
+
+        limiter.release(
+            latency=time.monotonic() - startTime,
+            overloaded=response.status_code in overloadedStatusCodes,
+            endpoint=get_endpoint_class(url))
+
+        retryAfterSeconds = get_retry_after_seconds(response)
+        throttled = (
+            response.status_code == 429
+            or (response.status_code == 503 and retryAfterSeconds is not None))
+
+        circuitBreaker.record_result(
+            failed=response.status_code in (502, 503, 504) and throttled is False)
+
+        retryable = (
+            throttled is True
+            or (idempotent is True and response.status_code in retryPolicyDefaults['retryableStatusCodes']))
+
+        if retryable is False or retry >= maxRetries:
+            return response
+
+        response.close()
+
+        # If the installation throttled the call, stop calling the installation for as long as
+        # it asks (or for the backoff time), then resend the call
+        if retryAfterSeconds is None:
+            retryAfterSeconds = get_backoff_seconds(retry)
+        if throttled is True:
+            rateLimiter.pause(retryAfterSeconds)
+        else:
+            time.sleep(retryAfterSeconds)
+        retry += 1
+
+
+def api_get(url, **kwargs):
+    return api_request('GET', url, **kwargs)
+
+
+def api_post(url, **kwargs):
+    return api_request('POST', url, **kwargs)
+
+
+def api_delete(url, **kwargs):
+    return api_request('DELETE', url, **kwargs)
+
+
 # From a YAML file, insert the installation URL and API Token into curation script
 # or return dictionary containing the information
 def import_credentials(filePath, installationURLField=None, apiKeyField=None, forCurationApp=False):
@@ -241,7 +775,7 @@ def get_installation_url(string):
 def get_installation_list():
     installationsList = []
     dataverseInstallationsJsonUrl = 'https://raw.githubusercontent.com/IQSS/dataverse-installations/main/data/data.json'
-    response = requests.get(dataverseInstallationsJsonUrl)
+    response = api_get(dataverseInstallationsJsonUrl)
     data = response.json()
 
     for installation in data['installations']:
@@ -258,7 +792,7 @@ def get_installation_list():
 
 def check_api_endpoint(url, headers, verify=False, json_response=True):
     try:
-        response = requests.get(url, headers=headers, timeout=60, verify=verify)
+        response = api_get(url, headers=headers, timeout=60, verify=verify)
         if response.status_code == 200 and json_response is True:
             try:
                 status = response.json()['status']
@@ -275,25 +809,11 @@ def check_api_endpoint(url, headers, verify=False, json_response=True):
 
 
 # Function for getting name of installation's root collection 
-# (assumming root dataverse's ID is 1, which isn't the case with UVA Dataverse)
 def get_root_alias(url):
 
-    # If it's the UVA homepage URL, it's root alias is uva (whose database ID is not 1)
-    if 'dataverse.lib.virginia.edu' in url:
-        rootAlias = 'uva'
-
-    # If's it's not the UVA homepage URL, get the alias of the collection whose database is 1
-    elif '/dataverse/' in url:
-        parsed = urlparse(url)
-        url = parsed.scheme + '://' + parsed.netloc + '/api/dataverses/1'
-        response = requests.get(url)
-        dataverseData = response.json()
-        rootAlias = dataverseData['data']['alias']
-    elif '/dataverse/' not in url:
-        url = f'{url}/api/dataverses/1'
-        response = requests.get(url)
-        dataverseData = response.json()
-        rootAlias = dataverseData['data']['alias']
+    # Get the alias of the installation's root collection from the collection tree index
+    installationUrl = get_installation_url(url)
+    rootAlias = get_root_collection_info(installationUrl)['alias']
 
     return rootAlias
 
@@ -302,19 +822,10 @@ def get_root_alias(url):
 # including the "Root" collection
 def get_alias_from_collection_url(url):
 
-    # If /dataverse/ is not in the URL, assume it's the installation's server url...
+    # If /dataverse/ is not in the URL, assume it's the installation's server url
+    # and get the alias of its root collection
     if '/dataverse/' not in url:
-        # If it's the UVA homepage URL, get it's root alias, whose database ID is not 1
-        if 'dataverse.lib.virginia.edu' in url:
-            alias = 'uva'
-
-        # If's it's not the UVA homepage URL, get the alias of the collection whose database is 1
-        elif 'dataverse.lib.virginia.edu' not in url:
-            installationUrl = get_installation_url(url)
-            url = f'{installationUrl}/api/dataverses/1'
-            response = requests.get(url)
-            dataverseData = response.json()
-            alias = dataverseData['data']['alias']
+        alias = get_root_alias(url)
 
     # If /dataverse/ is in the url, assume it's a collection URL and parse string to get its alias...
     elif '/dataverse/' in url:
@@ -329,11 +840,11 @@ def get_alias_from_collection_url(url):
 
 
 # Returns True if collection alias is the installation's root collection or
-# False if not (doesn't work with UVA)
+# False if not
 def is_root_collection(url):
     if get_alias_from_collection_url(url) == get_root_alias(url):
         return True
-    elif get_alias_from_collection_url(url) != get_root_alias(url):
+    else:
         return False
 
 
@@ -616,20 +1127,601 @@ def get_value_row_from_search_api_object(item, installationUrl):
     return newRow
 
 
-def get_object_dictionary_from_search_api_page(installationUrl, header, params, start, objectInfoDict):
-    searchApiUrl = f'{installationUrl}/api/search'
-    params['start'] = start
-    params['per_page'] = 10
-    response = requests.get(
-        searchApiUrl,
-        params=params,
-        headers=header
-    )
+# Maximum number of Search API calls that can be in flight at the same time,
+# including when the results of many installations are being crawled at once
+searchApiMaxConcurrency = 200
+
+# Most items the Search API returns per page, and how many times a page is retried before it's split
+# in half to find any misindexed object that breaks it. Misindexed objects break pages every time,
+# so retrying a page many times only slows down finding them
+searchApiMaxPerPage = 1000
+searchApiPageMaxRetries = 1
+
+# Deep start offsets are slow because Solr ranks every result before the offset. So when a crawl is partitioned,
+# the query is split into disjoint slices of at most searchApiMaxSliceSize results, which are paged through at the same time.
+# Queries are sliced by object type and then by ranges of the dateSort field, which holds each object's publication date,
+# or creation date if it's unpublished. Ranges are yearly from searchApiSliceStartYear and are halved until they're small enough
+searchApiMaxSliceSize = 10000
+searchApiSliceStartYear = 2006
+searchApiMinSliceSpan = timedelta(hours=1)
+
+
+# Run a coroutine to completion from synchronous code, even when an event loop
+# is already running in this thread, such as in a Jupyter notebook
+def run_coroutine(coroutine):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+# Make an API call in a thread of the given executor, so that the event loop can wait for
+# many calls at once. The semaphore limits how many calls can be in flight at the same time
+async def api_get_async(url, executor, semaphore, **kwargs):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        response = await loop.run_in_executor(executor, partial(api_get, url, **kwargs))
+    return response
+
+
+async def get_search_api_total_count_async(searchApiUrl, params, executor, semaphore, **kwargs):
+    countParams = dict(params)
+    countParams['start'] = 0
+    countParams['per_page'] = 1
+    response = await api_get_async(searchApiUrl, executor, semaphore, params=countParams, **kwargs)
     data = response.json()
+    return data['data']['total_count']
+
+
+# Get the items on a page of Search API results. If the page can't be retrieved, which happens when a
+# misindexed object is on the page (see https://github.com/IQSS/dataverse/issues/4225), split the page in half
+# and get each half, and so on, down to pages of one item. The start of each item that still
+# can't be retrieved is added to misindexedStarts
+async def get_search_api_page_items_async(
+    searchApiUrl, params, start, perPage, executor, semaphore, misindexedStarts, totalCount=None, **kwargs):
+
+    pageParams = dict(params)
+    pageParams['start'] = start
+    pageParams['per_page'] = perPage
+
+    pageKwargs = dict(kwargs)
+    pageKwargs.setdefault('maxRetries', searchApiPageMaxRetries)
+
+    try:
+        response = await api_get_async(searchApiUrl, executor, semaphore, params=pageParams, **pageKwargs)
+        data = response.json()
+        return data['data']['items']
+
+    except InstallationUnavailableError:
+        raise
+
+    except Exception:
+        if perPage == 1:
+            misindexedStarts.append(start)
+            return []
+
+        firstHalf = math.ceil(perPage / 2)
+        halves = [(start, firstHalf), (start + firstHalf, perPage - firstHalf)]
+
+        halvesItems = await asyncio.gather(*[
+            get_search_api_page_items_async(
+                searchApiUrl, params, halfStart, halfSize, executor, semaphore,
+                misindexedStarts, totalCount, **kwargs)
+            for halfStart, halfSize in halves
+            if totalCount is None or halfStart < totalCount])
+
+        return [item for items in halvesItems for item in items]
+
+
+# Asynchronous generator that pages through the results of a Search API query and yields each item.
+# Up to maxPagesInFlight pages are requested at a time. Pass the same executor and semaphore
+# to more than one generator to crawl the results of more than one installation at once.
+# Keyword arguments, like headers and verify, are passed to api_get
+async def iterate_search_api_items(
+    searchApiUrl, params, executor, semaphore, perPage=searchApiMaxPerPage, maxPagesInFlight=None,
+    misindexedStarts=None, progressBar=None, totalCount=None, **kwargs):
+
+    if misindexedStarts is None:
+        misindexedStarts = []
+    if maxPagesInFlight is None:
+        maxPagesInFlight = searchApiMaxConcurrency
+
+    if totalCount is None:
+        totalCount = await get_search_api_total_count_async(searchApiUrl, params, executor, semaphore, **kwargs)
+
+    if progressBar is not None:
+        progressBar.total = (progressBar.total or 0) + math.ceil(totalCount / perPage)
+        progressBar.refresh()
+
+    startsList = iter(range(0, totalCount, perPage))
+    pendingTasks = set()
+
+    try:
+        while True:
+            # Keep up to maxPagesInFlight pages requested
+            for start in startsList:
+                pendingTasks.add(asyncio.ensure_future(get_search_api_page_items_async(
+                    searchApiUrl, params, start, perPage, executor, semaphore, misindexedStarts,
+                    totalCount, **kwargs)))
+                if len(pendingTasks) >= maxPagesInFlight:
+                    break
+
+            if not pendingTasks:
+                break
+
+            doneTasks, pendingTasks = await asyncio.wait(pendingTasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in doneTasks:
+                if progressBar is not None:
+                    progressBar.update(1)
+                for item in task.result():
+                    yield item
+    finally:
+        for task in pendingTasks:
+            task.cancel()
+
+
+# Return a copy of the Search API params with another filter query added
+def add_search_api_filter_query(params, filterQuery):
+    slicedParams = dict(params)
+    fq = params.get('fq', [])
+    if isinstance(fq, str):
+        fq = [fq]
+    slicedParams['fq'] = list(fq) + [filterQuery]
+    return slicedParams
+
+
+# Return a filter query for objects whose dateSort is in the range from rangeStart up to, but not including, rangeEnd.
+# A rangeStart or rangeEnd of None leaves that end of the range open
+def get_date_sort_filter_query(rangeStart, rangeEnd):
+    if rangeStart is None:
+        rangeStartString = '*'
+    else:
+        rangeStartString = rangeStart.strftime('%Y-%m-%dT%H:%M:%SZ')
+    if rangeEnd is None:
+        return f'dateSort:[{rangeStartString} TO *]'
+    return f'dateSort:[{rangeStartString} TO {rangeEnd.strftime("%Y-%m-%dT%H:%M:%SZ")}}}'
+
+
+# Split a Search API query into disjoint slices that each have at most maxSliceSize results.
+# Returns a list of tuples with each slice's params and count of results, and the query's count of results.
+# If the counts of the slices don't add up to the query's count, e.g. because objects were indexed during
+# slicing, the query is returned as the only slice
+async def get_search_api_slices_async(searchApiUrl, params, executor, semaphore, maxSliceSize=None, **kwargs):
+
+    if maxSliceSize is None:
+        maxSliceSize = searchApiMaxSliceSize
+
+    async def get_count(sliceParams):
+        return await get_search_api_total_count_async(searchApiUrl, sliceParams, executor, semaphore, **kwargs)
+
+    async def split_date_range(typeParams, rangeStart, rangeEnd):
+        sliceParams = add_search_api_filter_query(typeParams, get_date_sort_filter_query(rangeStart, rangeEnd))
+        sliceCount = await get_count(sliceParams)
+
+        if (sliceCount <= maxSliceSize or None in [rangeStart, rangeEnd]
+                or rangeEnd - rangeStart <= searchApiMinSliceSpan):
+            return [(sliceParams, sliceCount)]
+
+        midpoint = rangeStart + (rangeEnd - rangeStart) / 2
+        midpoint = midpoint.replace(microsecond=0)
+        halvesSlices = await asyncio.gather(
+            split_date_range(typeParams, rangeStart, midpoint),
+            split_date_range(typeParams, midpoint, rangeEnd))
+        return [querySlice for halfSlices in halvesSlices for querySlice in halfSlices]
+
+    async def split_by_date(typeParams):
+        yearStarts = [None] + [
+            datetime(year, 1, 1, tzinfo=timezone.utc)
+            for year in range(searchApiSliceStartYear, datetime.now(timezone.utc).year + 2)]
+        yearEnds = yearStarts[1:] + [None]
+
+        rangesSlices = await asyncio.gather(*[
+            split_date_range(typeParams, rangeStart, rangeEnd)
+            for rangeStart, rangeEnd in zip(yearStarts, yearEnds)])
+        slices = [querySlice for rangeSlices in rangesSlices for querySlice in rangeSlices]
+
+        # Objects without a dateSort value aren't in any range
+        undatedParams = add_search_api_filter_query(typeParams, '-dateSort:[* TO *]')
+        slices.append((undatedParams, await get_count(undatedParams)))
+        return slices
+
+    totalCount = await get_count(params)
+    if totalCount <= maxSliceSize:
+        return [(params, totalCount)], totalCount
+
+    # Slice by object type first when more than one type is searched
+    types = params.get('type')
+    if isinstance(types, list) and len(types) > 1:
+        typeParamsList = []
+        for objectType in types:
+            typeParams = dict(params)
+            typeParams['type'] = [objectType]
+            typeParamsList.append(typeParams)
+    else:
+        typeParamsList = [params]
+
+    typesSlices = await asyncio.gather(*[split_by_date(typeParams) for typeParams in typeParamsList])
+    slices = [querySlice for typeSlices in typesSlices for querySlice in typeSlices if querySlice[1] > 0]
+
+    if sum(sliceCount for sliceParams, sliceCount in slices) != totalCount:
+        return [(params, totalCount)], totalCount
+
+    return slices, totalCount
+
+
+# Page through the results of a Search API query, or through each of its slices at the same time if partition is True,
+# and await pageFunction with each page of items turned into rows by rowFunction. maxSlicesInFlight limits
+# how many slices are paged through at the same time. Keyword arguments, like headers and verify, are passed to api_get
+async def crawl_search_api_query(
+    searchApiUrl, params, executor, semaphore, pageFunction, rowFunction=dict, perPage=searchApiMaxPerPage,
+    maxPagesInFlight=None, progressBar=None, partition=False, maxSlicesInFlight=None, **kwargs):
+
+    if partition is True:
+        apiGetKwargs = {key: value for key, value in kwargs.items() if key != 'misindexedStarts'}
+        slices, totalCount = await get_search_api_slices_async(
+            searchApiUrl, params, executor, semaphore, **apiGetKwargs)
+    else:
+        slices = [(params, None)]
+
+    if maxSlicesInFlight is None:
+        maxSlicesInFlight = len(slices)
+    sliceSemaphore = asyncio.Semaphore(maxSlicesInFlight)
+
+    async def crawl_slice(sliceParams, sliceCount):
+        async with sliceSemaphore:
+            rows = []
+            async for item in iterate_search_api_items(
+                searchApiUrl, sliceParams, executor, semaphore, perPage=perPage,
+                maxPagesInFlight=maxPagesInFlight, progressBar=progressBar, totalCount=sliceCount, **kwargs):
+                rows.append(rowFunction(item))
+                if len(rows) >= perPage:
+                    await pageFunction(rows)
+                    rows = []
+            if rows:
+                await pageFunction(rows)
+
+    await asyncio.gather(*[crawl_slice(sliceParams, sliceCount) for sliceParams, sliceCount in slices])
+
+
+# Use the Search API to get the results of many queries, e.g. one for each installation, at the same time.
+# queries is a dictionary whose values are dictionaries with each query's searchApiUrl and params, and optionally
+# a rowFunction that turns each item into a row, a misindexedStarts list, and keyword arguments for api_get.
+# Returns a dictionary with the same keys as queries and lists of rows as values.
+# If partition is True, queries with many results are split into slices that are paged through at the same time
+def get_search_api_rows_of_queries(
+    queries, maxConcurrency=None, perPage=searchApiMaxPerPage, showProgress=True, partition=False):
+
+    if maxConcurrency is None:
+        maxConcurrency = searchApiMaxConcurrency
+
+    async def crawl_query(queryName, query, executor, semaphore, progressBar):
+        query = dict(query)
+        searchApiUrl = query.pop('searchApiUrl')
+        params = query.pop('params')
+
+        rows = []
+
+        async def add_page(pageRows):
+            rows.extend(pageRows)
+
+        await crawl_search_api_query(
+            searchApiUrl, params, executor, semaphore, add_page, perPage=perPage,
+            maxPagesInFlight=maxConcurrency, progressBar=progressBar, partition=partition, **query)
+
+        return queryName, rows
+
+    async def crawl_queries(progressBar):
+        semaphore = asyncio.Semaphore(maxConcurrency)
+        with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+            results = await asyncio.gather(*[
+                crawl_query(queryName, query, executor, semaphore, progressBar)
+                for queryName, query in queries.items()], return_exceptions=True)
+
+        # Errors that aren't HTTP failures, like a KeyError in a rowFunction, are bugs and are raised
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, requests.exceptions.RequestException):
+                raise result
+
+        # If an installation seems to be down or its requests fail, stop crawling it
+        # but keep the results of the other queries
+        rowsDict = {}
+        for queryName, result in zip(queries.keys(), results):
+            if isinstance(result, Exception):
+                if len(queries) == 1:
+                    raise result
+                print(f'\tCould not get Search API results of {queryName}: {result}')
+                rowsDict[queryName] = []
+            else:
+                rowsDict[queryName] = result[1]
+        return rowsDict
+
+    if showProgress is True:
+        with tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=0) as progressBar:
+            return run_coroutine(crawl_queries(progressBar))
+    else:
+        return run_coroutine(crawl_queries(None))
+
+
+# Use the Search API to return a list of rows, one for each item in the results of the given query
+def get_search_api_rows(
+    searchApiUrl, params, rowFunction=dict, maxConcurrency=None, perPage=searchApiMaxPerPage, showProgress=True,
+    partition=False, **kwargs):
+
+    query = {
+        'searchApiUrl': searchApiUrl,
+        'params': params,
+        'rowFunction': rowFunction
+    }
+    query.update(kwargs)
+
+    rows = get_search_api_rows_of_queries(
+        {searchApiUrl: query}, maxConcurrency=maxConcurrency, perPage=perPage,
+        showProgress=showProgress, partition=partition)[searchApiUrl]
+
+    return rows
+
+
+# Generator that uses the Search API to yield a row for each item in the results of the given query, page by page,
+# without keeping the whole result list in memory. The results are paged through in a background thread and
+# at most maxQueuedPages pages of rows wait to be consumed, so memory use doesn't grow with the number of results
+def iterate_search_api_rows(
+    searchApiUrl, params, rowFunction=dict, maxConcurrency=None, perPage=searchApiMaxPerPage, showProgress=True,
+    partition=False, maxQueuedPages=4, **kwargs):
+
+    if maxConcurrency is None:
+        maxConcurrency = searchApiMaxConcurrency
+
+    pageQueue = queue.Queue(maxsize=maxQueuedPages)
+    stopCrawling = threading.Event()
+    endOfResults = object()
+    crawlErrors = []
+
+    # Wait until there's room in the queue, unless the generator was closed
+    def put_page(page):
+        while not stopCrawling.is_set():
+            try:
+                pageQueue.put(page, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    async def crawl(progressBar):
+        loop = asyncio.get_running_loop()
+
+        async def queue_page(pageRows):
+            if stopCrawling.is_set():
+                raise asyncio.CancelledError
+            await loop.run_in_executor(None, put_page, pageRows)
+
+        semaphore = asyncio.Semaphore(maxConcurrency)
+        with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+            # Page through one slice at a time so that pages of other slices don't pile up while waiting
+            await crawl_search_api_query(
+                searchApiUrl, params, executor, semaphore, queue_page, rowFunction=rowFunction,
+                perPage=perPage, maxPagesInFlight=maxConcurrency, progressBar=progressBar,
+                partition=partition, maxSlicesInFlight=1, **kwargs)
+
+    def run_crawl():
+        try:
+            if showProgress is True:
+                with tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=0) as progressBar:
+                    asyncio.run(crawl(progressBar))
+            else:
+                asyncio.run(crawl(None))
+        except (Exception, asyncio.CancelledError) as error:
+            crawlErrors.append(error)
+        finally:
+            put_page(endOfResults)
+
+    crawlThread = threading.Thread(target=run_crawl, daemon=True)
+    crawlThread.start()
+
+    try:
+        while True:
+            page = pageQueue.get()
+            if page is endOfResults:
+                break
+            for row in page:
+                yield row
+    finally:
+        stopCrawling.set()
+
+    if crawlErrors:
+        raise crawlErrors[0]
 
-    for item in data['data']['items']:
-        newRow = get_value_row_from_search_api_object(item, installationUrl)
-        objectInfoDict.append(dict(newRow))
+
+# Write rows, like the ones yielded by iterate_search_api_rows, to a CSV file as they're yielded.
+# The columns are the keys of the first row. Returns the number of rows written
+def write_rows_to_csv_file(rows, csvFilePath):
+    rowCount = 0
+    with open(csvFilePath, mode='w', newline='', encoding='utf-8') as f:
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row.keys()), extrasaction='ignore')
+                writer.writeheader()
+            writer.writerow(row)
+            rowCount += 1
+    return rowCount
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Reading and writing Parquet files requires the pyarrow package (pip install pyarrow)')
+    return pyarrow, pyarrow.parquet
+
+
+# Write rows, like the ones yielded by iterate_search_api_rows, to a Parquet file, rowsPerGroup rows at a time.
+# Column types are taken from the first group of rows, and columns that are empty in that group are saved as strings.
+# Requires the pyarrow package. Returns the number of rows written
+def write_rows_to_parquet_file(rows, parquetFilePath, rowsPerGroup=100000):
+    pa, pq = import_pyarrow()
+
+    rowCount = 0
+    writer = None
+    schema = None
+
+    def write_group(groupRows):
+        nonlocal writer, schema
+        if schema is None:
+            table = pa.Table.from_pylist(groupRows)
+            schema = pa.schema([
+                pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                for field in table.schema])
+            writer = pq.ParquetWriter(parquetFilePath, schema)
+        writer.write_table(pa.Table.from_pylist(groupRows, schema=schema))
+
+    try:
+        groupRows = []
+        for row in rows:
+            groupRows.append(row)
+            rowCount += 1
+            if len(groupRows) >= rowsPerGroup:
+                write_group(groupRows)
+                groupRows = []
+        if groupRows:
+            write_group(groupRows)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return rowCount
+
+
+# When syncing an inventory, items dated up to this long before the watermark are asked for again,
+# so that items that were indexed late aren't missed
+searchApiWatermarkOverlap = timedelta(days=1)
+
+
+# Return the date of a Search API item, which is its publication date, or creation date if it's unpublished, in UTC
+def get_search_api_item_date(item):
+    dateString = item.get('published_at') or item.get('createdAt')
+    if not dateString:
+        return None
+    itemDate = parse(dateString)
+    if itemDate.tzinfo is None:
+        itemDate = itemDate.replace(tzinfo=timezone.utc)
+    return itemDate.astimezone(timezone.utc)
+
+
+# Return a key that identifies a Search API query in an installation, for keeping track of its watermark
+def get_search_api_query_key(searchApiUrl, params):
+    queryParams = {
+        key: value for key, value in params.items()
+        if key not in ['start', 'per_page', 'sort', 'order']}
+    return f'{get_hostname(searchApiUrl)} {json.dumps(queryParams, sort_keys=True)}'
+
+
+# Version states of a dataset and the version states of the rows in a dataset inventory that they replace.
+# When a draft is published, the draft's row is replaced, and when a dataset is deaccessioned,
+# the rows of its published version and draft are replaced
+supersededVersionStates = {
+    'RELEASED': ['DRAFT'],
+    'DEACCESSIONED': ['RELEASED', 'DRAFT']
+}
+
+
+# Return the keys of the rows in a dataset inventory keyed on the dataset PID and version state that
+# the row of a dataset with the given PID and version state replaces. Use as sync_search_api_inventory's supersededKeysFunction
+def get_superseded_dataset_keys(datasetPid, versionState):
+    return [(datasetPid, supersededState) for supersededState in supersededVersionStates.get(versionState, [])]
+
+
+# Add the items of a Search API query that are newer than the query's watermark to an inventory CSV file.
+# The first time a query is synced, or if the inventory file doesn't exist, all of its items are added.
+# keyColumns are the columns that identify a row, so that rows of items that are found again replace the old rows.
+# If the inventory file doesn't have all of the keyColumns, e.g. because it was saved with other key columns,
+# it's rebuilt from all of the query's items.
+# supersededKeysFunction, if given, returns the keys of the rows that a new row replaces even though their keys differ,
+# e.g. the row of a draft that was published. Rows that were found again in the same sync are kept.
+# The watermarks, the newest item date seen for each query, are saved in a JSON file, by default next to the inventory file.
+# Items that were deleted from the installation aren't removed from the inventory.
+# Returns a list of all rows in the inventory and a list of the rows that were added or replaced
+def sync_search_api_inventory(
+    searchApiUrl, params, inventoryFilePath, keyColumns, rowFunction=dict, watermarkFilePath=None,
+    supersededKeysFunction=None, showProgress=True, **kwargs):
+
+    if watermarkFilePath is None:
+        watermarkFilePath = os.path.splitext(inventoryFilePath)[0] + '_watermarks.json'
+
+    watermarks = {}
+    if os.path.isfile(watermarkFilePath):
+        with open(watermarkFilePath, mode='r', encoding='utf-8') as f:
+            watermarks = json.load(f)
+
+    queryKey = get_search_api_query_key(searchApiUrl, params)
+
+    inventory = {}
+    syncParams = dict(params)
+    newestDate = None
+
+    incremental = os.path.isfile(inventoryFilePath) and queryKey in watermarks
+    if incremental is True:
+        with open(inventoryFilePath, mode='r', newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            if all(column in (reader.fieldnames or []) for column in keyColumns):
+                for row in reader:
+                    inventory[tuple(str(row[column]) for column in keyColumns)] = row
+            else:
+                print(f'Rebuilding {inventoryFilePath}, which doesn\'t have the columns {keyColumns}')
+                incremental = False
+
+    if incremental is True:
+        # Ask only for items dated on or after the watermark, newest first
+        newestDate = parse(watermarks[queryKey])
+        syncParams = add_search_api_filter_query(
+            syncParams, get_date_sort_filter_query(newestDate - searchApiWatermarkOverlap, None))
+
+    syncParams['sort'] = 'date'
+    syncParams['order'] = 'desc'
+
+    newRows = []
+    for itemDate, row in iterate_search_api_rows(
+        searchApiUrl, syncParams,
+        rowFunction=lambda item: (get_search_api_item_date(item), rowFunction(item)),
+        showProgress=showProgress,
+        partition=True,
+        **kwargs):
+
+        inventory[tuple(str(row[column]) for column in keyColumns)] = row
+        newRows.append(row)
+        if itemDate is not None and (newestDate is None or itemDate > newestDate):
+            newestDate = itemDate
+
+    if supersededKeysFunction is not None:
+        foundKeys = set(tuple(str(row[column]) for column in keyColumns) for row in newRows)
+        for row in newRows:
+            for key in supersededKeysFunction(row):
+                if tuple(key) not in foundKeys:
+                    inventory.pop(tuple(key), None)
+
+    # Write the inventory to a temporary file and then replace the old inventory file with it,
+    # so that a failed run doesn't leave a partly written inventory
+    fieldnames = []
+    for row in inventory.values():
+        for column in row:
+            if column not in fieldnames:
+                fieldnames.append(column)
+
+    temporaryFilePath = f'{inventoryFilePath}.tmp'
+    with open(temporaryFilePath, mode='w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(inventory.values())
+    os.replace(temporaryFilePath, inventoryFilePath)
+
+    # Save the watermark only after the inventory is saved
+    if newestDate is not None:
+        watermarks[queryKey] = newestDate.strftime('%Y-%m-%dT%H:%M:%SZ')
+        with open(watermarkFilePath, mode='w', encoding='utf-8') as f:
+            json.dump(watermarks, f, indent=4)
+
+    return list(inventory.values()), newRows
 
 
 # Uses Search API to return dataframe containing info about collectoins, datasets or files in an installation
@@ -650,107 +1742,361 @@ def get_object_dataframe_from_search_api(
     # Add param to show database IDs of each item
     params['show_entity_ids'] = 'true'
 
-    # Get total count of objects
-    params['per_page'] = 1
-
-    response = requests.get(
-        url,
-        params=params,
-        headers=header
-    )
-
-    # print(response.request.url)
-
-    data = response.json()
-    totalDatasetCount = data['data']['total_count']
-
     if None not in [rootWindow, progressText, progressLabel]:
         text = 'Looking for datasets...'
         progressText.set(text)
         progressLabel.config(fg='green')
         progressLabel = progressLabel.grid(sticky='w', row=0)
         rootWindow.update_idletasks()
-    
-    # Create start variables to paginate through SearchAPI results
-    start = 0
-    apiCallsCount = round(totalDatasetCount/10)
-    startsList = [0]
-    for apiCall in range(apiCallsCount):
-        start = start + 10
-        startsList.append(start)
-    startsListCount = len(startsList)
-
-    # misindexedObjectCount = 0
-    objectInfoDict = []
-
-    if None not in [rootWindow, progressText, progressLabel]:
-        Parallel(
-            n_jobs=4, 
-            backend='threading')(delayed(get_object_dictionary_from_search_api_page)(
-                installationUrl, header, params, start, objectInfoDict) for start in startsList)
-
+        showProgress = False
     else:
-        with tqdm_joblib(
-            tqdm(
-                bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', 
-                total=startsListCount)) as progress_bar:
-            Parallel(
-                n_jobs=4, 
-                backend='threading')(delayed(get_object_dictionary_from_search_api_page)(
-                    installationUrl, header, params, start, objectInfoDict) for start in startsList)        
+        showProgress = True
+
+    # Page through slices of the Search API results asynchronously and turn each item into a row
+    objectInfoDict = get_search_api_rows(
+        url, params,
+        rowFunction=lambda item: get_value_row_from_search_api_object(item, installationUrl),
+        showProgress=showProgress,
+        partition=True,
+        headers=header)
 
     objectInfoDF = pd.DataFrame(objectInfoDict)
 
     return objectInfoDF
 
 
-# Uses "Get Contents" endpoint to return list of dataverse aliases of all subcollections in a given collection
-def get_all_subcollection_aliases(collectionUrl, apiKey=''):
+# Generator version of get_object_dataframe_from_search_api that yields a row for each collection, dataset or file,
+# page by page, so that results with millions of items can be written to a file or filtered without keeping them in memory
+def iterate_object_rows_from_search_api(url, params, objectType, apiKey=None, showProgress=True):
 
-    parsed = urlparse(collectionUrl)
-    installationUrl = parsed.scheme + '://' + parsed.netloc
-    alias = parsed.path.split('/')[2]
+    installationUrl = get_installation_url(url)
 
     if apiKey:
         header = {'X-Dataverse-key': apiKey}
     else:
         header = {}
 
-    # Get ID of given dataverse alias
-    dataverseInfoEndpoint = f'{installationUrl}/api/dataverses/{alias}'
+    params['type'] = objectType
 
-    response = requests.get(
-        dataverseInfoEndpoint,
+    # Add param to show database IDs of each item
+    params['show_entity_ids'] = 'true'
+
+    for row in iterate_search_api_rows(
+        url, params,
+        rowFunction=lambda item: get_value_row_from_search_api_object(item, installationUrl),
+        showProgress=showProgress,
+        partition=True,
+        headers=header):
+        yield row
+
+
+# Incremental version of iterate_object_rows_from_search_api that adds only the collections, datasets or files
+# that are newer than the ones found in the last sync to the inventory CSV file. See sync_search_api_inventory
+def sync_object_inventory_from_search_api(
+    url, params, objectType, inventoryFilePath, keyColumns, apiKey=None, showProgress=True,
+    supersededKeysFunction=None):
+
+    installationUrl = get_installation_url(url)
+
+    if apiKey:
+        header = {'X-Dataverse-key': apiKey}
+    else:
+        header = {}
+
+    params['type'] = objectType
+
+    # Add param to show database IDs of each item
+    params['show_entity_ids'] = 'true'
+
+    return sync_search_api_inventory(
+        url, params, inventoryFilePath, keyColumns,
+        rowFunction=lambda item: get_value_row_from_search_api_object(item, installationUrl),
+        supersededKeysFunction=supersededKeysFunction,
+        showProgress=showProgress,
         headers=header)
-    data = response.json()
-    parentDataverseId = data['data']['id']
 
-    # Create list and add ID of given dataverse
-    dataverseIds = [parentDataverseId]
 
-    # Get each subdataverse in the given dataverse
-    for dataverseId in dataverseIds:
-        dataverseGetContentsEndpoint = f'{installationUrl}/api/dataverses/{dataverseId}/contents'
-        response = requests.get(
-            dataverseGetContentsEndpoint,
-            headers=header)
-        data = response.json()
+# Tree of a collection and the collections it owns, with each collection's database ID, alias, name,
+# parent collection ID and child collection IDs, and, if they were crawled, the datasets each collection owns,
+# as they're listed by the "Get Contents" endpoint. Linked collections and datasets aren't included
+class CollectionTree:
+    def __init__(self, installationUrl):
+        self.installationUrl = installationUrl
+        self.rootId = None
+        self.collections = {}
+        self.idsByAlias = {}
+
+    def add_collection(self, collectionId, alias, name, parentId=None, collectionType=None):
+        self.collections[collectionId] = {
+            'id': collectionId,
+            'alias': alias,
+            'name': name,
+            'type': collectionType,
+            'parentId': parentId,
+            'childIds': [],
+            'datasets': []
+        }
+        self.idsByAlias[alias] = collectionId
+        if parentId in self.collections:
+            self.collections[parentId]['childIds'].append(collectionId)
+        elif self.rootId is None:
+            self.rootId = collectionId
+
+    def get_id(self, collectionIdOrAlias=None):
+        if collectionIdOrAlias is None:
+            return self.rootId
+        if collectionIdOrAlias in self.collections:
+            return collectionIdOrAlias
+        return self.idsByAlias[collectionIdOrAlias]
+
+    def get_alias(self, collectionId):
+        return self.collections[collectionId]['alias']
+
+    # Return the IDs of the given collection, by default the tree's root, and all collections under it,
+    # level by level
+    def get_subtree_ids(self, collectionIdOrAlias=None):
+        subtreeIds = [self.get_id(collectionIdOrAlias)]
+        for collectionId in subtreeIds:
+            subtreeIds.extend(self.collections[collectionId]['childIds'])
+        return subtreeIds
+
+    def get_aliases(self, collectionIdOrAlias=None):
+        return [self.get_alias(collectionId) for collectionId in self.get_subtree_ids(collectionIdOrAlias)]
+
+    # Return tuples of each collection in the subtree and each dataset it owns
+    def get_datasets(self, collectionIdOrAlias=None):
+        return [
+            (self.collections[collectionId], dataset)
+            for collectionId in self.get_subtree_ids(collectionIdOrAlias)
+            for dataset in self.collections[collectionId]['datasets']]
+
+
+# Crawl the tree of a collection and its subcollections level by level. The "Get Contents" and "View a Dataverse Collection"
+# endpoints of every collection in a level are called at the same time, so each collection's alias and name
+# are known when its children are found. maxDepth limits how many levels under the collection are crawled,
+# and includeDatasets keeps the datasets each collection owns. Returns a CollectionTree
+def get_collection_tree(
+    installationUrl, collectionIdOrAlias=':root', apiKey='', includeDatasets=False, maxDepth=None,
+    maxConcurrency=None, verify=None):
 
-        for item in data['data']:
-            if item['type'] == 'dataverse':
-                dataverseId = item['id']
-                dataverseIds.extend([dataverseId])
-
-    # Get the alias for each dataverse ID
-    dataverseAliases = []
-    for dataverseId in dataverseIds:
-        dataverseInfoEndpoint = f'{installationUrl}/api/dataverses/{dataverseId}'
-        response = requests.get(
-            dataverseInfoEndpoint,
-            headers=header)
-        data = response.json()
-        alias = data['data']['alias']
-        dataverseAliases.append(alias)
+    if apiKey:
+        header = {'X-Dataverse-key': apiKey}
+    else:
+        header = {}
+
+    if maxConcurrency is None:
+        maxConcurrency = get_max_concurrency(installationUrl)
+
+    tree = CollectionTree(installationUrl)
+    level = [(collectionIdOrAlias, None)]
+    depth = 0
+
+    with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+        while level:
+            infoFutures = [
+                executor.submit(api_get, f'{installationUrl}/api/dataverses/{collectionId}', headers=header, verify=verify)
+                for collectionId, parentId in level]
+            contentsFutures = [
+                executor.submit(api_get, f'{installationUrl}/api/dataverses/{collectionId}/contents', headers=header, verify=verify)
+                for collectionId, parentId in level]
+
+            nextLevel = []
+            for (collectionId, parentId), infoFuture, contentsFuture in zip(level, infoFutures, contentsFutures):
+                collectionData = infoFuture.result().json()['data']
+                contentsData = contentsFuture.result().json()['data']
+
+                tree.add_collection(
+                    collectionData['id'], collectionData['alias'], collectionData['name'], parentId,
+                    collectionData.get('dataverseType'))
+
+                for item in contentsData:
+                    if item['type'] == 'dataverse' and (maxDepth is None or depth < maxDepth):
+                        nextLevel.append((item['id'], collectionData['id']))
+                    elif item['type'] == 'dataset' and includeDatasets is True:
+                        tree.collections[collectionData['id']]['datasets'].append(item)
+
+            level = nextLevel
+            depth += 1
+
+    return tree
+
+
+# Local SQLite index of the collection trees of installations, so that looking up root collections, aliases and
+# subcollections doesn't need API calls every time. Subtrees are crawled again when they were last crawled
+# more than collectionTreeIndexMaxAge ago
+collectionTreeIndexPath = str(Path.home() / '.dataverse_collection_tree_index.sqlite')
+collectionTreeIndexMaxAge = timedelta(days=1)
+
+
+@contextlib.contextmanager
+def open_collection_tree_index():
+    connection = sqlite3.connect(collectionTreeIndexPath, timeout=30)
+    try:
+        connection.row_factory = sqlite3.Row
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS collections (
+                hostname TEXT NOT NULL,
+                id INTEGER NOT NULL,
+                alias TEXT NOT NULL,
+                name TEXT,
+                parent_id INTEGER,
+                type TEXT,
+                is_root INTEGER NOT NULL DEFAULT 0,
+                indexed_at TEXT NOT NULL,
+                subtree_indexed_at TEXT,
+                PRIMARY KEY (hostname, id))''')
+        connection.execute('CREATE INDEX IF NOT EXISTS collections_alias ON collections (hostname, alias)')
+        connection.execute('CREATE INDEX IF NOT EXISTS collections_parent ON collections (hostname, parent_id)')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS dataset_sizes (
+                hostname TEXT NOT NULL,
+                pid TEXT NOT NULL,
+                version TEXT NOT NULL,
+                byte_size INTEGER NOT NULL,
+                fetched_at TEXT NOT NULL,
+                PRIMARY KEY (hostname, pid, version))''')
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
+
+def is_index_date_stale(indexedAt):
+    if indexedAt is None:
+        return True
+    return datetime.now(timezone.utc) - datetime.fromisoformat(indexedAt) > collectionTreeIndexMaxAge
+
+
+# Return the index row of a collection, or None if the collection isn't in the index
+def get_indexed_collection(installationUrl, collectionIdOrAlias):
+    hostname = get_hostname(installationUrl)
+    with open_collection_tree_index() as connection:
+        if collectionIdOrAlias == ':root':
+            row = connection.execute(
+                'SELECT * FROM collections WHERE hostname = ? AND is_root = 1', (hostname,)).fetchone()
+        elif isinstance(collectionIdOrAlias, int):
+            row = connection.execute(
+                'SELECT * FROM collections WHERE hostname = ? AND id = ?', (hostname, collectionIdOrAlias)).fetchone()
+        else:
+            row = connection.execute(
+                'SELECT * FROM collections WHERE hostname = ? AND alias = ?', (hostname, collectionIdOrAlias)).fetchone()
+    if row is None:
+        return None
+    return dict(row)
+
+
+# Crawl the tree of a collection and replace its subtree in the index. Returns the CollectionTree
+def index_collection_tree(installationUrl, collectionIdOrAlias=':root', apiKey='', verify=None):
+    hostname = get_hostname(installationUrl)
+    rootCollection = get_root_collection_info(installationUrl, apiKey=apiKey, verify=verify)
+
+    tree = get_collection_tree(installationUrl, collectionIdOrAlias, apiKey=apiKey, verify=verify)
+    indexedAt = datetime.now(timezone.utc).isoformat()
+
+    with open_collection_tree_index() as connection:
+        parentId = get_indexed_parent_id(connection, hostname, tree)
+
+        # Remove the collections that were in the subtree the last time it was indexed, in case some were deleted or moved
+        connection.execute('''
+            WITH RECURSIVE subtree(id) AS (
+                SELECT id FROM collections WHERE hostname = ? AND id = ?
+                UNION ALL
+                SELECT collections.id FROM collections JOIN subtree ON collections.parent_id = subtree.id
+                WHERE collections.hostname = ?)
+            DELETE FROM collections WHERE hostname = ? AND id IN subtree''',
+            (hostname, tree.rootId, hostname, hostname))
+
+        connection.executemany('''
+            INSERT OR REPLACE INTO collections
+            (hostname, id, alias, name, parent_id, type, is_root, indexed_at, subtree_indexed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', [
+                (hostname, collection['id'], collection['alias'], collection['name'],
+                 parentId if collection['id'] == tree.rootId else collection['parentId'],
+                 collection['type'], int(collection['id'] == rootCollection['id']), indexedAt, indexedAt)
+                for collection in tree.collections.values()])
+
+    return tree
+
+
+# The root of a crawled tree has no parent in the tree, so keep the parent it had in the index, if any
+def get_indexed_parent_id(connection, hostname, tree):
+    row = connection.execute(
+        'SELECT parent_id FROM collections WHERE hostname = ? AND id = ?', (hostname, tree.rootId)).fetchone()
+    if row is None:
+        return None
+    return row['parent_id']
+
+
+# Return a dictionary with the database ID, alias and name of the installation's root collection,
+# from the index if it's there, or from the "View a Dataverse Collection" endpoint
+def get_root_collection_info(installationUrl, apiKey='', verify=None):
+    rootCollection = get_indexed_collection(installationUrl, ':root')
+    if rootCollection is not None and not is_index_date_stale(rootCollection['indexed_at']):
+        return rootCollection
+
+    if apiKey:
+        header = {'X-Dataverse-key': apiKey}
+    else:
+        header = {}
+
+    # Installations running old Dataverse versions might not support :root, so fall back
+    # to the collection whose database ID is 1, which is the root collection in most installations
+    response = api_get(f'{installationUrl}/api/dataverses/:root', headers=header, verify=verify)
+    if response.status_code != 200:
+        response = api_get(f'{installationUrl}/api/dataverses/1', headers=header, verify=verify)
+    collectionData = response.json()['data']
+
+    hostname = get_hostname(installationUrl)
+    indexedAt = datetime.now(timezone.utc).isoformat()
+    with open_collection_tree_index() as connection:
+        connection.execute('UPDATE collections SET is_root = 0 WHERE hostname = ?', (hostname,))
+        connection.execute('''
+            INSERT INTO collections (hostname, id, alias, name, parent_id, type, is_root, indexed_at)
+            VALUES (?, ?, ?, ?, NULL, ?, 1, ?)
+            ON CONFLICT (hostname, id) DO UPDATE SET
+                alias = excluded.alias, name = excluded.name, type = excluded.type,
+                is_root = 1, indexed_at = excluded.indexed_at''',
+            (hostname, collectionData['id'], collectionData['alias'], collectionData['name'],
+             collectionData.get('dataverseType'), indexedAt))
+
+    return get_indexed_collection(installationUrl, ':root')
+
+
+# Return the aliases of a collection and all of its subcollections from the index,
+# crawling the collection's tree first if it hasn't been indexed recently
+def get_indexed_subtree_aliases(installationUrl, collectionIdOrAlias, apiKey='', verify=None):
+    collection = get_indexed_collection(installationUrl, collectionIdOrAlias)
+    if collection is None or is_index_date_stale(collection['subtree_indexed_at']):
+        tree = index_collection_tree(installationUrl, collectionIdOrAlias, apiKey=apiKey, verify=verify)
+        collectionId = tree.rootId
+    else:
+        collectionId = collection['id']
+
+    hostname = get_hostname(installationUrl)
+    with open_collection_tree_index() as connection:
+        rows = connection.execute('''
+            WITH RECURSIVE subtree(id, depth) AS (
+                SELECT id, 0 FROM collections WHERE hostname = ? AND id = ?
+                UNION ALL
+                SELECT collections.id, subtree.depth + 1 FROM collections JOIN subtree ON collections.parent_id = subtree.id
+                WHERE collections.hostname = ?)
+            SELECT collections.alias FROM subtree JOIN collections ON collections.id = subtree.id
+            WHERE collections.hostname = ?
+            ORDER BY subtree.depth''',
+            (hostname, collectionId, hostname, hostname)).fetchall()
+
+    return [row['alias'] for row in rows]
+
+
+# Return list of dataverse aliases of all subcollections in a given collection from the collection tree index,
+# which uses the "Get Contents" endpoint to crawl collections that haven't been indexed recently
+def get_all_subcollection_aliases(collectionUrl, apiKey=''):
+
+    parsed = urlparse(collectionUrl)
+    installationUrl = parsed.scheme + '://' + parsed.netloc
+    alias = parsed.path.split('/')[2]
+
+    dataverseAliases = get_indexed_subtree_aliases(installationUrl, alias, apiKey=apiKey)
 
     return dataverseAliases
 
@@ -759,7 +2105,7 @@ def get_collection_info(installationUrl, alias, dataverseCollectionInfoDict, hea
 
     try:
         viewCollectionApiEndpointURL = f'{installationUrl}/api/dataverses/{alias}'
-        response = requests.get(
+        response = api_get(
             viewCollectionApiEndpointURL,
             headers=header,
             verify=verify)
@@ -806,10 +2152,10 @@ def get_collection_info(installationUrl, alias, dataverseCollectionInfoDict, hea
 def get_collections_info(installationUrl, aliasList, dataverseCollectionInfoDict, header, apiKey=''):
     aliasCount = len(aliasList)
 
-    # Use joblib library to use 4 CPU cores to make SearchAPI calls to get info about datasets
-    # and report progress using tqdm progress bars
+    # Use joblib library to make API calls in threads and report progress using tqdm progress bars.
+    # The installation's concurrency controller decides how many of the threads' calls are in flight at once
     with tqdm_joblib(tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=aliasCount)) as progress_bar:
-        Parallel(n_jobs=4, backend='threading')(delayed(get_collection_info)(
+        Parallel(n_jobs=get_max_concurrency(installationUrl), backend='threading')(delayed(get_collection_info)(
             installationUrl,
             alias,
             dataverseCollectionInfoDict,
@@ -847,9 +2193,20 @@ def get_canonical_pid(pidOrUrl):
     return canonicalPid
 
 
+# Return the resolvable URL of a canonical DOI or Handle, or None for other kinds of PIDs
+def get_persistent_url_from_pid(canonicalPid):
+    if canonicalPid.startswith('doi:'):
+        return 'https://doi.org/' + canonicalPid[len('doi:'):]
+    elif canonicalPid.startswith('hdl:'):
+        return 'https://hdl.handle.net/' + canonicalPid[len('hdl:'):]
+    return None
+
+
+# If inventoryFilePath is given, only datasets that are newer than the ones found the last time the function ran
+# with the same url are looked for in the Search API results, and they're added to the inventory CSV file
 def get_datasets_from_collection_or_search_url(
     url, rootWindow=None, progressLabel=None, progressText=None, textBoxCollectionDatasetPIDs=None, 
-    apiKey='', ignoreDeaccessionedDatasets=False, subdataverses=False):
+    apiKey='', ignoreDeaccessionedDatasets=False, subdataverses=False, inventoryFilePath=None):
 
     # Hide the textBoxCollectionDatasetPIDs scrollbox if it exists
     if textBoxCollectionDatasetPIDs is not None:
@@ -862,10 +2219,74 @@ def get_datasets_from_collection_or_search_url(
     baseUrl = requestsGetProperties['baseUrl']
     params = requestsGetProperties['params']
 
-    datasetInfoDF = get_object_dataframe_from_search_api(
-        url=baseUrl, rootWindow=rootWindow, progressLabel=progressLabel, progressText=progressText,
-        params=params, objectType='dataset', apiKey=apiKey)
-    datasetCount = len(datasetInfoDF.index)
+    if None not in [rootWindow, progressText, progressLabel]:
+        text = 'Looking for datasets...'
+        progressText.set(text)
+        progressLabel.config(fg='green')
+        progressLabel = progressLabel.grid(sticky='w', row=0)
+        rootWindow.update_idletasks()
+        showProgress = False
+    else:
+        showProgress = True
+
+    # Before paging through the results, get the aliases of the collections whose datasets should be kept.
+    # None means all datasets in the results are kept
+    collectionAliases = None
+
+    # Check if url is collection url. If so:
+    if 'q=' not in url:
+        # If the user wants datasets in all subdataverses and the url
+        # is not the root collection, keep datasets owned by any of the
+        # subdataverses. This will exclude linked datasets
+        if subdataverses == True and is_root_collection(url) == False:
+            collectionAliases = set(get_all_subcollection_aliases(url, apiKey=apiKey))
+
+        # If the user wants only datasets in the collection,
+        # and not in collections within the collection, keep only datasets owned by that collection
+        # (including the alias of the root collection)
+        elif subdataverses == False:
+            collectionAliases = {get_alias_from_collection_url(url)}
+
+    if textBoxCollectionDatasetPIDs is not None:
+        # Clear whatever's in the textBoxCollectionDatasetPIDs textbox
+        textBoxCollectionDatasetPIDs.configure(state ='normal')
+        textBoxCollectionDatasetPIDs.delete('1.0', END)
+
+    # Stream the dataset rows instead of collecting them in a dataframe, and keep only the PIDs
+    # that have been seen, since the Search API results list a dataset's published and draft versions
+    datasetCount = 0
+    deaccessionedDatasetCount = 0
+    datasetPids = set()
+
+    if inventoryFilePath is None:
+        datasetRows = iterate_object_rows_from_search_api(
+            url=baseUrl, params=params, objectType='dataset', apiKey=apiKey, showProgress=showProgress)
+    else:
+        datasetRows = sync_object_inventory_from_search_api(
+            url=baseUrl, params=params, objectType='dataset', inventoryFilePath=inventoryFilePath,
+            keyColumns=['dataset_pid', 'version_state'], apiKey=apiKey, showProgress=showProgress,
+            supersededKeysFunction=lambda row: get_superseded_dataset_keys(row['dataset_pid'], row['version_state']))[0]
+
+    for datasetRow in datasetRows:
+        datasetCount += 1
+
+        # To ignore deaccessioned datasets, skip all datasets where version_state is DEACCESSIONED
+        if ignoreDeaccessionedDatasets == True and 'DEACCESSIONED' in datasetRow['version_state']:
+            deaccessionedDatasetCount += 1
+            continue
+
+        if collectionAliases is not None and datasetRow['dataverse_collection_alias'] not in collectionAliases:
+            continue
+
+        if datasetRow['dataset_pid'] in datasetPids:
+            continue
+        datasetPids.add(datasetRow['dataset_pid'])
+
+        # Insert the dataset PID into the textBoxCollectionDatasetPIDs scrollbox
+        if textBoxCollectionDatasetPIDs is not None:
+            textBoxCollectionDatasetPIDs.insert('end', datasetRow['dataset_pid'] + '\n')
+
+    uniqueDatasetCount = len(datasetPids)
 
     if datasetCount == 0:
         text = 'Datasets found: 0'
@@ -874,71 +2295,12 @@ def get_datasets_from_collection_or_search_url(
             progressText.set(text)
         else:
             print(text)
-    
-    elif datasetCount > 0:
 
-        deaccessionedDatasetCount = 0
-        
-        # To ignore deaccessioned datasets, remove from the dataframe all datasets where version_state is DEACCESSIONED 
-        if ignoreDeaccessionedDatasets == True:
-            datasetInfoDF = datasetInfoDF[datasetInfoDF['version_state'].str.contains('DEACCESSIONED') == False]
-            deaccessionedDatasetCount = datasetCount - len(datasetInfoDF.index)
-
-        # Remove version_state column so that I can remove the dataframe's duplicate rows and there's only one row per dataset
-        datasetInfoDF = datasetInfoDF.drop('version_state', axis=1)
-
-        # Drop duplicate rows, which happens when Search API results lists a dataset's published and draft versions
-        datasetInfoDF = datasetInfoDF.drop_duplicates()
-
-        # Recount datasets
-        uniqueDatasetCount = len(datasetInfoDF.index)
-
-        # Check if url is collection url. If so:
-        if 'q=' not in url:
-            # If the user wants datasets in all subdataverses and the url
-            # is the root collection, don't filter the dataframe
-            if subdataverses == True and is_root_collection(url) == True:
-                uniqueDatasetCount = len(datasetInfoDF)
-
-            # If the user wants datasets in all subdataverses and the url
-            # is not the root collection...
-            elif subdataverses == True and is_root_collection(url) == False:
-                # Get the aliases of all subdataverses...
-                dataverseAliases = get_all_subcollection_aliases(url, apiKey=apiKey)
-
-                # Remove any datasets that aren't owned by any of the 
-                # subdataverses. This will exclude linked datasets
-                datasetInfoDF = datasetInfoDF[
-                    datasetInfoDF['dataverse_collection_alias'].isin(dataverseAliases)]
-
-                uniqueDatasetCount = len(datasetInfoDF)
-
-            # If the user wants only datasets in the collection,
-            # and not in collections within the collection...
-            elif subdataverses == False:
-                # Get the alias of the collection (including the alias of the root collection)
-                alias = get_alias_from_collection_url(url)
-                # Retain only datasets owned by that collection
-                datasetInfoDF = datasetInfoDF[datasetInfoDF['dataverse_collection_alias'].isin([alias])]
-
-                uniqueDatasetCount = len(datasetInfoDF)
-
-        # If the url is a search URL, get all datasetPids from datasetInfoDF 
-        elif 'q=' in url:
-            uniqueDatasetCount = len(datasetInfoDF)
+    elif datasetCount > 0:
 
         if textBoxCollectionDatasetPIDs is not None:
-            # Place textbox with list of dataset PIDs and set state to read/write (normal) 
+            # Place textbox with list of dataset PIDs
             textBoxCollectionDatasetPIDs.grid(sticky='w', row=2, pady=5)
-            textBoxCollectionDatasetPIDs.configure(state ='normal')
-            
-            # Clear whatever's in the textBoxCollectionDatasetPIDs textbox
-            textBoxCollectionDatasetPIDs.delete('1.0', END)
-
-            # Insert the dataset PIDs into the textBoxCollectionDatasetPIDs scrollbox
-            for dfIndex, dfRow in datasetInfoDF.iterrows():
-                datasetPid = dfRow['dataset_pid'] + '\n'
-                textBoxCollectionDatasetPIDs.insert('end', datasetPid)
 
         # Create and place result text with uniqueDatasetCount
         if deaccessionedDatasetCount == 0:
@@ -973,8 +2335,8 @@ def get_dataset_size(installationUrl, apiKey, datasetIdorPid):
         datasetSizeEndpointUrl = f'{installationUrl}/api/datasets/:persistentId/storagesize?persistentId={datasetIdorPid}'
     elif isinstance(datasetIdorPid, int):
         datasetSizeEndpointUrl = f'{installationUrl}/api/datasets/{datasetIdorPid}/storagesize'
-    response = requests.get(
-        datasetSizeEndpointUrl, headers={'X-Dataverse-key': apiKey})
+    response = api_get(
+        datasetSizeEndpointUrl, apiKey=apiKey)
     byteSizeInt = get_int_from_size_message(sizeEndpointJson=response.json())
     byteSizePretty = format_size(byteSizeInt)
 
@@ -984,38 +2346,167 @@ def get_dataset_size(installationUrl, apiKey, datasetIdorPid):
     }
     return sizeFormats
 
+# Return the version of a dataset in Search API results, e.g. 1.0 or DRAFT
+def get_search_api_dataset_version(item):
+    if item.get('versionState') == 'DRAFT':
+        return 'DRAFT'
+    return f"{item.get('majorVersion')}.{item.get('minorVersion')}"
+
+
+# Return the version of a dataset in Search API results that its size is cached under. Files can be added to
+# and removed from a draft without changing its version, so the draft's update time is added, e.g. DRAFT@2024-01-31T10:00:00Z
+def get_search_api_dataset_size_version(item):
+    version = get_search_api_dataset_version(item)
+    if version == 'DRAFT' and item.get('updatedAt'):
+        version = f"DRAFT@{item['updatedAt']}"
+    return version
+
+
+# Return a dictionary of the byte sizes of the given datasets, fetched at the same time.
+# datasetVersions is a dictionary of dataset PIDs and the versions found for each, made by
+# get_search_api_dataset_size_version, which are used to cache the sizes in the collection tree index.
+# Sizes of datasets whose versions haven't changed since the last time they were fetched are taken from the cache.
+# Datasets with no versions, or with a draft whose update time isn't known, are always fetched and aren't cached,
+# since there's no way to tell when they change. Datasets whose sizes can't be fetched are left out
+def get_dataset_sizes(installationUrl, apiKey, datasetVersions, maxConcurrency=None):
+
+    hostname = get_hostname(installationUrl)
+    if maxConcurrency is None:
+        maxConcurrency = get_max_concurrency(installationUrl)
+
+    # An empty key means that the dataset's size isn't cached
+    versionKeys = {
+        datasetPid: '+'.join(sorted(versions)) if 'DRAFT' not in versions else ''
+        for datasetPid, versions in datasetVersions.items()}
+
+    datasetSizes = {}
+    with open_collection_tree_index() as connection:
+        for datasetPid, versionKey in versionKeys.items():
+            if not versionKey:
+                continue
+            row = connection.execute(
+                'SELECT byte_size FROM dataset_sizes WHERE hostname = ? AND pid = ? AND version = ?',
+                (hostname, datasetPid, versionKey)).fetchone()
+            if row is not None:
+                datasetSizes[datasetPid] = row['byte_size']
+
+    def fetch_size(datasetPid):
+        try:
+            return datasetPid, get_dataset_size(installationUrl, apiKey, datasetIdorPid=datasetPid)['byteSizeInt']
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f'\tCould not get the size of {datasetPid}: {e}')
+            return datasetPid, None
+
+    uncachedPids = [datasetPid for datasetPid in versionKeys if datasetPid not in datasetSizes]
+    with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+        fetchedSizes = [
+            (datasetPid, byteSize) for datasetPid, byteSize in executor.map(fetch_size, uncachedPids)
+            if byteSize is not None]
+
+    fetchedAt = datetime.now(timezone.utc).isoformat()
+    with open_collection_tree_index() as connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO dataset_sizes (hostname, pid, version, byte_size, fetched_at) VALUES (?, ?, ?, ?, ?)',
+            [(hostname, datasetPid, versionKeys[datasetPid], byteSize, fetchedAt)
+             for datasetPid, byteSize in fetchedSizes if versionKeys[datasetPid]])
+
+    datasetSizes.update(fetchedSizes)
+    return datasetSizes
+
+
+# Get the byte sizes of the files in every collection of a collection's tree, with and without the collections under it.
+# The datasets that each collection owns are found with the "Get Contents" endpoint while the tree is crawled, so
+# unpublished datasets that the API key can see are counted too. Only the versions of those datasets are looked up
+# with the Search API, their sizes are fetched at the same time or taken from the cache, and the sizes are added up
+# from the bottom of the tree to the top. Linked datasets and collections aren't counted.
+# Returns a list of dictionaries, one for each collection, with the tree's top collection first
+def get_collection_size_rollup(installationUrl, apiKey, collectionIdOrAlias=':root', maxDepth=None, showProgress=True):
+
+    tree = get_collection_tree(installationUrl, collectionIdOrAlias, apiKey=apiKey, includeDatasets=True, maxDepth=maxDepth)
+    subtreeIds = tree.get_subtree_ids()
+
+    # Get the PID and owning collection of each dataset in the tree
+    datasetOwnerIds = {}
+    for collection, dataset in tree.get_datasets():
+        if dataset.get('persistentUrl'):
+            datasetPid = get_canonical_pid(dataset['persistentUrl'])
+        else:
+            datasetPid = f"{dataset['protocol']}:{dataset['authority']}/{dataset['identifier']}"
+        datasetOwnerIds[datasetPid] = collection['id']
+
+    # Look up the versions of those datasets, which are used to cache their sizes.
+    # Datasets that the Search API doesn't find, e.g. ones that aren't indexed yet, have no versions and aren't cached
+    datasetVersions = {datasetPid: set() for datasetPid in datasetOwnerIds}
+    pidsByLowercasePid = {datasetPid.lower(): datasetPid for datasetPid in datasetOwnerIds}
+    if showProgress is True:
+        print(f'Looking up the versions of {len(datasetOwnerIds)} dataset(s)')
+    items = search_datasets_by_pids(installationUrl, list(datasetOwnerIds), apiKey=apiKey)[0]
+    for item in items:
+        datasetPid = pidsByLowercasePid.get(item['global_id'].lower())
+        if datasetPid is not None:
+            datasetVersions[datasetPid].add(get_search_api_dataset_size_version(item))
+
+    datasetSizes = get_dataset_sizes(installationUrl, apiKey, datasetVersions)
+
+    ownSizes = {collectionId: 0 for collectionId in subtreeIds}
+    datasetCounts = {collectionId: 0 for collectionId in subtreeIds}
+    unknownSizeCounts = {collectionId: 0 for collectionId in subtreeIds}
+    for datasetPid, ownerId in datasetOwnerIds.items():
+        datasetCounts[ownerId] += 1
+        if datasetPid in datasetSizes:
+            ownSizes[ownerId] += datasetSizes[datasetPid]
+        else:
+            unknownSizeCounts[ownerId] += 1
+
+    # Children come after their parents in subtreeIds, so going through it backwards
+    # adds up each collection's subtree after the subtrees of its children
+    subtreeSizes = {}
+    for collectionId in reversed(subtreeIds):
+        subtreeSizes[collectionId] = ownSizes[collectionId] + sum(
+            subtreeSizes[childId] for childId in tree.collections[collectionId]['childIds'])
+
+    rollupRows = []
+    for collectionId in subtreeIds:
+        collection = tree.collections[collectionId]
+        parentId = collection['parentId']
+        rollupRows.append({
+            'collection_id': collectionId,
+            'collection_alias': collection['alias'],
+            'collection_name': collection['name'],
+            'parent_collection_alias': tree.get_alias(parentId) if parentId in tree.collections else '',
+            'dataset_count': datasetCounts[collectionId],
+            'datasets_with_unknown_size': unknownSizeCounts[collectionId],
+            'byte_size': ownSizes[collectionId],
+            'byte_size_pretty': format_size(ownSizes[collectionId]),
+            'subtree_byte_size': subtreeSizes[collectionId],
+            'subtree_byte_size_pretty': format_size(subtreeSizes[collectionId])
+        })
+
+    return rollupRows
+
+
 # Get byte size of files in collection
 def get_collection_size(installationUrl, apiKey, collectionIdOrAlias, includeSubCollections=True):
 
     if includeSubCollections is True:
         collectionSizeEndpointUrl = f'{installationUrl}/api/dataverses/{collectionIdOrAlias}/storagesize'
-        response = requests.get(
-            collectionSizeEndpointUrl, headers={'X-Dataverse-key': apiKey})
+        response = api_get(
+            collectionSizeEndpointUrl, apiKey=apiKey)
         byteSizeInt = get_int_from_size_message(sizeEndpointJson=response.json())
         byteSizePretty = format_size(byteSizeInt)
 
-    # If we don't want to include sizes of files in collection's subcollections...
+    # If we don't want to include sizes of files in collection's subcollections,
+    # get the sizes of the datasets in the given collection at the same time and add them up.
+    # If any of their sizes can't be fetched, raise instead of returning a total that's too small
     elif includeSubCollections is False:
-        # Use Get Contents API endpoint to get a list of PIDs of datasets published in the given collection
-        datasetPids = []
-        dataverseGetContentsEndpoint = f'{installationUrl}/api/dataverses/{collectionIdOrAlias}/contents'
-        response = requests.get(
-            dataverseGetContentsEndpoint,
-            headers={'X-Dataverse-key': apiKey})
-        data = response.json()
-
-        for content in data['data']:
-            if content['type'] == 'dataset':
-                datasetPid = get_canonical_pid(content['persistentUrl'])
-                datasetPids.append(datasetPid)
-
-        # Get the sum of byte sizes of all datasets in datasetPids list
-        datasetsSizeSum = 0
-        for datasetPid in datasetPids:
-            datasetSizeInt = get_dataset_size(installationUrl, apiKey, datasetIdorPid=datasetPid)['byteSizeInt']
-            datasetsSizeSum = datasetsSizeSum + datasetSizeInt
-
-        byteSizeInt = datasetsSizeSum
+        collectionRow = get_collection_size_rollup(
+            installationUrl, apiKey, collectionIdOrAlias, maxDepth=0, showProgress=False)[0]
+        if collectionRow['datasets_with_unknown_size'] > 0:
+            raise RuntimeError(
+                f"Could not get the sizes of {collectionRow['datasets_with_unknown_size']} of the "
+                f"{collectionRow['dataset_count']} dataset(s) in {collectionIdOrAlias}")
+
+        byteSizeInt = collectionRow['byte_size']
         byteSizePretty = format_size(byteSizeInt)
 
     # Create dictionary that includes byte size as an int and a human readable string, e.g. 4MB
@@ -1027,45 +2518,76 @@ def get_collection_size(installationUrl, apiKey, collectionIdOrAlias, includeSub
     return sizeFormats
 
 
+# Add the HTTP status, byte count and latency of a response to the responseInfo dictionary, if one is given.
+# Counts and latencies of more than one response are added up. For streamed responses, pass the number of
+# bytes that were read as byteCount, since reading response.content would load the whole response
+def record_response_info(responseInfo, response, startTime, byteCount=None):
+    if responseInfo is not None:
+        if byteCount is None:
+            byteCount = len(response.content)
+        responseInfo['httpStatus'] = response.status_code
+        responseInfo['byteCount'] = responseInfo.get('byteCount', 0) + byteCount
+        responseInfo['latency'] = responseInfo.get('latency', 0) + time.monotonic() - startTime
+        responseInfo['requestCount'] = responseInfo.get('requestCount', 0) + 1
+
+
+def record_response_error(responseInfo, error):
+    if responseInfo is not None:
+        responseInfo['error'] = repr(error)
+
+
+# Formats of the exports that are XML documents
+xmlExportFormats = ('ddi', 'oai_ddi', 'dcterms', 'oai_dc', 'Datacite', 'oai_datacite')
+
+
+# If a responseInfo dictionary is given, the HTTP status, byte count and latency of the response are added to it.
+# XML exports are returned as strings prettified by BeautifulSoup. To save exports without parsing them, use
+# stream_dataset_export
 def get_dataset_metadata_export(
-    installationUrl, datasetPid, exportFormat, timeout, verify,
-    allVersions=False, header={}, apiKey=''):
-    if apiKey:
-        header['X-Dataverse-key'] = apiKey
+    installationUrl, datasetPid, exportFormat, timeout=None, verify=None,
+    allVersions=False, header={}, apiKey='', responseInfo=None):
 
     if exportFormat == 'dataverse_json':
         if allVersions is False:
             dataGetLatestVersionUrl = f'{installationUrl}/api/datasets/:persistentId'
             dataGetLatestVersionUrl = dataGetLatestVersionUrl.replace('//api', '/api')
             try:
-                response = requests.get(
+                startTime = time.monotonic()
+                response = api_get(
                     dataGetLatestVersionUrl,
                     params={'persistentId': datasetPid},
-                    headers=header, 
-                    timeout=timeout, 
+                    headers=header,
+                    apiKey=apiKey,
+                    timeout=timeout,
                     verify=verify)
+                record_response_info(responseInfo, response, startTime)
                 if response.status_code == 200 and 'metadataBlocks' in response.json()['data']['latestVersion']:
                     data = response.json()
                 else:
                     data = 'ERROR'
-            except Exception:
+            except Exception as e:
+                record_response_error(responseInfo, e)
                 data = 'ERROR'
 
         elif allVersions is True:
             dataGetAllVersionsUrl = f'{installationUrl}/api/datasets/:persistentId/versions'
             dataGetAllVersionsUrl = dataGetAllVersionsUrl.replace('//api', '/api')
             try:
-                response = requests.get(
+                startTime = time.monotonic()
+                response = api_get(
                     dataGetAllVersionsUrl,
                     params={'persistentId': datasetPid},
                     headers=header,
-                    timeout=timeout, 
+                    apiKey=apiKey,
+                    timeout=timeout,
                     verify=verify)
+                record_response_info(responseInfo, response, startTime)
                 if response.status_code == 200 and 'metadataBlocks' in response.json()['data'][0]:
                     data = response.json()
                 else:
                     data = 'ERROR'
-            except Exception:
+            except Exception as e:
+                record_response_error(responseInfo, e)
                 data = 'ERROR'
 
     # For getting metadata from other exports, which are available only for each dataset's latest published
@@ -1075,49 +2597,894 @@ def get_dataset_metadata_export(
         datasetMetadataExportEndpoint = f'{installationUrl}/api/datasets/export'
         datasetMetadataExportEndpoint = datasetMetadataExportEndpoint.replace('//api', '/api')
         try:
-            response = requests.get(
+            startTime = time.monotonic()
+            response = api_get(
                 datasetMetadataExportEndpoint,
                 params={
                     'persistentId': datasetPid,
                     'exporter': exportFormat
                     },
                 headers=header,
-                timeout=timeout, 
+                apiKey=apiKey,
+                timeout=timeout,
                 verify=verify)
+            record_response_info(responseInfo, response, startTime)
 
             if response.status_code == 200:
                 
                 if exportFormat in ('schema.org' , 'OAI_ORE'):
                     data = response.json()
 
-                if exportFormat in ('ddi' , 'oai_ddi', 'dcterms', 'oai_dc', 'Datacite', 'oai_datacite'):
+                if exportFormat in xmlExportFormats:
+                    from bs4 import BeautifulSoup
                     string = response.text
                     data = BeautifulSoup(string, 'xml').prettify()
             else:
                 data = 'ERROR'
-        except Exception:
+        except Exception as e:
+            record_response_error(responseInfo, e)
             data = 'ERROR'
 
     return data
 
+
+# Return the extension of the files that a metadata export format is saved in
+def get_export_file_extension(exportFormat):
+    if exportFormat in xmlExportFormats:
+        return '.xml'
+    if exportFormat == 'html':
+        return '.html'
+    return '.json'
+
+
+# Stream a dataset's export in a format other than Dataverse JSON, such as an XML export, straight into a file,
+# without parsing it. The export is written to a temporary
+# file that's renamed when the download is complete, so interrupted downloads don't leave partial files.
+# Returns True if the export was saved
+def stream_dataset_export(
+    installationUrl, datasetPid, exportFormat, filePath, timeout=None, verify=None,
+    header={}, apiKey='', responseInfo=None, chunkSize=65536):
+
+    datasetMetadataExportEndpoint = f'{installationUrl}/api/datasets/export'
+    datasetMetadataExportEndpoint = datasetMetadataExportEndpoint.replace('//api', '/api')
+    temporaryFilePath = filePath + '.part'
+    try:
+        startTime = time.monotonic()
+        with contextlib.closing(api_get(
+                datasetMetadataExportEndpoint,
+                params={
+                    'persistentId': datasetPid,
+                    'exporter': exportFormat
+                    },
+                headers=header,
+                apiKey=apiKey,
+                timeout=timeout,
+                verify=verify,
+                stream=True)) as response:
+
+            byteCount = 0
+            if response.status_code == 200:
+                with open(temporaryFilePath, mode='wb') as f:
+                    for chunk in response.iter_content(chunk_size=chunkSize):
+                        f.write(chunk)
+                        byteCount += len(chunk)
+            record_response_info(responseInfo, response, startTime, byteCount)
+
+        if response.status_code != 200:
+            return False
+        os.replace(temporaryFilePath, filePath)
+        return True
+
+    except Exception as e:
+        record_response_error(responseInfo, e)
+        if os.path.exists(temporaryFilePath):
+            os.remove(temporaryFilePath)
+        return False
+
+
+# Rewrite an XML export file in canonical form (C14N 2.0), which removes the differences in whitespace within tags,
+# attribute order and namespace declarations between exports that hold the same metadata. Text, including
+# leading and trailing whitespace in values like abstracts, isn't changed. Meant to be run
+# in a ProcessPoolExecutor, so that it doesn't hold up the threads that download exports.
+# Returns the path of the file, or raises an exception if the file isn't well-formed XML
+def canonicalize_xml_export_file(filePath):
+    temporaryFilePath = filePath + '.c14n'
+    try:
+        with open(temporaryFilePath, mode='w', encoding='utf-8') as f:
+            ElementTree.canonicalize(from_file=filePath, out=f)
+    except Exception:
+        os.remove(temporaryFilePath)
+        raise
+    os.replace(temporaryFilePath, filePath)
+    return filePath
+
+
+# Hostnames of installations whose "Get all versions" responses don't include what's needed
+# to build the latest version's Dataverse JSON export, so single request mode isn't used for them
+installationsWithoutSingleRequestExports = set()
+
+
+# Build what the "Get JSON of a dataset" endpoint returns from what the "Get all versions" endpoint returns,
+# so that only one request is needed for each dataset when saving all versions. The latest version is the first version,
+# the publisher is the name of the installation's root collection, the publication date is the release date of
+# the earliest published version, and the persistentUrl is made from the PID. Returns None if the export can't be built
+def get_latest_version_export_from_versions(installationUrl, datasetPid, allVersionsMetadata, apiKey='', verify=None):
+    versions = allVersionsMetadata['data']
+
+    releaseTimes = []
+    for version in versions:
+        if version['versionState'] in ('RELEASED', 'DEACCESSIONED'):
+            if not version.get('releaseTime'):
+                installationsWithoutSingleRequestExports.add(get_hostname(installationUrl))
+                return None
+            releaseTimes.append(version['releaseTime'])
+
+    canonicalPid = versions[0].get('datasetPersistentId', get_canonical_pid(datasetPid))
+    persistentUrl = get_persistent_url_from_pid(canonicalPid)
+    if persistentUrl is None:
+        return None
+
+    try:
+        publisher = get_root_collection_info(installationUrl, apiKey=apiKey, verify=verify)['name']
+    except Exception:
+        return None
+
+    if releaseTimes:
+        publicationDate = min(releaseTimes)[:10]
+    else:
+        publicationDate = None
+
+    return {
+        'status': allVersionsMetadata['status'],
+        'data': {
+            'persistentUrl': persistentUrl,
+            'publisher': publisher,
+            'publicationDate': publicationDate,
+            'latestVersion': versions[0]}}
+
+
+# Journal of the statuses of dataset metadata exports, kept in a SQLite database in WAL mode.
+# Worker threads add events to a queue, and one writer thread saves them in batches, so workers don't
+# have to open and close a file for each dataset. Each dataset gets a row with whether its export was saved,
+# and the HTTP status, byte count, latency and error of its requests, and each saved version gets a row
+# with the name and size of its file. If the writer thread can't save events, e.g. because the disk is full,
+# the error is raised when the journal is closed, so that a run isn't reported as complete when its journal isn't
+class ExportStatusJournal:
+    def __init__(self, journalFilePath, runId=None):
+        self.journalFilePath = journalFilePath
+        self.runId = runId or time.strftime('%Y.%m.%d_%H.%M.%S')
+        self.eventQueue = queue.Queue()
+        self.stopEvent = object()
+        self.writeError = None
+
+        with contextlib.closing(sqlite3.connect(journalFilePath)) as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS dataset_exports (
+                    run_id TEXT NOT NULL,
+                    requested_pid TEXT NOT NULL,
+                    dataset_pid TEXT NOT NULL,
+                    export_format TEXT NOT NULL,
+                    saved INTEGER NOT NULL,
+                    http_status INTEGER,
+                    byte_count INTEGER,
+                    latency REAL,
+                    request_count INTEGER,
+                    error TEXT,
+                    recorded_at TEXT NOT NULL)''')
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS version_exports (
+                    run_id TEXT NOT NULL,
+                    dataset_pid TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    export_format TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    byte_count INTEGER NOT NULL,
+                    recorded_at TEXT NOT NULL)''')
+            connection.commit()
+
+        self.writerThread = threading.Thread(target=self.write_events, daemon=True)
+        self.writerThread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_events(self):
+        try:
+            with contextlib.closing(sqlite3.connect(self.journalFilePath)) as connection:
+                stopping = False
+                while not stopping:
+                    events = [self.eventQueue.get()]
+                    # Save all events that are waiting in one transaction
+                    while True:
+                        try:
+                            events.append(self.eventQueue.get_nowait())
+                        except queue.Empty:
+                            break
+
+                    with connection:
+                        for event in events:
+                            if event is self.stopEvent:
+                                stopping = True
+                                continue
+                            table, row = event
+                            connection.execute(
+                                f'INSERT INTO {table} ({", ".join(row)}) VALUES ({", ".join("?" * len(row))})',
+                                list(row.values()))
+
+        # Keep the error to raise it in close(), since an error in this thread would otherwise only be printed
+        except Exception as e:
+            self.writeError = e
+
+    def record_dataset(self, requestedPid, datasetPid, exportFormat, saved, responseInfo=None):
+        responseInfo = responseInfo or {}
+        self.eventQueue.put(('dataset_exports', {
+            'run_id': self.runId,
+            'requested_pid': requestedPid,
+            'dataset_pid': datasetPid,
+            'export_format': exportFormat,
+            'saved': int(saved),
+            'http_status': responseInfo.get('httpStatus'),
+            'byte_count': responseInfo.get('byteCount'),
+            'latency': responseInfo.get('latency'),
+            'request_count': responseInfo.get('requestCount'),
+            'error': responseInfo.get('error'),
+            'recorded_at': datetime.now(timezone.utc).isoformat()}))
+
+    def record_version(self, datasetPid, version, exportFormat, fileName, byteCount):
+        self.eventQueue.put(('version_exports', {
+            'run_id': self.runId,
+            'dataset_pid': datasetPid,
+            'version': version,
+            'export_format': exportFormat,
+            'file_name': fileName,
+            'byte_count': byteCount,
+            'recorded_at': datetime.now(timezone.utc).isoformat()}))
+
+    def close(self):
+        if self.writerThread.is_alive():
+            self.eventQueue.put(self.stopEvent)
+            self.writerThread.join()
+        if self.writeError is not None:
+            raise self.writeError
+
+    # Write the download status CSV file of this run, with one row for each dataset.
+    # With allRuns=True, the CSV file has the last status of each dataset in any run recorded in the journal
+    # With byFormat=True, the CSV file has a row for each dataset and export format, for runs that save more than one format
+    def write_download_status_file(self, downloadStatusFilePath, allRuns=False, exportFormat='dataverse_json', byFormat=False):
+        with contextlib.closing(sqlite3.connect(self.journalFilePath)) as connection:
+            if allRuns is True:
+                rows = connection.execute('''
+                    SELECT dataset_pid, export_format, saved FROM dataset_exports WHERE rowid IN (
+                        SELECT MAX(rowid) FROM dataset_exports GROUP BY requested_pid, export_format)
+                    ORDER BY rowid''').fetchall()
+            else:
+                rows = connection.execute(
+                    'SELECT dataset_pid, export_format, saved FROM dataset_exports WHERE run_id = ? ORDER BY rowid',
+                    (self.runId,)).fetchall()
+
+        with open(downloadStatusFilePath, mode='w', newline='', encoding='utf-8') as downloadStatusFile:
+            writer = csv.writer(downloadStatusFile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            if byFormat is True:
+                writer.writerow(['dataset_pid', 'export_format', 'export_saved'])
+                for datasetPid, rowExportFormat, saved in rows:
+                    writer.writerow([datasetPid, rowExportFormat, bool(saved)])
+            else:
+                writer.writerow(['dataset_pid', f'{exportFormat}_export_saved'])
+                for datasetPid, rowExportFormat, saved in rows:
+                    writer.writerow([datasetPid, bool(saved)])
+
+
+# Return the set of PIDs, in lowercase, of datasets whose exports were already saved, so that an interrupted
+# download can be resumed. When there's an ExportStatusJournal, datasets are complete only if the journal recorded
+# that their exports were saved. Only for directories saved without a journal, datasets are complete if the directory
+# or a bundle in it has their latest version's export file, which is the last file saved for each dataset.
+# Datasets whose downloads failed or didn't start aren't included, so they're tried again
+def get_completed_dataset_exports(journalFilePath=None, directoryPath=None, exportFormat='dataverse_json'):
+    completedPids = set()
+
+    if journalFilePath is not None and os.path.isfile(journalFilePath):
+        with contextlib.closing(sqlite3.connect(journalFilePath)) as connection:
+            try:
+                rows = connection.execute(
+                    'SELECT requested_pid, dataset_pid FROM dataset_exports WHERE saved = 1 AND export_format = ?',
+                    (exportFormat,)).fetchall()
+            except sqlite3.OperationalError:
+                rows = None
+        if rows is not None:
+            for requestedPid, datasetPid in rows:
+                completedPids.add(requestedPid.lower())
+                completedPids.add(datasetPid.lower())
+            return completedPids
+
+    # Export file names are the PID with colons and slashes replaced by underscores,
+    # followed by the version, e.g. doi_10.70122_FK2_ABCDEF_v1.0(latest_version).json
+    if directoryPath is not None and os.path.isdir(directoryPath):
+        for fileName in get_dataset_export_file_names(directoryPath, latestVersionOnly=True):
+            match = re.match(r'^(.*)_[^_]+\(latest_version\)\.json$', fileName)
+            if match:
+                completedPids.add(match.group(1).lower())
+
+    return completedPids
+
+
+def is_dataset_export_completed(datasetPid, completedPids):
+    return (
+        datasetPid.lower() in completedPids
+        or datasetPid.replace(':', '_').replace('/', '_').lower() in completedPids)
+
+
+# Status writer used by save_dataset_export when there's no journal, which appends each dataset's status
+# to the download status CSV file
+class DownloadStatusFileWriter:
+    def __init__(self, downloadStatusFile):
+        self.writer = csv.writer(
+            downloadStatusFile, delimiter=',', quotechar='"', 
+            quoting=csv.QUOTE_MINIMAL)
+
+    def record_dataset(self, requestedPid, datasetPid, exportFormat, saved, responseInfo=None):
+        self.writer.writerow([datasetPid, saved])
+
+    def record_version(self, datasetPid, version, exportFormat, fileName, byteCount):
+        pass
+
+
+@contextlib.contextmanager
+def open_download_status_writer(downloadStatusFilePath, journal=None):
+    if journal is not None:
+        yield journal
+    else:
+        with open(downloadStatusFilePath, mode='a', newline='', encoding='utf-8') as downloadStatusFile:
+            yield DownloadStatusFileWriter(downloadStatusFile)
+
+
+# Name of the bundle file that save_dataset_exports saves exports in when storage='bundle'
+exportBundleName = 'dataset_exports'
+exportBundleExtensions = {'gzip': '.ndjson.gz', 'zstd': '.ndjson.zst'}
+
+
+def get_export_bundle_path(directoryPath, compression='gzip'):
+    return os.path.join(directoryPath, exportBundleName + exportBundleExtensions[compression])
+
+
+def get_export_bundle_index_path(bundleFilePath):
+    return bundleFilePath + '.index.csv'
+
+
+def get_export_bundle_compression(bundleFilePath):
+    for compression, extension in exportBundleExtensions.items():
+        if bundleFilePath.endswith(extension):
+            return compression
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('Reading and writing .ndjson.zst bundles requires the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+def compress_export_record(data, compression):
+    if compression == 'zstd':
+        return import_zstandard().ZstdCompressor().compress(data)
+    return gzip.compress(data)
+
+
+def decompress_export_record(data, compression):
+    if compression == 'zstd':
+        return import_zstandard().ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+# Bundle of dataset metadata exports: one NDJSON file with a line for each saved file, compressed with gzip
+# or zstd, and a CSV index of the byte offset and length of each line. Each line is compressed on its own,
+# as a separate gzip member or zstd frame, so the bundle can be read as one stream by ordinary tools
+# and a single export can be read by seeking to its offset. Exports are compressed in the threads that
+# save them, and the lines are appended and indexed one at a time
+class ExportBundleWriter:
+    def __init__(self, bundleFilePath, compression=None):
+        self.bundleFilePath = bundleFilePath
+        self.indexFilePath = get_export_bundle_index_path(bundleFilePath)
+        self.compression = compression or get_export_bundle_compression(bundleFilePath) or 'gzip'
+        self.lock = threading.Lock()
+
+        # When adding to a bundle whose writing was interrupted, cut off any line that wasn't indexed
+        indexedEnd = 0
+        if os.path.isfile(self.indexFilePath):
+            for row in read_export_bundle_index(bundleFilePath).values():
+                indexedEnd = max(indexedEnd, row['offset'] + row['length'])
+        if os.path.isfile(bundleFilePath) and os.path.getsize(bundleFilePath) > indexedEnd:
+            os.truncate(bundleFilePath, indexedEnd)
+
+        self.bundleFile = open(bundleFilePath, mode='ab')
+        newIndex = not os.path.isfile(self.indexFilePath)
+        self.indexFile = open(self.indexFilePath, mode='a', newline='', encoding='utf-8')
+        self.indexWriter = csv.writer(self.indexFile)
+        if newIndex:
+            self.indexWriter.writerow(['file_name', 'dataset_pid', 'version', 'offset', 'length'])
+            self.indexFile.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Save a dataset version's metadata under the name of the file it would be saved in. Returns the size of the
+    # uncompressed line
+    def write(self, fileName, datasetPid, version, metadata):
+        line = json.dumps(
+            {'file_name': fileName, 'dataset_pid': datasetPid, 'version': version, 'metadata': metadata},
+            separators=(',', ':')).encode('utf-8') + b'\n'
+        self.write_compressed(fileName, datasetPid, version, compress_export_record(line, self.compression))
+        return len(line)
+
+    def write_compressed(self, fileName, datasetPid, version, compressedLine):
+        with self.lock:
+            offset = self.bundleFile.tell()
+            self.bundleFile.write(compressedLine)
+            self.bundleFile.flush()
+            self.indexWriter.writerow([fileName, datasetPid, version, offset, len(compressedLine)])
+            self.indexFile.flush()
+
+    # Copy a line from another bundle, given its row in that bundle's index,
+    # without decompressing it if both bundles use the same compression
+    def copy_from(self, sourceBundlePath, row):
+        fileName = row['file_name']
+        compressedLine = read_export_bundle_record(sourceBundlePath, row, decompress=False)
+        if get_export_bundle_compression(sourceBundlePath) == self.compression:
+            self.write_compressed(fileName, row['dataset_pid'], row['version'], compressedLine)
+            return len(decompress_export_record(compressedLine, self.compression))
+        record = json.loads(decompress_export_record(
+            compressedLine, get_export_bundle_compression(sourceBundlePath)))
+        return self.write(fileName, row['dataset_pid'], row['version'], record['metadata'])
+
+    def close(self):
+        with self.lock:
+            self.bundleFile.close()
+            self.indexFile.close()
+
+
+# Return a dictionary of the file names in a bundle and their rows in the bundle's index.
+# If a file was saved in the bundle more than once, the last one is used
+def read_export_bundle_index(bundleFilePath):
+    indexRows = {}
+    with open(get_export_bundle_index_path(bundleFilePath), mode='r', newline='', encoding='utf-8') as indexFile:
+        for row in csv.DictReader(indexFile):
+            row['offset'] = int(row['offset'])
+            row['length'] = int(row['length'])
+            indexRows[row['file_name']] = row
+    return indexRows
+
+
+def read_export_bundle_record(bundleFilePath, indexRow, decompress=True):
+    with open(bundleFilePath, mode='rb') as bundleFile:
+        bundleFile.seek(indexRow['offset'])
+        compressedLine = bundleFile.read(indexRow['length'])
+    if decompress is False:
+        return compressedLine
+    return json.loads(decompress_export_record(compressedLine, get_export_bundle_compression(bundleFilePath)))
+
+
+# Return the metadata saved in a bundle for a dataset version, looked up by its file name,
+# or for a dataset's latest version, looked up by its PID. Returns None if it isn't in the bundle
+def read_dataset_export_from_bundle(bundleFilePath, fileNameOrPid):
+    indexRows = read_export_bundle_index(bundleFilePath)
+    indexRow = indexRows.get(fileNameOrPid)
+    if indexRow is None:
+        for row in indexRows.values():
+            if row['dataset_pid'].lower() == fileNameOrPid.lower() and row['file_name'].endswith('(latest_version).json'):
+                indexRow = row
+    if indexRow is None:
+        return None
+    return read_export_bundle_record(bundleFilePath, indexRow)['metadata']
+
+
+def get_export_bundle_paths(directoryPath):
+    bundleFilePaths = []
+    for extension in exportBundleExtensions.values():
+        bundleFilePaths.extend(sorted(glob.glob(os.path.join(glob.escape(directoryPath), '*' + extension))))
+    return bundleFilePaths
+
+
+# Name of the manifest that lists the exports saved in a directory with storage='sharded'
+exportManifestName = 'manifest.csv'
+
+
+# Return the path that an export file is saved in when exports are sharded: two levels of subdirectories named after
+# the first characters of a hash of the dataset's PID, e.g. 3f/a2/doi_10.70122_FK2_ABCDEF_v1.0.json.
+# All versions of a dataset are saved in the same subdirectory
+def get_sharded_export_file_path(directoryPath, fileName):
+    pidHash = hashlib.md5(split_export_file_name(fileName)[0].lower().encode('utf-8')).hexdigest()
+    return os.path.join(directoryPath, pidHash[:2], pidHash[2:4], fileName)
+
+
+# Writer of export files sharded into subdirectories, which adds a row to the directory's manifest for each file
+# it saves, so that readers can list the exports without scanning the subdirectories
+class ShardedExportWriter:
+    def __init__(self, directoryPath):
+        self.directoryPath = directoryPath
+        self.lock = threading.Lock()
+
+        manifestFilePath = os.path.join(directoryPath, exportManifestName)
+        newManifest = not os.path.isfile(manifestFilePath)
+        self.manifestFile = open(manifestFilePath, mode='a', newline='', encoding='utf-8')
+        self.manifestWriter = csv.writer(self.manifestFile)
+        if newManifest:
+            self.manifestWriter.writerow(['file_name', 'dataset_pid', 'version', 'path', 'byte_count'])
+            self.manifestFile.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_file_path(self, fileName):
+        return get_sharded_export_file_path(self.directoryPath, fileName)
+
+    def write(self, fileName, datasetPid, version, metadata):
+        filePath = self.get_file_path(fileName)
+        os.makedirs(os.path.dirname(filePath), exist_ok=True)
+        metadataJson = json.dumps(metadata, indent=4)
+        write_file_atomically(filePath, metadataJson)
+        self.add_to_manifest(fileName, datasetPid, version, filePath, len(metadataJson))
+        return len(metadataJson)
+
+    # Add a file saved in an earlier run, using a hard link when possible
+    def link_file(self, sourceFilePath, fileName, datasetPid, version):
+        filePath = self.get_file_path(fileName)
+        os.makedirs(os.path.dirname(filePath), exist_ok=True)
+        if not os.path.exists(filePath):
+            try:
+                os.link(sourceFilePath, filePath)
+            except OSError:
+                shutil.copy2(sourceFilePath, filePath)
+        byteCount = os.path.getsize(filePath)
+        self.add_to_manifest(fileName, datasetPid, version, filePath, byteCount)
+        return byteCount
+
+    def add_to_manifest(self, fileName, datasetPid, version, filePath, byteCount):
+        relativePath = Path(os.path.relpath(filePath, self.directoryPath)).as_posix()
+        with self.lock:
+            self.manifestWriter.writerow([fileName, datasetPid, version, relativePath, byteCount])
+            self.manifestFile.flush()
+
+    def close(self):
+        with self.lock:
+            self.manifestFile.close()
+
+
+# Return a dictionary of the file names in a directory's manifest and their rows, or an empty dictionary
+# if the directory has no manifest. If a file was saved more than once, the last row is used
+def read_export_manifest(directoryPath):
+    manifestRows = {}
+    manifestFilePath = os.path.join(directoryPath, exportManifestName)
+    if os.path.isfile(manifestFilePath):
+        with open(manifestFilePath, mode='r', newline='', encoding='utf-8') as manifestFile:
+            for row in csv.DictReader(manifestFile):
+                manifestRows[row['file_name']] = row
+    return manifestRows
+
+
+# Return the names of the exports saved in a directory as JSON files, in sharded subdirectories listed
+# in the directory's manifest, or in bundles
+def get_dataset_export_file_names(directoryPath, latestVersionOnly=False):
+    pattern = '*(latest_version).json' if latestVersionOnly else '*.json'
+    fileNames = [os.path.basename(filePath) for filePath in glob.glob(os.path.join(glob.escape(directoryPath), pattern))]
+    fileNames.extend(
+        fileName for fileName in read_export_manifest(directoryPath)
+        if not latestVersionOnly or fileName.endswith('(latest_version).json'))
+    for bundleFilePath in get_export_bundle_paths(directoryPath):
+        fileNames.extend(
+            fileName for fileName in read_export_bundle_index(bundleFilePath)
+            if not latestVersionOnly or fileName.endswith('(latest_version).json'))
+    return fileNames
+
+
+# Return the number of exports that iterate_dataset_exports yields for a directory
+def count_dataset_exports(directoryPath, latestVersionOnly=False):
+    return len(get_dataset_export_file_names(directoryPath, latestVersionOnly))
+
+
+# Yield the file name and metadata of each dataset export saved in a directory, whether the exports are saved
+# as JSON files, in sharded subdirectories or in bundles. Sharded files are found from the directory's manifest
+# instead of by scanning the subdirectories. Lines in bundles are read in the order they were saved, and if a file was
+# saved in a bundle more than once, only its last line is read
+def iterate_dataset_exports(directoryPath, latestVersionOnly=False):
+    pattern = '*(latest_version).json' if latestVersionOnly else '*.json'
+    for filePath in glob.glob(os.path.join(glob.escape(directoryPath), pattern)):
+        with open(filePath, 'r') as f:
+            yield os.path.basename(filePath), json.load(f)
+
+    for fileName, row in read_export_manifest(directoryPath).items():
+        if latestVersionOnly and not fileName.endswith('(latest_version).json'):
+            continue
+        with open(os.path.join(directoryPath, row['path']), 'r') as f:
+            yield fileName, json.load(f)
+
+    for bundleFilePath in get_export_bundle_paths(directoryPath):
+        compression = get_export_bundle_compression(bundleFilePath)
+        indexRows = sorted(read_export_bundle_index(bundleFilePath).values(), key=lambda row: row['offset'])
+        with open(bundleFilePath, mode='rb') as bundleFile:
+            for row in indexRows:
+                if latestVersionOnly and not row['file_name'].endswith('(latest_version).json'):
+                    continue
+                bundleFile.seek(row['offset'])
+                record = json.loads(decompress_export_record(bundleFile.read(row['length']), compression))
+                yield row['file_name'], record['metadata']
+
+
+# Write text to a temporary file that's renamed when it's complete, so that interrupted writes don't leave partial files
+def write_file_atomically(filePath, text):
+    temporaryFilePath = filePath + '.part'
+    with open(temporaryFilePath, mode='w') as f:
+        f.write(text)
+    os.replace(temporaryFilePath, filePath)
+
+
+# Save a dataset version's export as a JSON file in directoryPath, or with the export writer if one is given,
+# an ExportBundleWriter or ShardedExportWriter. Returns the number of bytes saved, before compression
+def write_dataset_export_file(directoryPath, metadataFile, datasetPid, version, datasetVersion, exportWriter=None):
+    if exportWriter is not None:
+        return exportWriter.write(metadataFile, datasetPid, version, datasetVersion)
+
+    metadataJson = json.dumps(datasetVersion, indent=4)
+    write_file_atomically(os.path.join(directoryPath, metadataFile), metadataJson)
+    return len(metadataJson)
+
+
+# Path of the SQLite database that stores the version and update time of each dataset whose exports were saved,
+# along with the paths of the saved files, so that datasets that haven't changed since then aren't downloaded again
+exportFingerprintCachePath = str(Path.home() / '.dataverse_export_fingerprints.sqlite')
+
+
+@contextlib.contextmanager
+def open_export_fingerprint_cache(cachePath=None):
+    connection = sqlite3.connect(cachePath or exportFingerprintCachePath)
+    try:
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS export_fingerprints (
+                hostname TEXT NOT NULL,
+                dataset_pid TEXT NOT NULL,
+                export_format TEXT NOT NULL,
+                all_versions INTEGER NOT NULL,
+                version TEXT NOT NULL,
+                update_time TEXT NOT NULL,
+                file_paths TEXT NOT NULL,
+                recorded_at TEXT NOT NULL,
+                PRIMARY KEY (hostname, dataset_pid, export_format, all_versions))''')
+        yield connection
+        connection.commit()
+    finally:
+        connection.close()
+
+
+# Return the fingerprint of a dataset in Search API results: the version of the dataset
+# and the time it was last updated, or created if it was never updated
+def get_search_api_dataset_fingerprint(item):
+    return (get_search_api_dataset_version(item), item.get('updatedAt') or item.get('createdAt') or '')
+
+
+# Add the fingerprint of a dataset in Search API results to a dictionary of dataset PIDs and fingerprints.
+# When the Search API lists both a draft and a published version of a dataset, the draft is kept,
+# since the latest version export of the dataset is the draft
+def add_search_api_dataset_fingerprint(datasetFingerprints, item):
+    datasetPid = item['global_id']
+    existingFingerprint = datasetFingerprints.get(datasetPid)
+    if existingFingerprint is None or existingFingerprint[0] != 'DRAFT':
+        datasetFingerprints[datasetPid] = get_search_api_dataset_fingerprint(item)
+
+
+# Copy the files saved for an unchanged dataset in an earlier run into directoryPath, using hard links
+# when possible so that no data is copied, or with the export writer if one is given. Files saved in a bundle
+# have paths made of the bundle's path and the file name. bundleIndexes is a dictionary used to keep the indexes
+# of bundles that were already read. Returns a list of the names and sizes of the files, or None if
+# any of the files no longer exist, in which case the dataset's exports are downloaded again
+def link_unchanged_dataset_export_files(datasetPid, filePaths, directoryPath, exportWriter=None, bundleIndexes=None):
+    if bundleIndexes is None:
+        bundleIndexes = {}
+
+    sources = []
+    for filePath in filePaths:
+        sourceBundlePath, fileName = os.path.split(filePath)
+        if get_export_bundle_compression(sourceBundlePath) is not None:
+            if sourceBundlePath not in bundleIndexes:
+                if not os.path.isfile(get_export_bundle_index_path(sourceBundlePath)):
+                    return None
+                bundleIndexes[sourceBundlePath] = read_export_bundle_index(sourceBundlePath)
+            indexRow = bundleIndexes[sourceBundlePath].get(fileName)
+            if indexRow is None:
+                return None
+            sources.append((fileName, filePath, sourceBundlePath, indexRow))
+        elif os.path.isfile(filePath):
+            sources.append((fileName, filePath, None, None))
+        else:
+            return None
+
+    linkedFiles = []
+    for fileName, filePath, sourceBundlePath, indexRow in sources:
+        version = get_version_from_export_file_name(fileName)
+        if isinstance(exportWriter, ExportBundleWriter) and sourceBundlePath is not None:
+            byteCount = exportWriter.copy_from(sourceBundlePath, indexRow)
+        elif isinstance(exportWriter, ShardedExportWriter) and sourceBundlePath is None:
+            byteCount = exportWriter.link_file(filePath, fileName, datasetPid, version)
+        elif exportWriter is not None and sourceBundlePath is not None:
+            byteCount = exportWriter.write(
+                fileName, datasetPid, version, read_export_bundle_record(sourceBundlePath, indexRow)['metadata'])
+        elif exportWriter is not None:
+            with open(filePath, 'r') as f:
+                byteCount = exportWriter.write(fileName, datasetPid, version, json.load(f))
+        else:
+            newFilePath = os.path.join(directoryPath, fileName)
+            if not os.path.exists(newFilePath):
+                if sourceBundlePath is not None:
+                    write_dataset_export_file(
+                        directoryPath, fileName, datasetPid, version,
+                        read_export_bundle_record(sourceBundlePath, indexRow)['metadata'])
+                else:
+                    try:
+                        os.link(filePath, newFilePath)
+                    except OSError:
+                        shutil.copy2(filePath, newFilePath)
+            byteCount = os.path.getsize(newFilePath)
+        linkedFiles.append((fileName, byteCount))
+    return linkedFiles
+
+
+# Export file names are the PID with colons and slashes replaced by underscores, followed by the version,
+# e.g. doi_10.70122_FK2_ABCDEF_v1.0(latest_version).json, or for formats other than Dataverse JSON, by the format.
+# Return the two parts
+def split_export_file_name(fileName):
+    return os.path.splitext(fileName.replace('(latest_version)', ''))[0].rsplit('_', 1)
+
+
+def get_version_from_export_file_name(fileName):
+    return split_export_file_name(fileName)[-1]
+
+
+# Save the exports of datasets whose fingerprints match the ones stored in the fingerprint cache by linking
+# the files saved in the earlier run, and record them in the journal as saved without making any requests.
+# Returns the list of PIDs of datasets that are new or have changed, which need to be downloaded
+def save_unchanged_dataset_exports(
+    directoryPath, installationUrl, datasetPidList, exportFormat, allVersions, datasetFingerprints,
+    journal, fingerprintCachePath=None, exportWriter=None):
+
+    hostname = get_hostname(installationUrl)
+
+    with open_export_fingerprint_cache(fingerprintCachePath) as connection:
+        cachedExports = {
+            datasetPid: ((version, updateTime), json.loads(filePaths))
+            for datasetPid, version, updateTime, filePaths in connection.execute('''
+                SELECT dataset_pid, version, update_time, file_paths FROM export_fingerprints
+                WHERE hostname = ? AND export_format = ? AND all_versions = ?''',
+                (hostname, exportFormat, int(allVersions)))}
+
+    changedPidList = []
+    bundleIndexes = {}
+    for datasetPid in datasetPidList:
+        fingerprint = datasetFingerprints.get(datasetPid)
+        cachedExport = cachedExports.get(datasetPid.lower())
+        linkedFiles = None
+        if fingerprint is not None and cachedExport is not None and tuple(fingerprint) == cachedExport[0]:
+            linkedFiles = link_unchanged_dataset_export_files(
+                datasetPid, cachedExport[1], directoryPath, exportWriter, bundleIndexes)
+
+        if linkedFiles is None:
+            changedPidList.append(datasetPid)
+            continue
+
+        for fileName, byteCount in linkedFiles:
+            journal.record_version(
+                datasetPid, get_version_from_export_file_name(fileName), exportFormat, fileName, byteCount)
+        journal.record_dataset(datasetPid, datasetPid, exportFormat, True, {'requestCount': 0})
+
+    return changedPidList
+
+
+# Store the fingerprints of the datasets whose exports were saved in the given run of an ExportStatusJournal,
+# with the paths of the files that were saved, so that the next run can skip them if they haven't changed.
+# For exports saved in a bundle, directoryPath is the path of the bundle
+def update_export_fingerprint_cache(
+    journalFilePath, runId, directoryPath, installationUrl, exportFormat, allVersions,
+    datasetFingerprints, fingerprintCachePath=None, sharded=False):
+
+    with contextlib.closing(sqlite3.connect(journalFilePath)) as journalConnection:
+        savedDatasets = journalConnection.execute('''
+            SELECT requested_pid, dataset_pid FROM dataset_exports
+            WHERE run_id = ? AND export_format = ? AND saved = 1''', (runId, exportFormat)).fetchall()
+        fileNames = {}
+        for datasetPid, fileName in journalConnection.execute('''
+                SELECT dataset_pid, file_name FROM version_exports
+                WHERE run_id = ? AND export_format = ? ORDER BY rowid''', (runId, exportFormat)):
+            fileNames.setdefault(datasetPid, []).append(fileName)
+
+    hostname = get_hostname(installationUrl)
+    recordedAt = datetime.now(timezone.utc).isoformat()
+    rows = []
+    for requestedPid, datasetPid in savedDatasets:
+        fingerprint = datasetFingerprints.get(requestedPid)
+        if fingerprint is None or datasetPid not in fileNames:
+            continue
+        if sharded is True:
+            filePaths = [
+                os.path.abspath(get_sharded_export_file_path(directoryPath, fileName)) for fileName in fileNames[datasetPid]]
+        else:
+            filePaths = [os.path.abspath(os.path.join(directoryPath, fileName)) for fileName in fileNames[datasetPid]]
+        rows.append((
+            hostname, requestedPid.lower(), exportFormat, int(allVersions),
+            fingerprint[0], fingerprint[1], json.dumps(filePaths), recordedAt))
+
+    with open_export_fingerprint_cache(fingerprintCachePath) as connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO export_fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+
+# With singleRequest=True and allVersions=True, the latest version's metadata is built from the
+# "Get all versions" response instead of being requested separately, for installations where that's possible.
+# If an ExportStatusJournal is given, statuses are recorded in it instead of in the download status CSV file.
+# If an ExportBundleWriter or ShardedExportWriter is given, exports are saved with it instead of as JSON files in directoryPath.
+# Exports in other formats than Dataverse JSON, like XML exports, are streamed into files in directoryPath without being parsed.
+# If a ProcessPoolExecutor is given as canonicalizeExecutor, each XML file is then canonicalized in it,
+# and the future is added to the canonicalizeFutures list
 def save_dataset_export(
     directoryPath, downloadStatusFilePath, installationUrl, datasetPid, 
-    exportFormat, timeout, verify, allVersions=False, header={}, apiKey=''):
+    exportFormat, timeout, verify, allVersions=False, header={}, apiKey='', singleRequest=False,
+    journal=None, exportWriter=None, canonicalizeExecutor=None, canonicalizeFutures=None):
 
     requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
-    with open(downloadStatusFilePath, mode='a', newline='', encoding='utf-8') as downloadStatusFile:
-        writer = csv.writer(
-            downloadStatusFile, delimiter=',', quotechar='"', 
-            quoting=csv.QUOTE_MINIMAL)
+    responseInfo = {}
 
-        latestVersionMetadata = get_dataset_metadata_export(installationUrl, 
-            datasetPid, exportFormat, timeout, verify=verify, allVersions=False, 
-            header={}, apiKey=apiKey)
+    if exportFormat != 'dataverse_json':
+        datasetPidForFileName = get_canonical_pid(datasetPid).replace(':', '_').replace('/', '_')
+        metadataFile = f'{datasetPidForFileName}_{exportFormat}{get_export_file_extension(exportFormat)}'
+        filePath = os.path.join(directoryPath, metadataFile)
+
+        with open_download_status_writer(downloadStatusFilePath, journal) as statusWriter:
+            saved = stream_dataset_export(
+                installationUrl, datasetPid, exportFormat, filePath, timeout, verify=verify,
+                header=header, apiKey=apiKey, responseInfo=responseInfo)
+            if saved is True:
+                statusWriter.record_version(
+                    datasetPid, exportFormat, exportFormat, metadataFile, responseInfo.get('byteCount'))
+            statusWriter.record_dataset(datasetPid, datasetPid, exportFormat, saved, responseInfo)
+
+        if saved is True and canonicalizeExecutor is not None and exportFormat in xmlExportFormats:
+            future = canonicalizeExecutor.submit(canonicalize_xml_export_file, filePath)
+            if canonicalizeFutures is not None:
+                canonicalizeFutures.append(future)
+        return
+
+    with open_download_status_writer(downloadStatusFilePath, journal) as statusWriter:
+
+        allVersionsMetadata = None
+        latestVersionMetadata = None
+
+        if (allVersions == True and singleRequest == True
+                and get_hostname(installationUrl) not in installationsWithoutSingleRequestExports):
+            allVersionsMetadata = get_dataset_metadata_export(installationUrl, 
+                datasetPid, exportFormat, timeout, verify=verify, allVersions=True, header={}, 
+                apiKey=apiKey, responseInfo=responseInfo)
+
+            if allVersionsMetadata == 'ERROR':
+                latestVersionMetadata = 'ERROR'
+            else:
+                latestVersionMetadata = get_latest_version_export_from_versions(
+                    installationUrl, datasetPid, allVersionsMetadata, apiKey=apiKey, verify=verify)
+
+        if latestVersionMetadata is None:
+            latestVersionMetadata = get_dataset_metadata_export(installationUrl, 
+                datasetPid, exportFormat, timeout, verify=verify, allVersions=False, 
+                header={}, apiKey=apiKey, responseInfo=responseInfo)
         
         if latestVersionMetadata == 'ERROR':
-            # Add to CSV file that the dataset's metadata was not downloaded
-            writer.writerow([datasetPid, False])  
+            # Record that the dataset's metadata was not downloaded
+            statusWriter.record_dataset(datasetPid, datasetPid, exportFormat, False, responseInfo)
 
         elif latestVersionMetadata != 'ERROR':
             persistentUrl = latestVersionMetadata['data']['persistentUrl']
@@ -1155,24 +3522,28 @@ def save_dataset_export(
                 datasetPidForFileName = datasetPidInJson.replace(':', '_').replace('/', '_')
 
                 metadataFile = f'{datasetPidForFileName}_{latestVersionNumber}(latest_version).json'
-                with open(os.path.join(directoryPath, metadataFile), mode='w') as f:
-                    f.write(json.dumps(datasetVersion, indent=4))
+                byteCount = write_dataset_export_file(
+                    directoryPath, metadataFile, datasetPidInJson, latestVersionNumber, datasetVersion, exportWriter)
+                statusWriter.record_version(
+                    datasetPidInJson, latestVersionNumber, exportFormat, metadataFile, byteCount)
 
-                # Add to CSV file that the dataset's metadata was not downloaded
-                writer.writerow([datasetPidInJson, True])
+                # Record that the dataset's metadata was downloaded
+                statusWriter.record_dataset(datasetPid, datasetPidInJson, exportFormat, True, responseInfo)
 
             elif allVersions == True:
 
-                allVersionsMetadata = get_dataset_metadata_export(installationUrl, 
-                    datasetPid, exportFormat, timeout, verify=verify, allVersions=True, header={}, 
-                    apiKey=apiKey)
+                if allVersionsMetadata is None:
+                    allVersionsMetadata = get_dataset_metadata_export(installationUrl, 
+                        datasetPid, exportFormat, timeout, verify=verify, allVersions=True, header={}, 
+                        apiKey=apiKey, responseInfo=responseInfo)
 
                 if allVersionsMetadata == 'ERROR':
-                    # Add to CSV file that the dataset's metadata was not downloaded
-                    writer.writerow([datasetPid, False])
+                    # Record that the dataset's metadata was not downloaded
+                    statusWriter.record_dataset(datasetPid, datasetPid, exportFormat, False, responseInfo)
 
                 elif allVersionsMetadata != 'ERROR':
 
+                    versionFiles = []
                     for datasetVersion in allVersionsMetadata['data']:
                         datasetVersion = {
                             'status': latestVersionMetadata['status'],
@@ -1198,47 +3569,150 @@ def save_dataset_export(
                             metadataFile = f'{datasetPidForFileName}_{versionNumber}(latest_version).json'
                         else:
                             metadataFile = f'{datasetPidForFileName}_{versionNumber}.json'
-
-                        with open(os.path.join(directoryPath, metadataFile), mode='w') as f:
-                            f.write(json.dumps(datasetVersion, indent=4))
-
-                    # Add to CSV file that the dataset's metadata was not downloaded
-                    writer.writerow([datasetPidInJson, True])  
+                        versionFiles.append((metadataFile, versionNumber, datasetVersion))
+
+                    # Save the latest version's file last, so that when there's no journal, a resumed download
+                    # doesn't skip a dataset whose older versions weren't all saved
+                    versionFiles.sort(key=lambda versionFile: versionFile[0].endswith('(latest_version).json'))
+                    for metadataFile, versionNumber, datasetVersion in versionFiles:
+                        byteCount = write_dataset_export_file(
+                            directoryPath, metadataFile, datasetPidInJson, versionNumber, datasetVersion, exportWriter)
+                        statusWriter.record_version(
+                            datasetPidInJson, versionNumber, exportFormat, metadataFile, byteCount)
+
+                    # Record that the dataset's metadata was downloaded
+                    statusWriter.record_dataset(datasetPid, datasetPidInJson, exportFormat, True, responseInfo)
         
 
+# Statuses are recorded in an ExportStatusJournal, by default saved next to the download status CSV file,
+# and the CSV file is written from the journal when all exports are done.
+# With resume=True, datasets whose exports were saved in an earlier run into the same directory and journal
+# are skipped, and the CSV file lists the last status of every dataset in all runs.
+# datasetFingerprints is an optional dictionary of dataset PIDs and fingerprints made by get_search_api_dataset_fingerprint.
+# When it's given, datasets whose fingerprints haven't changed since their exports were last saved aren't downloaded again.
+# Their files from the earlier run are linked into directoryPath instead.
+# With storage='bundle', exports are saved in one compressed NDJSON bundle in directoryPath instead of
+# in a JSON file for each version. compression is 'gzip', or 'zstd', which needs the zstandard package.
+# With storage='sharded', each version's JSON file is saved in subdirectories named after a hash of the dataset's PID,
+# and the files are listed in a manifest in directoryPath.
+# XML exports are always saved as files in directoryPath, streamed to disk without being parsed. With canonicalize=True,
+# each XML file is rewritten in canonical form in a pool of canonicalizeWorkers processes while downloads continue.
+# On systems that start processes by spawning them, like Windows and macOS, scripts that use canonicalize=True
+# need to call this function under if __name__ == '__main__'.
+# exportFormat can be a list of formats, which are all downloaded in one pass: the downloads of each dataset's formats
+# are started together, each format is saved in a subdirectory of directoryPath named after the format, bundles and
+# sharding are used only for Dataverse JSON, and the CSV file has a row for each dataset and format
 def save_dataset_exports(directoryPath, downloadStatusFilePath, installationUrl, datasetPidList, 
-    exportFormat, n_jobs, timeout, verify, allVersions=False, header={}, apiKey=''):
+    exportFormat, n_jobs=None, timeout=None, verify=None, allVersions=False, header={}, apiKey='',
+    singleRequest=False, journalFilePath=None, resume=False, datasetFingerprints=None, fingerprintCachePath=None,
+    storage='files', compression='gzip', canonicalize=False, canonicalizeWorkers=None):
     
     currentTime = time.strftime('%Y.%m.%d_%H.%M.%S')
-    
-    # Create CSV file and add headerrow
-    headerRow = ['dataset_pid', 'dataverse_json_export_saved']
-    with open(downloadStatusFilePath, mode='w', newline='') as downloadStatusFile:
-        writer = csv.writer(downloadStatusFile)
-        writer.writerow(headerRow)
-
-    datasetCount = len(datasetPidList)
-
-    # Use joblib library to use 4 CPU cores to make SearchAPI calls to get info about datasets
-    # and report progress using tqdm progress bars
-    with tqdm_joblib(tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=datasetCount)) as progress_bar:
-        Parallel(n_jobs=n_jobs, backend='threading')(delayed(save_dataset_export)(
-            directoryPath=directoryPath,
-            downloadStatusFilePath=downloadStatusFilePath,
-            installationUrl=installationUrl,
-            datasetPid=datasetPid, 
-            exportFormat=exportFormat,
-            timeout=timeout,
-            verify=verify,
-            allVersions=allVersions, 
-            header={}, 
-            apiKey=apiKey) for datasetPid in datasetPidList)
+
+    if journalFilePath is None:
+        journalFilePath = os.path.splitext(downloadStatusFilePath)[0] + '.sqlite'
+
+    multipleFormats = isinstance(exportFormat, (list, tuple))
+    exportFormats = list(exportFormat) if multipleFormats else [exportFormat]
+
+    # Unless n_jobs is given, start as many threads as the installation's concurrency controller
+    # could let make calls at once, and let the controller decide how many calls are in flight
+    if n_jobs is None:
+        n_jobs = get_max_concurrency(installationUrl)
+
+    with contextlib.ExitStack() as stack:
+        journal = stack.enter_context(ExportStatusJournal(journalFilePath, runId=currentTime))
+
+        canonicalizeExecutor = None
+        if canonicalize is True and any(fmt in xmlExportFormats for fmt in exportFormats):
+            canonicalizeExecutor = stack.enter_context(ProcessPoolExecutor(max_workers=canonicalizeWorkers))
+        canonicalizeFutures = []
+
+        # For each format, get the directory, export writer and PIDs of the datasets whose exports need to be downloaded
+        formatOutputs = {}
+        for fmt in exportFormats:
+            if multipleFormats:
+                formatDirectoryPath = os.path.join(directoryPath, fmt)
+                os.makedirs(formatDirectoryPath, exist_ok=True)
+            else:
+                formatDirectoryPath = directoryPath
+
+            formatStorage = storage if fmt == 'dataverse_json' else 'files'
+            bundleFilePath = None
+            exportWriter = None
+            if formatStorage == 'bundle':
+                bundleFilePath = get_export_bundle_path(formatDirectoryPath, compression)
+                exportWriter = stack.enter_context(ExportBundleWriter(bundleFilePath, compression))
+            elif formatStorage == 'sharded':
+                exportWriter = stack.enter_context(ShardedExportWriter(formatDirectoryPath))
+
+            formatPidList = datasetPidList
+            if resume is True:
+                completedPids = get_completed_dataset_exports(journalFilePath, formatDirectoryPath, fmt)
+                remainingPidList = [
+                    datasetPid for datasetPid in formatPidList
+                    if not is_dataset_export_completed(datasetPid, completedPids)]
+                print(f'Resuming: skipping {len(formatPidList) - len(remainingPidList)} dataset(s) whose {fmt} exports were already saved')
+                formatPidList = remainingPidList
+
+            if datasetFingerprints is not None:
+                changedPidList = save_unchanged_dataset_exports(
+                    formatDirectoryPath, installationUrl, formatPidList, fmt, allVersions,
+                    datasetFingerprints, journal, fingerprintCachePath, exportWriter)
+                print(f'Skipping {len(formatPidList) - len(changedPidList)} dataset(s) whose {fmt} exports haven\'t changed since they were last saved')
+                formatPidList = changedPidList
+
+            formatOutputs[fmt] = {
+                'directoryPath': formatDirectoryPath,
+                'storage': formatStorage,
+                'bundleFilePath': bundleFilePath,
+                'exportWriter': exportWriter,
+                'datasetPids': set(formatPidList)}
+
+        # List the downloads dataset by dataset, so that the formats of each dataset are downloaded at about the same time
+        downloads = [
+            (datasetPid, fmt) for datasetPid in datasetPidList for fmt in exportFormats
+            if datasetPid in formatOutputs[fmt]['datasetPids']]
+        downloadCount = len(downloads)
+
+        # Use joblib library to make API calls in threads and report progress using tqdm progress bars
+        with tqdm_joblib(tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=downloadCount)) as progress_bar:
+            Parallel(n_jobs=n_jobs, backend='threading')(delayed(save_dataset_export)(
+                directoryPath=formatOutputs[fmt]['directoryPath'],
+                downloadStatusFilePath=downloadStatusFilePath,
+                installationUrl=installationUrl,
+                datasetPid=datasetPid, 
+                exportFormat=fmt,
+                timeout=timeout,
+                verify=verify,
+                allVersions=allVersions, 
+                header={}, 
+                apiKey=apiKey,
+                singleRequest=singleRequest,
+                journal=journal,
+                exportWriter=formatOutputs[fmt]['exportWriter'],
+                canonicalizeExecutor=canonicalizeExecutor,
+                canonicalizeFutures=canonicalizeFutures) for datasetPid, fmt in downloads)
+
+    canonicalizeErrorCount = sum(1 for future in canonicalizeFutures if future.exception() is not None)
+    if canonicalizeErrorCount > 0:
+        print(f'{canonicalizeErrorCount} XML export(s) couldn\'t be canonicalized and were saved as downloaded')
+
+    journal.write_download_status_file(
+        downloadStatusFilePath, allRuns=resume, exportFormat=exportFormats[0], byFormat=multipleFormats)
+
+    if datasetFingerprints is not None:
+        for fmt, formatOutput in formatOutputs.items():
+            update_export_fingerprint_cache(
+                journalFilePath, journal.runId, formatOutput['bundleFilePath'] or formatOutput['directoryPath'],
+                installationUrl, fmt, allVersions, datasetFingerprints, fingerprintCachePath,
+                sharded=formatOutput['storage'] == 'sharded')
     
 
 def get_metadatablock_data(installationUrl, metadatablockName):
     metadatablocksApiEndpoint = f'{installationUrl}/api/v1/metadatablocks/{metadatablockName}'
 
-    response = requests.get(metadatablocksApiEndpoint)
+    response = api_get(metadatablocksApiEndpoint)
     if response.status_code == 200:
         data = response.json()
         return data
@@ -1350,6 +3824,64 @@ def get_column_names(metadatablockData, parentFieldTitle, parentFieldDBNameAndTi
         return columns
 
 
+# Get the dataset-level values that start each row of a metadata CSV file
+def get_dataset_row_prefix(installationUrl, datasetMetadata, versions='latestVersion'):
+    datasetPersistentUrl = datasetMetadata['data']['persistentUrl']
+    datasetPid = get_canonical_pid(datasetPersistentUrl)
+    datasetUrl = installationUrl + '/dataset.xhtml?persistentId=' + datasetPid
+
+    versionCreateTime = datasetMetadata['data'][versions]['createTime']
+    publicationDate = datasetMetadata['data'].get('publicationDate', '')
+
+    if 'versionNumber' in datasetMetadata['data'][versions]:
+        majorVersionNumber = datasetMetadata['data'][versions]['versionNumber']
+        minorVersionNumber = datasetMetadata['data'][versions]['versionMinorNumber']
+        datasetVersionNumber = f'{majorVersionNumber}.{minorVersionNumber}'
+    else:
+        datasetVersionNumber = 'DRAFT'
+
+    return [
+        datasetPid, datasetPersistentUrl, datasetUrl,
+        publicationDate, datasetVersionNumber, versionCreateTime]
+
+
+# Values saved in CSV files are cut to 10,000 characters (some metadata fields have 30,000+ characters,
+# which messes with opening the files in spreadsheet apps) and carriage returns are replaced.
+# When maxValueLength is None, values are kept as they are, e.g. for Parquet files
+def clean_metadata_value(value, maxValueLength=10000):
+    if maxValueLength is None:
+        return value
+    return value[:maxValueLength].replace('\r', ' - ')
+
+
+# Get the rows of values of one field in a dataset's metadata, each row starting with rowPrefix.
+# chosenFields are the child fields to get from compound fields.
+def get_field_value_rows(fields, rowPrefix, chosenFields=None, maxValueLength=10000):
+    typeClass = fields['typeClass']
+    allowsMultiple = fields['multiple']
+    rowVariablesList = []
+
+    if typeClass in ('primitive', 'controlledVocabulary'):
+        values = fields['value'] if allowsMultiple is True else [fields['value']]
+        for value in values:
+            rowVariablesList.append(rowPrefix + [clean_metadata_value(value, maxValueLength)])
+
+    elif typeClass == 'compound':
+        values = fields['value'] if allowsMultiple is True else [fields['value']]
+        for compoundValue in values:
+            rowVariables = list(rowPrefix)
+            for chosenField in chosenFields:
+                # Save an empty string as the value if the child field has no value
+                childField = compoundValue.get(chosenField)
+                if childField is None:
+                    rowVariables.append('')
+                else:
+                    rowVariables.append(clean_metadata_value(childField['value'], maxValueLength))
+            rowVariablesList.append(rowVariables)
+
+    return rowVariablesList
+
+
 def get_metadata_values_lists(
     installationUrl, datasetMetadata, metadatablockName,
     chosenTitleDBName, chosenFields=None, versions='latestVersion'):
@@ -1359,101 +3891,156 @@ def get_metadata_values_lists(
     rowVariablesList = []
 
     if datasetMetadata['status'] == 'OK':
+        metadatablocks = datasetMetadata['data'][versions]['metadataBlocks']
 
-        for metadatablock in datasetMetadata['data']['datasetVersion']['metadataBlocks']:
-            if metadatablockName in metadatablock:
-
-                # (metadatablockName in datasetMetadata['data'][versions]['metadataBlocks']):
+        if metadatablockName in metadatablocks:
+            rowPrefix = get_dataset_row_prefix(installationUrl, datasetMetadata, versions)
 
-                datasetPersistentUrl = datasetMetadata['data']['persistentUrl']
-                datasetPid = get_canonical_pid(datasetPersistentUrl)
-                datasetUrl = installationUrl + '/dataset.xhtml?persistentId=' + datasetPid
+            for fields in metadatablocks[metadatablockName]['fields']:
+                if fields['typeName'] == chosenTitleDBName:
+                    rowVariablesList.extend(get_field_value_rows(fields, rowPrefix, chosenFields))
 
-                versionCreateTime = datasetMetadata['data'][versions]['createTime']
-
-                if 'publicationDate' not in datasetMetadata['data']:
-                    publicationDate = ''
-                elif 'publicationDate' in datasetMetadata['data']:
-                    publicationDate = datasetMetadata['data']['publicationDate']
+    return rowVariablesList
 
-                if 'versionNumber' in datasetMetadata['data'][versions]:
-                    majorVersionNumber = datasetMetadata['data'][versions]['versionNumber']
-                    minorVersionNumber = datasetMetadata['data'][versions]['versionMinorNumber']
-                    datasetVersionNumber = f'{majorVersionNumber}.{minorVersionNumber}'
-                else:
-                    datasetVersionNumber = 'DRAFT'
-
-                for fields in datasetMetadata['data'][versions]['metadataBlocks'][metadatablockName]['fields']:
-                    if fields['typeName'] == chosenTitleDBName:
-
-                        # Save the field's typeClass and if it allows multiple values 
-                        typeClass = fields['typeClass']
-                        allowsMultiple = fields['multiple']
-
-                        if typeClass in ('primitive', 'controlledVocabulary') and allowsMultiple is True:
-                            for value in fields['value']:
-                                rowVariables = [
-                                    datasetPid, datasetPersistentUrl, datasetUrl,
-                                    publicationDate, datasetVersionNumber, 
-                                    versionCreateTime,
-                                    value[:10000].replace('\r', ' - ')]
-                                rowVariablesList.append(rowVariables)
-
-                        elif typeClass in ('primitive', 'controlledVocabulary') and allowsMultiple is False:
-                            value = fields['value'][:10000].replace('\r', ' - ')
-                            rowVariables = [
-                                datasetPid, datasetPersistentUrl, datasetUrl, 
-                                publicationDate, datasetVersionNumber, 
-                                versionCreateTime, value]
-
-                            rowVariablesList.append(rowVariables)
-
-                        elif typeClass == 'compound' and allowsMultiple is True:          
-                            
-                            index = 0
-                            condition = True
-
-                            while condition:
-                                rowVariables = [
-                                    datasetPid, datasetPersistentUrl, datasetUrl, 
-                                    publicationDate, datasetVersionNumber,
-                                    versionCreateTime]
-
-                                # Get number of multiples
-                                total = len(fields['value'])
-
-                                # For each child field...
-                                for chosenField in chosenFields:
-                                    # Try getting the value of that child field
-                                    try:
-                                        value = fields['value'][index][chosenField]['value'][:10000].replace('\r', ' - ')
-                                    # Otherwise, save an empty string as the value
-                                    except KeyError:
-                                        value = ''
-                                    # Append value to the rowVariables list to add to the CSV file
-                                    rowVariables.append(value)
-
-                                rowVariablesList.append(rowVariables)
-
-                                index += 1
-                                condition = index < total
-
-                        elif typeClass == 'compound' and allowsMultiple is False:
-                            rowVariables = [
-                                datasetPid, datasetPersistentUrl, datasetUrl, 
-                                publicationDate, datasetVersionNumber,
-                                versionCreateTime]
-
-                            for chosenField in chosenFields:
-                                try:
-                                    # Get value from compound field
-                                    value = fields['value'][chosenField]['value'][:10000].replace('\r', ' - ')
-                                except KeyError:
-                                    value = ''
-                                rowVariables.append(value)
-                            rowVariablesList.append(rowVariables)
 
-    return rowVariablesList
+# Extracts the values of several fields of a metadatablock from Dataverse JSON exports.
+# The field names and columns are worked out from the metadatablock's schema once,
+# so that each dataset's fields are read in a single pass no matter how many fields were chosen.
+# maxValueLength is passed to clean_metadata_value
+class MetadataFieldExtractor:
+    def __init__(self, metadatablockData, parentFieldTitleList, metadatablockName='citation', maxValueLength=10000):
+        self.metadatablockName = metadatablockName
+        self.maxValueLength = maxValueLength
+        schemaFields = metadatablockData['data']['fields']
+        parentFieldDBNameAndTitleDict = get_metadatablock_db_field_name_and_title(metadatablockData)
+
+        # Title, database name and CSV columns of each chosen field, in the order they were chosen
+        self.fields = []
+        for parentFieldTitle in parentFieldTitleList:
+            dbName = parentFieldDBNameAndTitleDict[parentFieldTitle]
+            childFields = schemaFields[dbName].get('childFields')
+            columns = list(childFields) if childFields else [dbName]
+            self.fields.append((parentFieldTitle, dbName, columns))
+
+        # Index of each chosen field's database name, used to look up fields while reading a dataset
+        self.fieldIndexes = {dbName: index for index, (_, dbName, _) in enumerate(self.fields)}
+
+    def get_columns(self, parentFieldTitle):
+        for title, _, columns in self.fields:
+            if title == parentFieldTitle:
+                return columns
+
+    # Return a list of rows for each chosen field, in the order the fields were chosen
+    def extract(self, installationUrl, datasetMetadata, versions='latestVersion'):
+        if versions == 'allVersions':
+            versions = 'datasetVersion'
+        rowsLists = [[] for _ in self.fields]
+
+        if datasetMetadata['status'] != 'OK':
+            return rowsLists
+
+        metadatablock = datasetMetadata['data'][versions]['metadataBlocks'].get(self.metadatablockName)
+        if metadatablock is None:
+            return rowsLists
+
+        rowPrefix = get_dataset_row_prefix(installationUrl, datasetMetadata, versions)
+        for fields in metadatablock['fields']:
+            index = self.fieldIndexes.get(fields['typeName'])
+            if index is not None:
+                columns = self.fields[index][2]
+                rowsLists[index].extend(get_field_value_rows(fields, rowPrefix, columns, self.maxValueLength))
+
+        return rowsLists
+
+
+metadataTableExtensions = {'csv': '.csv', 'parquet': '.parquet'}
+
+# Types of the columns of metadata tables saved as Parquet files. Other columns are saved as strings.
+# Parquet files are written with dictionary encoding, which keeps columns like dataset_pid_url,
+# whose values repeat in every row of a dataset, small on disk
+metadataTableColumnTypes = {
+    'publication_date': 'date',
+    'dataset_publication_date': 'date',
+    'dataset_version_create_time': 'timestamp'}
+
+
+def get_metadata_table_file_path(directoryPath, tableName, outputFormat='csv'):
+    return str(Path(directoryPath, tableName)) + metadataTableExtensions[outputFormat]
+
+
+# Convert a date or timestamp from Dataverse JSON, e.g. 2020-01-01 or 2020-01-01T12:00:00Z,
+# for a typed Parquet column. Empty values, and values that can't be read as dates, are saved as nulls
+def convert_metadata_table_value(value, columnType):
+    if value in ('', None):
+        return None
+    try:
+        if columnType == 'date':
+            return datetime.strptime(value[:10], '%Y-%m-%d').date()
+        if columnType == 'timestamp':
+            return parse(value).astimezone(timezone.utc)
+    except (ValueError, OverflowError):
+        return None
+    return value
+
+
+# Writes the rows of a metadata table to a CSV file or, when outputFormat is 'parquet', to a Parquet file,
+# rowsPerGroup rows at a time. Parquet files require the pyarrow package
+class MetadataTableWriter:
+    def __init__(self, filePath, columns, outputFormat='csv', rowsPerGroup=100000):
+        self.filePath = filePath
+        self.columns = columns
+        self.outputFormat = outputFormat
+        self.rowsPerGroup = rowsPerGroup
+        self.rowCount = 0
+
+        if outputFormat == 'parquet':
+            self.pa, pq = import_pyarrow()
+            self.columnTypes = [metadataTableColumnTypes.get(column) for column in columns]
+            arrowTypes = {'date': self.pa.date32(), 'timestamp': self.pa.timestamp('s', tz='UTC')}
+            self.schema = self.pa.schema([
+                self.pa.field(column, arrowTypes.get(columnType, self.pa.string()))
+                for column, columnType in zip(columns, self.columnTypes)])
+            self.parquetWriter = pq.ParquetWriter(filePath, self.schema, use_dictionary=True)
+            self.groupRows = []
+        else:
+            self.csvFile = open(filePath, mode='w', newline='', encoding='utf-8')
+            self.csvWriter = csv.writer(self.csvFile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            self.csvWriter.writerow(columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writerow(self, row):
+        self.rowCount += 1
+        if self.outputFormat == 'parquet':
+            self.groupRows.append(row)
+            if len(self.groupRows) >= self.rowsPerGroup:
+                self.write_group()
+        else:
+            self.csvWriter.writerow(row)
+
+    def write_group(self):
+        if not self.groupRows:
+            return
+        arrays = []
+        for columnValues, columnType, field in zip(zip(*self.groupRows), self.columnTypes, self.schema):
+            if columnType is not None:
+                columnValues = [convert_metadata_table_value(value, columnType) for value in columnValues]
+            arrays.append(self.pa.array(columnValues, type=field.type))
+        self.parquetWriter.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self.groupRows = []
+
+    def close(self):
+        if self.outputFormat == 'parquet':
+            if self.parquetWriter is not None:
+                self.write_group()
+                self.parquetWriter.close()
+                self.parquetWriter = None
+        else:
+            self.csvFile.close()
 
 
 # Delete empty CSV files in a given directory.
@@ -1473,57 +4060,374 @@ def delete_empty_csv_files(csvDirectory):
     return fieldsWithNoMetadata
 
 
-# Full outer join of CSV files in a given directory
-def join_metadata_csv_files(csvDirectory):
+# Columns that the metadata tables made by get_dataset_metadata have in common, which they're joined on
+metadataTableIndexColumns = [
+    'dataset_pid', 'dataset_pid_url', 'dataset_url', 'publication_date', 
+    'dataset_version_number', 'dataset_version_create_time', 
+    'dataverse_collection_alias']
+
+
+# Delete empty Parquet files in a given directory
+def delete_empty_parquet_files(parquetDirectory):
+    pa, pq = import_pyarrow()
+    fieldsWithNoMetadata = []
+    for file in glob.glob(str(Path(parquetDirectory)) + '/' + '*.parquet'):
+        if pq.read_metadata(file).num_rows == 0:
+            fieldName = Path(file).name.replace('.parquet', '')
+            fieldsWithNoMetadata.append(fieldName)
+            os.remove(file)
+    return fieldsWithNoMetadata
+
+
+# Number of rows of each CSV file that join_csv_files_on_columns sorts in memory at a time.
+# Larger files are sorted in runs that are saved to temporary files and then merged
+csvJoinSortChunkRows = 100000
+
+
+def iterate_csv_run_file(runFilePath, keyLength):
+    with open(runFilePath, mode='r', newline='', encoding='utf-8') as f:
+        for row in csv.reader(f):
+            yield tuple(row[:keyLength]), row[keyLength:]
+
+
+# Sort rows of strings, whose column names are in header, by the values of their keyColumns, chunkRows rows at a time.
+# Returns the names of the other columns and an iterator of (key, values) tuples in order of their keys.
+# Tables with more than chunkRows rows are sorted in runs saved in tempDirectory, which are merged as they're read.
+# A table that fits in one chunk is kept in memory, unless spill is True, e.g. when the rows of many tables
+# are read at the same time, in which case it's saved as a run too
+def sort_table_rows(header, rows, keyColumns, tempDirectory, chunkRows=None, spill=False):
+    chunkRows = chunkRows or csvJoinSortChunkRows
+    runFilePaths = []
+
+    keyIndexes = [header.index(column) for column in keyColumns]
+    valueIndexes = [index for index in range(len(header)) if index not in keyIndexes]
+    valueColumns = [header[index] for index in valueIndexes]
+
+    while True:
+        chunk = []
+        linesRead = 0
+        for row in itertools.islice(rows, chunkRows):
+            linesRead += 1
+            # Skip blank lines and pad rows that are shorter than the header
+            if not row:
+                continue
+            row += [''] * (len(header) - len(row))
+            chunk.append((tuple(row[index] for index in keyIndexes), [row[index] for index in valueIndexes]))
+        chunk.sort(key=itemgetter(0))
+
+        # The end of the table is reached when fewer lines than chunkRows were read, whether or not some were blank.
+        # If the whole table fit in one chunk, there's nothing to merge
+        endOfFile = linesRead < chunkRows
+        if not runFilePaths and endOfFile and spill is False:
+            return valueColumns, iter(chunk)
+
+        if chunk:
+            with tempfile.NamedTemporaryFile(
+                    mode='w', newline='', encoding='utf-8', suffix='.csv', dir=tempDirectory, delete=False) as runFile:
+                runWriter = csv.writer(runFile)
+                for key, values in chunk:
+                    runWriter.writerow(list(key) + values)
+            runFilePaths.append(runFile.name)
+        if endOfFile:
+            break
+
+    runs = [iterate_csv_run_file(runFilePath, len(keyColumns)) for runFilePath in runFilePaths]
+    return valueColumns, heapq.merge(*runs, key=itemgetter(0))
+
+
+# Sort the rows of a CSV file by the values of its keyColumns. See sort_table_rows
+def sort_csv_file_rows(filePath, keyColumns, tempDirectory, chunkRows=None, encoding='utf-8-sig', spill=False):
+    with open(filePath, mode='r', newline='', encoding=encoding) as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        return sort_table_rows(header, reader, keyColumns, tempDirectory, chunkRows=chunkRows, spill=spill)
+
+
+# Yield the rows of a Parquet file as lists of strings, one record batch at a time, in the format that
+# MetadataTableWriter reads them back in: nulls as empty strings, dates as 2020-01-01 and timestamps as 2020-01-01T12:00:00Z
+def iterate_parquet_file_rows(parquetFile):
+    for batch in parquetFile.iter_batches():
+        columns = []
+        for columnValues in batch.to_pydict().values():
+            strings = []
+            for value in columnValues:
+                if value is None:
+                    strings.append('')
+                elif isinstance(value, datetime):
+                    strings.append(value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+                elif isinstance(value, date):
+                    strings.append(value.isoformat())
+                else:
+                    strings.append(str(value))
+            columns.append(strings)
+        for row in zip(*columns):
+            yield list(row)
+
+
+# Sort the rows of a Parquet file by the values of its keyColumns. See sort_table_rows
+def sort_parquet_file_rows(filePath, keyColumns, tempDirectory, chunkRows=None, spill=False):
+    pa, pq = import_pyarrow()
+    parquetFile = pq.ParquetFile(filePath)
+    return sort_table_rows(
+        parquetFile.schema_arrow.names, iterate_parquet_file_rows(parquetFile), keyColumns, tempDirectory,
+        chunkRows=chunkRows, spill=spill)
+
+
+def tag_sorted_csv_rows(sortedRows, tableIndex):
+    for key, values in sortedRows:
+        yield key, tableIndex, values
+
+
+# Sort each of the files in filesList with sortFunction, e.g. sort_csv_file_rows, then merge the sorted files
+# and join them one key at a time, yielding the header and then the joined rows.
+# Like a pandas outer join, rows that share a key are combined in every combination, the values of files that don't
+# have the key are set to emptyValue, and the joined rows are in order of their keys
+def iterate_joined_table_rows(filesList, indexList, sortFunction, tempDirectory, chunkRows=None, emptyValue=''):
+    valueColumnsLists = []
+    sortedRowsOfFiles = []
+    for tableIndex, filePath in enumerate(filesList):
+        valueColumns, sortedRows = sortFunction(
+            filePath, indexList, tempDirectory, chunkRows=chunkRows, spill=len(filesList) > 1)
+        valueColumnsLists.append(valueColumns)
+        sortedRowsOfFiles.append(tag_sorted_csv_rows(sortedRows, tableIndex))
+    emptyValuesLists = [[emptyValue] * len(valueColumns) for valueColumns in valueColumnsLists]
+
+    yield list(indexList) + [column for valueColumns in valueColumnsLists for column in valueColumns]
+
+    mergedRows = heapq.merge(*sortedRowsOfFiles, key=itemgetter(0))
+    for key, keyRows in itertools.groupby(mergedRows, key=itemgetter(0)):
+        valuesListsOfFiles = [[] for _ in filesList]
+        for _, tableIndex, values in keyRows:
+            valuesListsOfFiles[tableIndex].append(values)
+
+        for valuesLists in itertools.product(*[
+                valuesLists or [emptyValues]
+                for valuesLists, emptyValues in zip(valuesListsOfFiles, emptyValuesLists)]):
+            yield list(key) + [value for values in valuesLists for value in values]
+
+
+# Full outer join of CSV files on the columns in indexList, saved to joinedFilePath.
+# Each file is sorted by its index columns on its own and saved to temporary files, then the sorted files are merged
+# and joined one key at a time, so only a chunk of a file, or the rows that share a key, are in memory at once,
+# however large or many the files are. See iterate_joined_table_rows. Returns the number of rows written
+def join_csv_files_on_columns(
+    filesList, indexList, joinedFilePath, tempDirectory=None, chunkRows=None, encoding='utf-8'):
+
+    # Increase the limit Python imposes on field sizes in CSV files
+    csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+
+    rowCount = 0
+    with tempfile.TemporaryDirectory(dir=tempDirectory) as tempDirectoryPath:
+        joinedRows = iterate_joined_table_rows(
+            filesList, indexList, sort_csv_file_rows, tempDirectoryPath, chunkRows=chunkRows)
+
+        with open(joinedFilePath, mode='w', newline='', encoding=encoding) as f:
+            writer = csv.writer(f)
+            writer.writerow(next(joinedRows))
+            for row in joinedRows:
+                writer.writerow(row)
+                rowCount += 1
+
+    return rowCount
+
+
+# Full outer join of Parquet files on the columns in indexList, saved to joinedFilePath with MetadataTableWriter.
+# The files are joined like join_csv_files_on_columns joins CSV files, with their sorted runs saved as temporary
+# CSV files, and the joined rows are written a row group at a time. Nulls match each other, like empty values in CSV files,
+# and the values of files that don't have a key are saved as nulls. Returns the number of rows written
+def join_parquet_files_on_columns(filesList, indexList, joinedFilePath, tempDirectory=None, chunkRows=None):
+
+    # Increase the limit Python imposes on field sizes in the CSV files that sorted runs are saved in
+    csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+
+    with tempfile.TemporaryDirectory(dir=tempDirectory) as tempDirectoryPath:
+        joinedRows = iterate_joined_table_rows(
+            filesList, indexList, sort_parquet_file_rows, tempDirectoryPath, chunkRows=chunkRows, emptyValue=None)
+
+        with MetadataTableWriter(joinedFilePath, next(joinedRows), outputFormat='parquet') as writer:
+            for row in joinedRows:
+                writer.writerow(row)
+
+    return writer.rowCount
+
+
+# Full outer join of CSV files in a given directory, using join_csv_files_on_columns so that the tables
+# don't all have to fit in memory.
+# When outputFormat is 'parquet', the Parquet files in the directory are joined into all_fields.parquet instead
+def join_metadata_csv_files(csvDirectory, outputFormat='csv'):
+
+    if outputFormat == 'parquet':
+        join_metadata_parquet_files(csvDirectory)
+        return
 
     # Create CSV file in the directory that the user selected
     allMetadataFileName = os.path.join(csvDirectory, 'all_fields.csv')
 
-    # Create list of common columns in CSV files to join on
-    indexList = [
-        'dataset_pid', 'dataset_pid_url', 'dataset_url', 'publication_date', 
-        'dataset_version_number', 'dataset_version_create_time', 
-        'dataverse_collection_alias']
-
     # Get list of CSV files in the csvDirectory
-    filesList = listdir(csvDirectory)
-    if len(filesList) > 1:
-        filesDirectoryPathsList = []
-        for file in filesList:
-            fileDirectoryPath = os.path.join(csvDirectory, file)
-            filesDirectoryPathsList.append(fileDirectoryPath)
+    filesDirectoryPathsList = [
+        file for file in glob.glob(str(Path(csvDirectory)) + '/' + '*.csv')
+        if file != allMetadataFileName]
+    if len(filesDirectoryPathsList) > 1:
+
+        # Full outer join all CSV files on their common columns and export to a CSV file
+        join_csv_files_on_columns(
+            sorted(filesDirectoryPathsList), metadataTableIndexColumns, allMetadataFileName, encoding='utf-8-sig')
+
 
-        # Create a dataframe of each CSV file in the 'filesList' list
-        dataframes = [pd.read_csv(table, sep=',', na_filter = False) for table in filesDirectoryPathsList]
+# Full outer join of the Parquet files in a given directory, saved as all_fields.parquet,
+# using join_parquet_files_on_columns so that the tables don't all have to fit in memory.
+# Rows whose publication dates are both null, e.g. the rows of drafts, are matched
+def join_metadata_parquet_files(parquetDirectory):
+    import_pyarrow()
 
-        # For each dataframe, set the indexes (or the common columns across the dataframes to join on)
-        for dataframe in dataframes:
-            dataframe.set_index(indexList, inplace=True)
+    allMetadataFileName = os.path.join(parquetDirectory, 'all_fields.parquet')
 
-        # Full outer join all dataframes and save to the 'joined' variable
-        joined = reduce(lambda left, right: left.join(right, how='outer'), dataframes)
+    filesDirectoryPathsList = [
+        file for file in glob.glob(str(Path(parquetDirectory)) + '/' + '*.parquet')
+        if file != allMetadataFileName]
+    if len(filesDirectoryPathsList) > 1:
+        join_parquet_files_on_columns(
+            sorted(filesDirectoryPathsList), metadataTableIndexColumns, allMetadataFileName)
 
-        # Export joined dataframe to a CSV file
-        joined.to_csv(allMetadataFileName, encoding='utf-8-sig')
 
+# Number of PIDs OR-ed into each Search API query by search_datasets_by_pids. Batches whose
+# URLs are too long for an installation are split in half until they're short enough
+searchApiPidBatchSize = 200
 
-# Get the metadata of datasets. Function passed to tkinter button
+
+# Search for a batch of datasets by their PIDs in one Search API query.
+# Batches that the installation rejects, usually because the URL is too long, are split in half and searched again.
+# Returns the items found and the PIDs that couldn't be searched for, because the installation responded with an error
+# or the call failed, so that a batch that fails doesn't stop the other batches
+def search_datasets_of_pid_batch(searchApiUrl, datasetPidBatch, apiKey=''):
+    quotedPids = ' OR '.join('"%s"' % datasetPid.replace('"', '\\"') for datasetPid in datasetPidBatch)
+    params = {
+        'q': f'dsPersistentId:({quotedPids})',
+        'type': 'dataset',
+        'per_page': searchApiMaxPerPage,
+        'start': 0}
+
+    items = []
+    while True:
+        try:
+            response = api_get(searchApiUrl, params=params, apiKey=apiKey)
+            if response.status_code in (400, 414) and len(datasetPidBatch) > 1:
+                half = math.ceil(len(datasetPidBatch) / 2)
+                firstItems, firstFailedPids = search_datasets_of_pid_batch(searchApiUrl, datasetPidBatch[:half], apiKey)
+                secondItems, secondFailedPids = search_datasets_of_pid_batch(searchApiUrl, datasetPidBatch[half:], apiKey)
+                return items + firstItems + secondItems, firstFailedPids + secondFailedPids
+            if response.status_code != 200:
+                break
+            data = response.json()['data']
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            break
+
+        items.extend(data['items'])
+
+        # The same dataset can be listed twice, once for its draft and once for its published version,
+        # so a batch can have more results than PIDs
+        params['start'] += len(data['items'])
+        if len(data['items']) == 0 or params['start'] >= data['total_count']:
+            return items, []
+
+    # Only PIDs that weren't found in pages that were already returned count as failed
+    foundPids = {item['global_id'].lower() for item in items}
+    return items, [datasetPid for datasetPid in datasetPidBatch if datasetPid.lower() not in foundPids]
+
+
+# Search for datasets by their PIDs, searchApiPidBatchSize PIDs at a time in one Search API query
+# (q=dsPersistentId:("doi:..." OR "doi:..." ...)) instead of searching for each dataset. Batches are searched
+# at the same time, and the PIDs of batches that fail are searched for one at a time.
+# Returns the Search API items found and the PIDs that still couldn't be searched for
+def search_datasets_by_pids(installationUrl, datasetPids, apiKey='', batchSize=None, maxConcurrency=None):
+    searchApiUrl = f'{installationUrl}/api/search'.replace('//api', '/api')
+    if batchSize is None:
+        batchSize = searchApiPidBatchSize
+    if maxConcurrency is None:
+        maxConcurrency = get_max_concurrency(installationUrl)
+
+    datasetPids = list(dict.fromkeys(get_canonical_pid(datasetPid) for datasetPid in datasetPids))
+    datasetPidBatches = [datasetPids[i:i + batchSize] for i in range(0, len(datasetPids), batchSize)]
+
+    items = []
+    failedPids = []
+    with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+        for batchItems, batchFailedPids in executor.map(
+                lambda datasetPidBatch: search_datasets_of_pid_batch(searchApiUrl, datasetPidBatch, apiKey),
+                datasetPidBatches):
+            items.extend(batchItems)
+            failedPids.extend(batchFailedPids)
+
+        if failedPids and batchSize > 1:
+            retriedPids, failedPids = failedPids, []
+            for pidItems, pidFailedPids in executor.map(
+                    lambda datasetPid: search_datasets_of_pid_batch(searchApiUrl, [datasetPid], apiKey),
+                    retriedPids):
+                items.extend(pidItems)
+                failedPids.extend(pidFailedPids)
+
+    if failedPids:
+        print(f'{len(failedPids)} dataset(s) could not be searched for in {installationUrl}: {failedPids[:10]}')
+
+    return items, failedPids
+
+
+# Return a dictionary of the given dataset PIDs, in lowercase, and the PID, URL, and alias and name of the collection
+# of each dataset, found with search_datasets_by_pids. Datasets that aren't found aren't in the dictionary.
+# If a failedPids list is given, the PIDs of datasets that couldn't be searched for are added to it
+def get_dataset_collections_from_search_api(
+    installationUrl, datasetPids, apiKey='', batchSize=None, maxConcurrency=None, failedPids=None):
+
+    items, searchFailedPids = search_datasets_by_pids(
+        installationUrl, datasetPids, apiKey=apiKey, batchSize=batchSize, maxConcurrency=maxConcurrency)
+    if failedPids is not None:
+        failedPids.extend(searchFailedPids)
+
+    datasetCollections = {}
+    for item in items:
+        datasetCollections[item['global_id'].lower()] = {
+            'dataset_pid': item['global_id'],
+            'dataset_pid_url': item.get('url', ''),
+            'dataverse_collection_alias': item.get('identifier_of_dataverse', ''),
+            'dataverse_collection_name': item.get('name_of_dataverse', '')}
+
+    return datasetCollections
+
+
+# Get the Dataverse JSON export of the latest version of a dataset for get_dataset_metadata. Run in worker threads.
+# Returns the dataset's PID and the export, or 'ERROR' if the export couldn't be downloaded
+def fetch_dataset_metadata_for_csv_files(installationUrl, datasetPid, apiKey=''):
+    datasetMetadata = get_dataset_metadata_export(
+        installationUrl=installationUrl,
+        datasetPid=datasetPid, 
+        exportFormat='dataverse_json',
+        timeout=60,
+        verify=False,
+        apiKey=apiKey)
+
+    return datasetPid, datasetMetadata
+
+
+# Get the metadata of datasets. Function passed to tkinter button.
+# The collection aliases of all datasets are looked up first, hundreds of datasets per Search API call.
+# Then the exports of datasets are downloaded in worker threads, as many at a time as the
+# installation's concurrency controller allows, while the main thread extracts the chosen fields from each export
+# as it arrives, updates the progress text, and writes the rows to the CSV files, which are kept open until all
+# datasets are done.
+# When outputFormat is 'parquet', each table is saved as a Parquet file with typed columns and values that aren't truncated
 def get_dataset_metadata(
     rootWindow, progressLabel, progressText, noMetadataText, noMetadataLabel,
     installationUrl='', datasetPidString='', 
-    parentFieldTitleList='', directoryPath='', apiKey=''):
+    parentFieldTitleList='', directoryPath='', apiKey='', outputFormat='csv'):
 
     # Use metadatablock API endpoint to get metadatablock data
     metadatablockData = get_metadatablock_data(installationUrl, 'citation')
 
-    # From metadatablockData, get the database and display names of each parent field
-    allFieldsDBNamesDict = get_metadatablock_db_field_name_and_title(metadatablockData)
-
     # Create directory in the directory that the user chose
     currentTime = time.strftime('%Y.%m.%d_%H.%M.%S')
 
     # Get name of repository
-    req = requests.get(
+    req = api_get(
         f'{installationUrl}/api/dataverses/1')
     data = req.json()
     installationName = data['data']['name'].replace(' ', '_').replace('__', '_')
@@ -1535,36 +4439,9 @@ def get_dataset_metadata(
     mainDirectoryPath = str(Path(directoryPath + '/' + mainDirectoryName))
     os.mkdir(mainDirectoryPath)
 
-    # For each field the user chose:
-    for parentFieldTitle in parentFieldTitleList:
-
-        # Create CSV file
-
-        # Create file name and path
-        csvFileName =  parentFieldTitle.lower().strip().replace(' ', '_')
-        csvFileName = csvFileName + '(citation)'
-        mainDirectoryPath = str(Path(directoryPath + '/' + mainDirectoryName))
-        csvFilePath = str(Path(mainDirectoryPath, csvFileName)) + '.csv'
-          
-        # Create header row for the CSV file
-        headerRow = [
-            'dataset_pid', 'dataset_pid_url', 'dataset_url', 
-            'publication_date', 'dataset_version_number', 
-            'dataset_version_create_time', 'dataverse_collection_alias']
-
-        childFieldsList = get_column_names(
-            metadatablockData, parentFieldTitle, allFieldsDBNamesDict)
-        # Add childFields list to header row
-        headerRow = headerRow + childFieldsList
-
-        # Create CSV file and add headerrow
-        with open(csvFilePath, mode='w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(headerRow)        
-
     # Change passed datasetPidString to a list. Make sure the last newline doesn't mess up the list
     # datasetPidList = [x.strip() for x in datasetPidString.splitlines()][:-1]
-    datasetPidList = [x.strip() for x in datasetPidString.rstrip().splitlines()]
+    datasetPidList = [get_canonical_pid(x.strip()) for x in datasetPidString.rstrip().splitlines()]
 
     # Delete any message in the tkinter window about no metadata being found
     # the last time the "Get metadata" button was pressed
@@ -1578,66 +4455,91 @@ def get_dataset_metadata(
     progressLabel.grid(sticky='w', row=1, columnspan=2)
     rootWindow.update_idletasks()
 
-    for datasetPid in datasetPidList:
-
-        datasetPid = get_canonical_pid(datasetPid)
-
-        # Get alias of collection that dataset is in
-        searchApiUrl = f'{installationUrl}/api/search?q=dsPersistentId:"{datasetPid}"'
-        requestsGetProperties = get_params(searchApiUrl)
-        baseUrl = requestsGetProperties['baseUrl']
-        params = requestsGetProperties['params']
-
-        datasetInfoDF = get_object_dataframe_from_search_api(
-            url=baseUrl, rootWindow=rootWindow, progressLabel=None, progressText=None,
-            params=params, objectType='dataset', apiKey=apiKey)
-
-        dataverseAlias = datasetInfoDF.iloc[0]['dataverse_collection_alias']
-
-        # Get the JSON metadata export of the latest version of the dataset
-        datasetMetadata = get_dataset_metadata_export(
-            installationUrl=installationUrl,
-            datasetPid=datasetPid, 
-            exportFormat='dataverse_json',
-            timeout=60,
-            verify=False,
-            apiKey=apiKey)
-
-        if datasetMetadata['status'] == 'OK':
-
-            for parentFieldTitle in parentFieldTitleList:
-                # Get database name of parentFieldTitle
-                dbName = allFieldsDBNamesDict[parentFieldTitle]
-
-                valueLists = get_metadata_values_lists(
-                    installationUrl=installationUrl,
-                    datasetMetadata=datasetMetadata,
-                    metadatablockName='citation',
-                    chosenTitleDBName=dbName, 
-                    chosenFields=get_column_names(
-                        metadatablockData, parentFieldTitle, allFieldsDBNamesDict))                
-                citationMetadataCsvFileName =  parentFieldTitle.lower().strip().replace(' ', '_')
-                citationMetadataCsvFileName = citationMetadataCsvFileName + '(citation)'
-                citationMetadataCsvFilePath = str(Path(mainDirectoryPath, citationMetadataCsvFileName)) + '.csv'
-
-                for valueList in valueLists:
-
-                    # Insert alias of collection that dataset is published in
-                    valueList.insert(6, dataverseAlias)
-
-                    # Add row containing metadata of the dataset
-                    with open(citationMetadataCsvFilePath, mode='a', newline='', encoding='utf-8') as f:
-                        writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-                        writer.writerow(valueList) 
-
-        count += 1
-        text = f'Dataset metadata retrieved: {count} of {datasetTotalCount}'
+    # Get the alias of the collection that each dataset is in
+    collectionFailedPids = []
+    datasetCollections = get_dataset_collections_from_search_api(
+        installationUrl, datasetPidList, apiKey=apiKey, failedPids=collectionFailedPids)
+
+    maxConcurrency = get_max_concurrency(installationUrl)
+    maxInFlight = maxConcurrency * 2
+
+    with contextlib.ExitStack() as stack:
+
+        # For each field the user chose, create a CSV or Parquet file, add the header row, and keep the file open
+        maxValueLength = None if outputFormat == 'parquet' else 10000
+        extractor = MetadataFieldExtractor(metadatablockData, parentFieldTitleList, maxValueLength=maxValueLength)
+        csvWriters = []
+        for parentFieldTitle in parentFieldTitleList:
+
+            # Create file name and path
+            csvFileName =  parentFieldTitle.lower().strip().replace(' ', '_')
+            csvFileName = csvFileName + '(citation)'
+            csvFilePath = get_metadata_table_file_path(mainDirectoryPath, csvFileName, outputFormat)
+              
+            # Create header row for the CSV file
+            headerRow = list(metadataTableIndexColumns)
+
+            childFieldsList = extractor.get_columns(parentFieldTitle)
+            # Add childFields list to header row
+            headerRow = headerRow + childFieldsList
+
+            writer = stack.enter_context(MetadataTableWriter(csvFilePath, headerRow, outputFormat))
+            csvWriters.append(writer)
+
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=maxConcurrency))
+        datasetPidIterator = iter(datasetPidList)
+        pendingFutures = set()
+
+        while True:
+            # Keep up to maxInFlight datasets being downloaded, so that exports that are waiting
+            # to be extracted don't pile up in memory
+            for datasetPid in itertools.islice(datasetPidIterator, maxInFlight - len(pendingFutures)):
+                pendingFutures.add(executor.submit(
+                    fetch_dataset_metadata_for_csv_files, installationUrl, datasetPid, apiKey))
+            if not pendingFutures:
+                break
+
+            doneFutures, pendingFutures = concurrent.futures.wait(
+                pendingFutures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in doneFutures:
+                datasetPid, datasetMetadata = future.result()
+                dataverseAlias = datasetCollections.get(datasetPid.lower(), {}).get('dataverse_collection_alias', '')
+
+                if datasetMetadata != 'ERROR' and datasetMetadata['status'] == 'OK':
+
+                    # Get the rows of all chosen fields in one pass through the dataset's metadata
+                    valueListsOfFields = extractor.extract(installationUrl, datasetMetadata)
+
+                    for writer, valueLists in zip(csvWriters, valueListsOfFields):
+                        for valueList in valueLists:
+
+                            # Insert alias of collection that dataset is published in
+                            valueList.insert(6, dataverseAlias)
+
+                            # Add row containing metadata of the dataset
+                            writer.writerow(valueList)
+
+                count += 1
+                text = f'Dataset metadata retrieved: {count} of {datasetTotalCount}'
+                progressText.set(text)
+                rootWindow.update_idletasks()
+
+    # Report in the app the datasets whose collection aliases couldn't be looked up and are left empty
+    if collectionFailedPids:
+        text = (
+            f'Dataset metadata retrieved: {count} of {datasetTotalCount}. '
+            f'The collections of {len(collectionFailedPids)} dataset(s) couldn\'t be looked up, '
+            'so their dataverse_collection_alias is empty')
         progressText.set(text)
         rootWindow.update_idletasks()
 
     # Delete any CSV files in the mainDirectory that are empty and 
     # report in the app the deleted CSV files
-    fieldsWithNoMetadata = delete_empty_csv_files(mainDirectoryPath)
+    if outputFormat == 'parquet':
+        fieldsWithNoMetadata = delete_empty_parquet_files(mainDirectoryPath)
+    else:
+        fieldsWithNoMetadata = delete_empty_csv_files(mainDirectoryPath)
 
     if count > 0 and len(fieldsWithNoMetadata) > 0:
 
@@ -1649,14 +4551,14 @@ def get_dataset_metadata(
         rootWindow.update_idletasks()
 
     # Full outer join all CSV files to create a CSV with all metadata
-    join_metadata_csv_files(mainDirectoryPath)
+    join_metadata_csv_files(mainDirectoryPath, outputFormat)
 
 
 def delete_published_dataset(installationUrl, datasetPid, apiKey):
     destroyDatasetApiEndpointUrl = f'{installationUrl}/api/datasets/:persistentId/destroy/?persistentId={datasetPid}'
-    req = requests.delete(
+    req = api_delete(
         destroyDatasetApiEndpointUrl,
-        headers={'X-Dataverse-key': apiKey})
+        apiKey=apiKey)
     data = req.json()
 
     status = data.get('status')
@@ -1735,9 +4637,9 @@ def save_locked_dataset_report(installationUrl='', directoryPath='', apiKey=''):
     # Get dataset PIDs of datasets that have any of the lock types in lockTypesList
     for lockType in lockTypesList:
         datasetLocksApiEndpoint = f'{installationUrl}/api/datasets/locks?type={lockType}'
-        response = requests.get(
+        response = api_get(
             datasetLocksApiEndpoint,
-            headers={'X-Dataverse-key': apiKey})
+            apiKey=apiKey)
         data = response.json()
 
         if data['status'] == 'OK':
@@ -1837,7 +4739,7 @@ def save_locked_dataset_report(installationUrl='', directoryPath='', apiKey=''):
 
                 # Get all data about locks on the dataset
                 getAllLocksofDatasetApiEndpoint = f'{installationUrl}/api/datasets/:persistentId/locks?persistentId={lockedDatasetPid}'
-                allLockData = requests.get(getAllLocksofDatasetApiEndpoint).json()
+                allLockData = api_get(getAllLocksofDatasetApiEndpoint).json()
 
                 for lock in allLockData['data']:
                     datasetUrl = f'{installationUrl}/dataset.xhtml?persistentId={lockedDatasetPid}&version=DRAFT'
@@ -1854,9 +4756,9 @@ def save_locked_dataset_report(installationUrl='', directoryPath='', apiKey=''):
 
                     userTracesApiEndpointUrl = f'{installationUrl}/api/users/{userName}/traces'
 
-                    response = requests.get(
+                    response = api_get(
                         userTracesApiEndpointUrl,
-                        headers={'X-Dataverse-key': apiKey})
+                        apiKey=apiKey)
                     userTracesData = response.json()
 
                     createdDatasetPidsList = []
@@ -1910,9 +4812,9 @@ def save_locked_dataset_report(installationUrl='', directoryPath='', apiKey=''):
 
 def unlock_dataset(installationUrl, datasetPid, apiKey):
     unlockDatasetApiEndpointUrl = f'{installationUrl}/api/datasets/:persistentId/locks?persistentId={datasetPid}'
-    req = requests.delete(
+    req = api_delete(
         unlockDatasetApiEndpointUrl,
-        headers={'X-Dataverse-key': apiKey})
+        apiKey=apiKey)
     data = req.json()
 
     status = data.get('status')
@@ -1990,12 +4892,11 @@ def get_monthly_counts(installationUrl, objects, directoryPath):
     with open(csvFilePath, mode='a', newline='', encoding='utf-8') as f:
         writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-        with requests.Session() as s:
-            download = s.get(monthlyCountsApiEndpoint)
+        download = api_get(monthlyCountsApiEndpoint)
 
-            decodedContent = download.content.decode('utf-8')
+        decodedContent = download.content.decode('utf-8')
 
-            cr = csv.reader(decodedContent.splitlines(), delimiter=',')
-            countList = list(cr)
-            for row in countList[1:]:
-                writer.writerow(row)  
\ No newline at end of file
+        cr = csv.reader(decodedContent.splitlines(), delimiter=',')
+        countList = list(cr)
+        for row in countList[1:]:
+            writer.writerow(row)  
\ No newline at end of file
@@ -400,6 +400,13 @@ class getMetadataAsCSVsFrame(Frame):
             text='Clear selections', width=120, 
             command=lambda: clear_selections(self.listboxSelectFieldNames))
 
+        # Create checkbox for saving the tables as Parquet files instead of CSV files
+        self.saveAsParquet = BooleanVar()
+        self.checkboxSaveAsParquet = Checkbutton(
+            self.frameWhichFields,
+            text='Save tables as Parquet files (values aren\'t shortened to 10,000 characters)', bg='white',
+            variable=self.saveAsParquet, onvalue = True, offvalue = False)
+
         # Place frames, buttons, labels and help text for getting and selecting metadata field names
         self.frameWhichFields.grid(sticky='w', row=0, pady=10)
         self.buttonGetFieldNames.grid(sticky='w', row=0)
@@ -417,6 +424,8 @@ class getMetadataAsCSVsFrame(Frame):
         self.buttonSelectAll.grid(sticky='w', column=0, row=1)
         self.buttonClearSelections.grid(sticky='w', column=1, row=1)
 
+        self.checkboxSaveAsParquet.grid(sticky='w', row=5, pady=5)
+
         # Add scrollbar to listbox for select metadata field names
         self.listboxSelectFieldNames.config(
             yscrollcommand=self.scrollbarSelectFieldNames.set)
@@ -441,7 +450,8 @@ class getMetadataAsCSVsFrame(Frame):
                     datasetPidString=self.textBoxCollectionDatasetPIDs.get('1.0', END),
                     parentFieldTitleList=get_listbox_values(self.listboxSelectFieldNames),
                     directoryPath=get_directory_path(), # function that asks user for directory
-                    apiKey=self.entryApiToken.get().strip()
+                    apiKey=self.entryApiToken.get().strip(),
+                    outputFormat='parquet' if self.saveAsParquet.get() else 'csv'
                     )
                 )
 
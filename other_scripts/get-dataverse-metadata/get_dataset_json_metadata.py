@@ -3,6 +3,7 @@
 
 import csv
 from csv import DictReader
+import glob
 import json
 import os
 from pathlib import Path
@@ -82,9 +83,17 @@ labelBrowseDirectory.grid(sticky='w', column=0, row=15, pady=2)
 buttonBrowseDirectory = ttk.Button(window, text='Browse', command=lambda: retrieve_directory())
 buttonBrowseDirectory.grid(sticky='w', column=0, row=16)
 
+# Create "Resume" checkbox
+resumeDownload = IntVar()
+Checkbutton(window, text="Resume the last download in the chosen folder", variable=resumeDownload).grid(sticky='w', column=0, row=18)
+
+# Create help text for resume checkbox
+labelResumeHelpText = Label(window, text='Metadata that was already downloaded is skipped, and failed downloads are tried again', foreground='grey', anchor='w')
+labelResumeHelpText.grid(sticky='w', column=0, row=19)
+
 # Create start button
 buttonSubmit = ttk.Button(window, text='Start', command=lambda: retrieve_input())
-buttonSubmit.grid(sticky='w', column=0, row=18, pady=40)
+buttonSubmit.grid(sticky='w', column=0, row=20, pady=40)
 
 
 # Function called when Browse button is pressed for choosing text file with dataset PIDs
@@ -121,10 +130,14 @@ def retrieve_input():
     global installationUrl
     global apiKey
     global getAllVersionMetadata
+    global resumeDownload
 
     # Record if user wants metadata from all dataset versions
     getAllVersionMetadata = getAllVersionMetadata.get()
 
+    # Record if user wants to resume the last download in the chosen folder
+    resumeDownload = resumeDownload.get()
+
     # Store what's entered in dataverseUrl text box as a global variable
     installationUrl = entryInstallationUrl.get()
 
@@ -139,6 +152,14 @@ mainloop()
 # Save current time to append it to main folder name
 currentTime = time.strftime('%Y.%m.%d_%H.%M.%S')
 
+# To resume the last download in the chosen folder, reuse the time in the names of its metadata folder
+# and download status files
+previousMetadataFileDirectories = sorted(glob.glob(str(Path(metadataFileDirectory)) + '/JSON_metadata_*'))
+resume = resumeDownload == 1 and len(previousMetadataFileDirectories) > 0
+if resume:
+    currentTime = previousMetadataFileDirectories[-1].split('JSON_metadata_')[-1]
+    print(f'Resuming download that started at {currentTime}')
+
 # Use the "Get Version" endpoint to get repository's Dataverse version (or set version as 'NA')
 getInstallationVersionApiUrl = f'%s/api/v1/info/version' % (installationUrl)
 response = requests.get(getInstallationVersionApiUrl)
@@ -149,7 +170,7 @@ dataverseVersion = str(dataverseVersion.lstrip('v'))
 # Download metadatablock JSON files
 # Create name for metadatablock files directory in main directory
 metadatablockFileDirectoryPath = str(Path(metadataFileDirectory)) + '/' + f'metadatablocks_v{dataverseVersion}'
-os.mkdir(metadatablockFileDirectoryPath)
+os.makedirs(metadatablockFileDirectoryPath, exist_ok=True)
 
 # Get list of the repository's metadatablock names
 metadatablocksApi = f'{installationUrl}/api/v1/metadatablocks'
@@ -183,7 +204,7 @@ print(f'\nFinished downloading {metadatablockNamesCount} metadatablock JSON file
 
 # Create directory for metadata exports with current time
 metadataFileDirectoryPath = str(Path(metadataFileDirectory)) + '/' + f'JSON_metadata_{currentTime}'
-os.mkdir(metadataFileDirectoryPath)
+os.makedirs(metadataFileDirectoryPath, exist_ok=True)
 
 if getAllVersionMetadata != 1:
     print('\nDownloading JSON metadata of latest published dataset versions to dataset_metadata folder:')
@@ -215,7 +236,7 @@ if getAllVersionMetadata != 1:
         downloadStatusFilePath=downloadStatusFilePath,
         installationUrl=installationUrl, datasetPidList=datasetPids, 
         exportFormat='dataverse_json', verify=False, allVersions=False, 
-        header={}, apiKey=apiKey)
+        header={}, apiKey=apiKey, resume=resume)
 
 elif getAllVersionMetadata == 1:
     save_dataset_exports(
@@ -224,5 +245,5 @@ elif getAllVersionMetadata == 1:
         installationUrl=installationUrl, datasetPidList=datasetPids, 
         exportFormat='dataverse_json', timeout=60,
         verify=False, allVersions=True, 
-        header={}, apiKey=apiKey)
+        header={}, apiKey=apiKey, resume=resume)
 
@@ -7,6 +7,10 @@ import requests
 from tkinter import *
 from tkinter import filedialog
 from tkinter import ttk
+import sys
+
+sys.path.append('/Users/juliangautier/dataverse-scripts/dataverse_repository_curation_assistant')
+from dataverse_repository_curation_assistant_functions import *
 
 # Create GUI for getting user input
 window = Tk()
@@ -96,10 +100,14 @@ def retrieve_directory():
 # Function called when Start button is pressed
 def retrieve_input():
     global repositoryURL
+    global apikey
 
     # Store what's entered in dataverseUrl text box as a global variable
     repositoryURL = entry_repositoryURL.get()
 
+    # Store what's entered in the API key text box as a global variable
+    apikey = entryApikey.get().strip()
+
     window.destroy()
 
 
@@ -131,32 +139,29 @@ with open(filename, mode='w') as opencsvfile:
     # Create header row
     opencsvfile.writerow(['persistentUrl', 'dataverseAlias', 'dataverseName'])
 
+# Look up the Dataverse collections of the datasets, hundreds of datasets per Search API call
+print('Looking up the Dataverse collections of %s datasets' % (total))
+datasetCollections = get_dataset_collections_from_search_api(
+    repositoryURL.rstrip('/'), datasetPIDs, apiKey=apikey)
+
 datasetPIDErrors = []
 count = 0
-for datasetPID in datasetPIDs:
-    try:
-        if apikey:
-            url = '%s/api/search?q="%s"&type=dataset&show_entity_ids=true&key=%s' % (repositoryURL, datasetPID, apikey)
-        else:
-            url = '%s/api/search?q="%s"&type=dataset&show_entity_ids=true' % (repositoryURL, datasetPID)
-        response = requests.get(url)
-        data = response.json()
-
-        # Save dataset PID, Dataverse name and Dataverse alias
-        persistentUrl = data['data']['items'][0]['url']
-        dataverseName = data['data']['items'][0]['name_of_dataverse']
-        dataverseAlias = data['data']['items'][0]['identifier_of_dataverse']
-
-        # Write values of the three variables to a new row in the CSV
-        with open(filename, mode='a') as datasets:
-            datasets = csv.writer(datasets, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-            datasets.writerow([persistentUrl, dataverseAlias, dataverseName])
+with open(filename, mode='a') as datasets:
+    datasets = csv.writer(datasets, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+    for datasetPID in datasetPIDs:
+        datasetCollection = datasetCollections.get(get_canonical_pid(datasetPID).lower())
+        if datasetCollection is None:
+            datasetPIDErrors.append(datasetPID)
+            continue
+
+        # Write the dataset's persistent URL and the alias and name of its Dataverse collection to a new row in the CSV
+        datasets.writerow([
+            datasetCollection['dataset_pid_url'], datasetCollection['dataverse_collection_alias'],
+            datasetCollection['dataverse_collection_name']])
         count += 1
 
-    except Exception:
-        datasetPIDErrors.append(datasetPID)
-
-    print('Dataverse collection names retrieved: %s of %s (%s)' % (count, total, datasetPID))
+print('Dataverse collection names retrieved: %s of %s' % (count, total))
 if datasetPIDErrors:
     print('The Dataverse collection names of these datasets could not be retrieved:\n')
     print(datasetPIDErrors)
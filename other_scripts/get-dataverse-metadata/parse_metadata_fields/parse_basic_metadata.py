@@ -48,6 +48,10 @@ def retrieve_csvdirectory():
 
 # Function called when Start button is pressed
 def start():
+    global saveAsParquet
+
+    # Save the checkbox value before the window and its variables are destroyed
+    saveAsParquet = saveAsParquet.get()
     window.destroy()
 
 
@@ -70,80 +74,68 @@ label_tablesDirectory.grid(sticky='w', column=0, row=4, pady=2)
 button_tablesDirectory = ttk.Button(window, text='Browse', command=lambda: retrieve_csvdirectory())
 button_tablesDirectory.grid(sticky='w', column=0, row=5)
 
+# Create checkbox for saving the table as a Parquet file instead of a CSV file
+saveAsParquet = IntVar()
+Checkbutton(window, text="Save as a Parquet file instead of a CSV file", variable=saveAsParquet).grid(sticky='w', column=0, row=7, pady=10)
+
 # Create start button
 button_Start = ttk.Button(window, text='Start', command=lambda: start())
-button_Start.grid(sticky='w', column=0, row=7, pady=40)
+button_Start.grid(sticky='w', column=0, row=8, pady=40)
 
 # Keep window open until it's closed
 mainloop()
 
+outputFormat = 'parquet' if saveAsParquet == 1 else 'csv'
 
 # Add path of csv file to filename variable
-filename = os.path.join(csvDirectory, 'basic_metadata.csv')
+filename = get_metadata_table_file_path(csvDirectory, 'basic_metadata', outputFormat)
 
-print('Creating CSV file')
+print('Creating %s file' % (outputFormat.upper()))
 
-with open(filename, mode='w', newline='') as metadatafile:
-    metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    # Create header row
-    metadatafile.writerow([
-            'dataset_pid', 'dataset_pid_url', 'dataset_version_number', 'dataset_publication_date', 
-            'dataset_version_create_time', 'dataset_version_state', 'publisher'])
+# Create the file with a header row, and keep it open while rows are written
+metadatafile = MetadataTableWriter(filename, [
+    'dataset_pid', 'dataset_pid_url', 'dataset_version_number', 'dataset_publication_date', 
+    'dataset_version_create_time', 'dataset_version_state', 'publisher'], outputFormat)
 
 print('Getting metadata:')
 error_files = []
 fileCount = 0
-fileCountTotal = len(glob.glob(os.path.join(jsonDirectory, '*.json')))
+fileCountTotal = count_dataset_exports(jsonDirectory)
 
-# For each JSON file in a folder
-for file in glob.glob(os.path.join(jsonDirectory, '*.json')):
+# For each JSON file in a folder, or each export in a bundle of exports
+for file, datasetMetadata in iterate_dataset_exports(jsonDirectory):
     fileCount += 1
     print(f'Getting metadata from {fileCount} of {fileCountTotal} files', end='\r', flush=True)
-    # Open each file in read mode
-    with open(file, 'r') as f1:
-        # Copy content to datasetMetadata variable
-        datasetMetadata = f1.read()
-        # Load content in variable as a json object
-        datasetMetadata = json.loads(datasetMetadata)
-
-        # Check if JSON file has "data" key
-        if datasetMetadata['status'] == 'OK':
-
-            # Save the metadata values in variables
-            datasetPersistentUrl = datasetMetadata['data']['persistentUrl']
-            datasetPid = improved_get(datasetMetadata, 'data.datasetVersion.datasetPersistentId')
-
-            # Older Dataverse installations' JSON metadata exports don't include the datasetPersistentId key
-            # So try to use the datasetPersistentUrl instead and convert to a canonical PID. Hopefully it's a DOI or HDL...
-            if datasetPid is None:
-                datasetPid = get_canonical_pid(datasetPersistentUrl)  
-
-            majorVersionNumber = improved_get(datasetMetadata, 'data.datasetVersion.versionNumber')
-            minorVersionNumber = improved_get(datasetMetadata, 'data.datasetVersion.versionMinorNumber')
-            datasetVersionNumber = f'{majorVersionNumber}.{minorVersionNumber}'
-
-            datasetVersionCreateTime = datasetMetadata['data']['datasetVersion']['createTime']
-            datasetVersionState = datasetMetadata['data']['datasetVersion']['versionState']
-            datasetPublicationDate = datasetMetadata['data']['publicationDate']
-            publisher = datasetMetadata['data']['publisher']
-
-            # Write fields to the csv file
-            with open(filename, mode='a', newline='') as metadatafile:
-
-                # Convert all characters to utf-8
-                def to_utf8(lst):
-                    return [unicode(elem).encode('utf-8') for elem in lst]
-
-                metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-                # Write new row
-                metadatafile.writerow([
-                    datasetPid, datasetPersistentUrl, datasetVersionNumber, datasetPublicationDate,
-                    datasetVersionCreateTime, datasetVersionState, publisher])
-
-        # If JSON file doens't have "data" key, add file to list of error_files
-        else:
-            error_files.append(Path(file).name)
+    # Check if JSON file has "data" key
+    if datasetMetadata['status'] == 'OK':
+
+        # Save the metadata values in variables
+        datasetPersistentUrl = datasetMetadata['data']['persistentUrl']
+        datasetPid = improved_get(datasetMetadata, 'data.datasetVersion.datasetPersistentId')
+
+        # Older Dataverse installations' JSON metadata exports don't include the datasetPersistentId key
+        # So try to use the datasetPersistentUrl instead and convert to a canonical PID. Hopefully it's a DOI or HDL...
+        if datasetPid is None:
+            datasetPid = get_canonical_pid(datasetPersistentUrl)  
+
+        majorVersionNumber = improved_get(datasetMetadata, 'data.datasetVersion.versionNumber')
+        minorVersionNumber = improved_get(datasetMetadata, 'data.datasetVersion.versionMinorNumber')
+        datasetVersionNumber = f'{majorVersionNumber}.{minorVersionNumber}'
+
+        datasetVersionCreateTime = datasetMetadata['data']['datasetVersion']['createTime']
+        datasetVersionState = datasetMetadata['data']['datasetVersion']['versionState']
+        datasetPublicationDate = datasetMetadata['data']['publicationDate']
+        publisher = datasetMetadata['data']['publisher']
+
+        # Write new row
+        metadatafile.writerow([
+            datasetPid, datasetPersistentUrl, datasetVersionNumber, datasetPublicationDate,
+            datasetVersionCreateTime, datasetVersionState, publisher])
+
+    # If JSON file doens't have "data" key, add file to list of error_files
+    else:
+        error_files.append(Path(file).name)
+metadatafile.close()
 print(f'Finished getting metadata from {fileCount} of {fileCountTotal} files')
 
 if error_files:
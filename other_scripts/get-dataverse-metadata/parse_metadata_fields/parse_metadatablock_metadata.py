@@ -62,6 +62,10 @@ def retrieve_csvdirectory():
 
 # Function called when Start button is pressed
 def start():
+    global saveAsParquet
+
+    # Save the checkbox value before the window and its variables are destroyed
+    saveAsParquet = saveAsParquet.get()
     window.destroy()
 
 
@@ -95,13 +99,22 @@ label_tablesDirectory.grid(sticky='w', column=0, row=8, pady=2)
 button_tablesDirectory = ttk.Button(window, text='Browse', command=lambda: retrieve_csvdirectory())
 button_tablesDirectory.grid(sticky='w', column=0, row=9)
 
+# Create checkbox for saving the tables as Parquet files instead of CSV files
+saveAsParquet = IntVar()
+Checkbutton(window, text="Save as Parquet files instead of CSV files", variable=saveAsParquet).grid(sticky='w', column=0, row=11, pady=10)
+
 # Create start button
 button_Start = ttk.Button(window, text='Start', command=lambda: start())
-button_Start.grid(sticky='w', column=0, row=11, pady=40)
+button_Start.grid(sticky='w', column=0, row=12, pady=40)
 
 # Keep window open until it's closed
 mainloop()
 
+# Parquet files keep values as they are. Values in CSV files are truncated to 10000 characters
+# (some metadata fields have 30,000+ characters, which messes with CSV writing/reading)
+outputFormat = 'parquet' if saveAsParquet == 1 else 'csv'
+maxValueLength = None if outputFormat == 'parquet' else 10000
+
 
 # Read metadatablock file
 with open(metadatablockfile, 'r') as f:  # Open file in read mode
@@ -149,14 +162,14 @@ def getsubfields(parent_compound_field, subfield):
 
             # If the compound field allows multiple instances, use the index variable to iterate over each instance
             if fields['typeName'] == parent_compound_field and fields['multiple'] is True:
-                subfield = fields['value'][index][subfield]['value'][:10000].replace('\r', ' - ')
+                subfield = clean_metadata_value(fields['value'][index][subfield]['value'], maxValueLength)
 
                 # Truncate value to 10000 characters (some metadata fields have 30,000+ characters, which messes with CSV writing/reading)
                 # subfield = subfield[:10000].replace('\r', ' - ')
 
             # If the compound field doesn't allow multiple values, the index isn't needed
             elif fields['typeName'] == parent_compound_field and fields['multiple'] is False:
-                subfield = fields['value'][subfield]['value'][:10000].replace('\r', ' - ')
+                subfield = clean_metadata_value(fields['value'][subfield]['value'], maxValueLength)
 
     except KeyError:
         subfield = ''
@@ -167,32 +180,22 @@ for parent_compound_field in compound_field_dictionary:
     subfields = compound_field_dictionary[parent_compound_field]
 
     # Create table in directory user chose
-    compound_field_csv_filename = '%s_%s.csv' % (metadatablock_name, parent_compound_field)
-    compound_field_csv_filepath = Path(csvDirectory) / compound_field_csv_filename
+    compound_field_csv_filename = '%s_%s' % (metadatablock_name, parent_compound_field)
+    compound_field_csv_filepath = get_metadata_table_file_path(csvDirectory, compound_field_csv_filename, outputFormat)
 
-    print('\nCreating CSV file for %s metadata' % (parent_compound_field))
+    print('\nCreating %s file for %s metadata' % (outputFormat.upper(), parent_compound_field))
 
     # Create column names for the header row
     ids = ['dataset_version_id', 'persistent_url', 'persistent_id', 'dataset_version_number', 'dataset_version_create_time']
     header_row = ids + subfields
 
-    with open(compound_field_csv_filepath, mode='w', newline='') as metadatafile:
-        metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        metadatafile.writerow(header_row)  # Create header row
+    # Create the file with a header row, and keep it open while rows are written
+    metadatafile = MetadataTableWriter(compound_field_csv_filepath, header_row, outputFormat)
 
     print('\rGetting %s metadata:' % (parent_compound_field))
 
-    # For each file in a folder of json files
-    for file in glob.glob(os.path.join(jsonDirectory, '*.json')):
-
-        # Open each file in read mode
-        with open(file, 'r') as f1:
-
-            # Copy content to datasetMetadata variable
-            datasetMetadata = f1.read()
-
-            # Overwrite variable with content as a python dict
-            datasetMetadata = json.loads(datasetMetadata)
+    # For each file in a folder of json files, or each export in a bundle of exports
+    for file, datasetMetadata in iterate_dataset_exports(jsonDirectory):
 
         # Check if status is OK, there's a datasetVersion key (the dataset isn't deaccessioned,
         # and there's metadata for fields in the given metadatablock
@@ -240,16 +243,12 @@ for parent_compound_field in compound_field_dictionary:
                         for subfield in subfields:
                             row_variables.append(globals()[subfield])
 
-                        # Append fields to the csv file
-                        with open(compound_field_csv_filepath, mode='a', newline='', encoding='utf-8') as metadatafile:
-                            metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-                            # Write new row using list of variables
-                            metadatafile.writerow(row_variables)
+                        # Write new row using list of variables
+                        metadatafile.writerow(row_variables)
 
-                            # As a progress indicator, print a dot each time a row is written
-                            sys.stdout.write('.')
-                            sys.stdout.flush()
+                        # As a progress indicator, print a dot each time a row is written
+                        sys.stdout.write('.')
+                        sys.stdout.flush()
 
                         index += 1
                         condition = index < total
@@ -257,6 +256,7 @@ for parent_compound_field in compound_field_dictionary:
         else:
             continue
 
+    metadatafile.close()
     print('\nFinished writing %s metadata to %s' % (parent_compound_field, compound_field_csv_filepath))
 
 # Get list of primitive fields in the given metadatablock JSON file
@@ -278,109 +278,83 @@ primitive_fields = list(set(all_fields) - set(all_parent_and_child_fields))
 for primitive_field in primitive_fields:
 
     # Store path of CSV file to variable
-    primitive_field_filename = '%s_%s.csv' % (metadatablock_name, primitive_field)
-    primitive_field_csv_filepath = Path(csvDirectory) / primitive_field_filename
-
-    with open(primitive_field_csv_filepath, mode='w', newline='') as metadatafile:
-        metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    primitive_field_filename = '%s_%s' % (metadatablock_name, primitive_field)
+    primitive_field_csv_filepath = get_metadata_table_file_path(csvDirectory, primitive_field_filename, outputFormat)
 
-        # Create header row
-        metadatafile.writerow(['dataset_version_id', 'persistent_url', 'persistent_id', 'dataset_version_number', 'dataset_version_create_time', primitive_field])
+    # Create the file with a header row, and keep it open while rows are written
+    metadatafile = MetadataTableWriter(
+        primitive_field_csv_filepath,
+        ['dataset_version_id', 'persistent_url', 'persistent_id', 'dataset_version_number', 'dataset_version_create_time', primitive_field],
+        outputFormat)
 
     print('\nGetting %s metadata:' % (primitive_field))
 
-    # For each file in the folder of JSON files
-    for file in glob.glob(os.path.join(jsonDirectory, '*.json')):
-
-        # Open each file in read mode
-        with open(file, 'r') as f1:
-
-            # Copy content to datasetMetadata variable
-            datasetMetadata = f1.read()
-
-            # Overwrite variable with content as a python dict
-            datasetMetadata = json.loads(datasetMetadata)
+    # For each file in the folder of JSON files, or each export in a bundle of exports
+    for file, datasetMetadata in iterate_dataset_exports(jsonDirectory):
 
-            if (datasetMetadata['status'] == 'OK') and ('datasetVersion' in datasetMetadata['data']) and (metadatablock_name in datasetMetadata['data']['datasetVersion']['metadataBlocks']):
-
-                # Save the dataset id, persistent URL, and version number of each dataset
-                datasetVersionId = str(datasetMetadata['data']['datasetVersion']['id'])
-                persistentUrl = datasetMetadata['data']['persistentUrl']
-                datasetPersistentId = improved_get(datasetMetadata, 'data.datasetVersion.datasetPersistentId')
-
-                versionState = datasetMetadata['data']['datasetVersion']['versionState']
-                if datasetMetadata['data']['publicationDate'] == None:
-                    datasetVersionNumber = 'UNPUBLISHED'
-                elif versionState == 'DRAFT':
-                    datasetVersionNumber = 'DRAFT'
-                elif versionState == 'RELEASED':
-                    majorVersionNumber = datasetMetadata['data']['datasetVersion']['versionNumber']
-                    minorVersionNumber = datasetMetadata['data']['datasetVersion']['versionMinorNumber']
-                    datasetVersionNumber = f'{majorVersionNumber}.{minorVersionNumber}'
-
-
-                # Couple each field value with the dataset version ID and write as a row
-                for fields in datasetMetadata['data']['datasetVersion']['metadataBlocks'][metadatablock_name]['fields']:
-                    if fields['typeName'] == primitive_field:
-                        value = fields['value']
+        if (datasetMetadata['status'] == 'OK') and ('datasetVersion' in datasetMetadata['data']) and (metadatablock_name in datasetMetadata['data']['datasetVersion']['metadataBlocks']):
 
-                        # Check if value is a string, which means the field doesn't allow multiple values
-                        if isinstance(value, str):
+            # Save the dataset id, persistent URL, and version number of each dataset
+            datasetVersionId = str(datasetMetadata['data']['datasetVersion']['id'])
+            persistentUrl = datasetMetadata['data']['persistentUrl']
+            datasetPersistentId = improved_get(datasetMetadata, 'data.datasetVersion.datasetPersistentId')
 
-                            # Truncate value to 10000 characters (some metadata fields have 30,000+ characters, which messes with CSV writing/reading)
-                            value = value[:10000].replace('\r', ' - ')
+            versionState = datasetMetadata['data']['datasetVersion']['versionState']
+            if datasetMetadata['data']['publicationDate'] == None:
+                datasetVersionNumber = 'UNPUBLISHED'
+            elif versionState == 'DRAFT':
+                datasetVersionNumber = 'DRAFT'
+            elif versionState == 'RELEASED':
+                majorVersionNumber = datasetMetadata['data']['datasetVersion']['versionNumber']
+                minorVersionNumber = datasetMetadata['data']['datasetVersion']['versionMinorNumber']
+                datasetVersionNumber = f'{majorVersionNumber}.{minorVersionNumber}'
 
-                            with open(primitive_field_csv_filepath, mode='a', newline='', encoding='utf-8') as metadatafile:
 
-                                metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            # Couple each field value with the dataset version ID and write as a row
+            for fields in datasetMetadata['data']['datasetVersion']['metadataBlocks'][metadatablock_name]['fields']:
+                if fields['typeName'] == primitive_field:
+                    value = fields['value']
 
-                                # Write new row
-                                metadatafile.writerow([datasetVersionId, persistentUrl, datasetPersistentId, datasetVersionNumber, datasetVersionCreateTime, value])
+                    # Check if value is a string, which means the field doesn't allow multiple values
+                    if isinstance(value, str):
 
-                                # As a progress indicator, print a dot each time a row is written
-                                sys.stdout.write('.')
-                                sys.stdout.flush()
+                        # Truncate value to 10000 characters when writing CSV files
+                        value = clean_metadata_value(value, maxValueLength)
 
-                        # Check if value is a list, which means the field allows multiple values
-                        elif isinstance(value, list):
-                            for value in fields['value']:
+                        # Write new row
+                        metadatafile.writerow([datasetVersionId, persistentUrl, datasetPersistentId, datasetVersionNumber, datasetVersionCreateTime, value])
 
-                                # Truncate value to 10000 characters (some metadata fields have 30,000+ characters, which messes with CSV writing/reading)
-                                value = value[:10000].replace('\r', ' - ')
+                        # As a progress indicator, print a dot each time a row is written
+                        sys.stdout.write('.')
+                        sys.stdout.flush()
 
-                                # persistentUrl = datasetMetadata['data']['persistentUrl']
-                                with open(primitive_field_csv_filepath, mode='a', newline='', encoding='utf-8') as metadatafile:
+                    # Check if value is a list, which means the field allows multiple values
+                    elif isinstance(value, list):
+                        for value in fields['value']:
 
-                                    metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+                            # Truncate value to 10000 characters when writing CSV files
+                            value = clean_metadata_value(value, maxValueLength)
 
-                                    # Write new row
-                                    metadatafile.writerow([datasetVersionId, persistentUrl, datasetPersistentId, datasetVersionNumber, datasetVersionCreateTime, value])
+                            # Write new row
+                            metadatafile.writerow([datasetVersionId, persistentUrl, datasetPersistentId, datasetVersionNumber, datasetVersionCreateTime, value])
 
-                                    # As a progress indicator, print a dot each time a row is written
-                                    sys.stdout.write('.')
-                                    sys.stdout.flush()
-            else:
-                continue
+                            # As a progress indicator, print a dot each time a row is written
+                            sys.stdout.write('.')
+                            sys.stdout.flush()
+        else:
+            continue
 
+    metadatafile.close()
     print('\nFinished writing %s metadata to %s' % (primitive_field, primitive_field_csv_filepath))
 
 # Increase the limit Python imposes on field sizes in CSV files
 csv.field_size_limit(sys.maxsize)
 
-# Delete any CSV files that are empty and report
-
-deletedfiles = []
-for file in glob.glob(str(Path(csvDirectory)) + '/' + '*.csv'):
-    with open(file, mode='r', encoding='utf-8') as f:
-
-        reader = csv.reader(f, delimiter=',')
-        data = list(reader)
-        row_count = len(data)
-        if row_count == 1:
-            filename = Path(file).name
-            deletedfiles.append(filename)
-            f.close()
-            os.remove(file)
+# Delete any CSV or Parquet files that are empty and report
+if outputFormat == 'parquet':
+    deletedfiles = delete_empty_parquet_files(csvDirectory)
+else:
+    deletedfiles = delete_empty_csv_files(csvDirectory)
 if deletedfiles:
     print('\rNumber of files deleted because they had no metadata: %s' % (len(deletedfiles)))
     print(deletedfiles)
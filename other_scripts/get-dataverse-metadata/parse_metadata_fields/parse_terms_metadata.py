@@ -50,6 +50,10 @@ def retrieve_csvdirectory():
 
 # Function called when Start button is pressed
 def start():
+    global saveAsParquet
+
+    # Save the checkbox value before the window and its variables are destroyed
+    saveAsParquet = saveAsParquet.get()
     window.destroy()
 
 
@@ -72,57 +76,49 @@ label_tablesDirectory.grid(sticky='w', column=0, row=4, pady=2)
 button_tablesDirectory = ttk.Button(window, text='Browse', command=lambda: retrieve_csvdirectory())
 button_tablesDirectory.grid(sticky='w', column=0, row=5)
 
+# Create checkbox for saving the table as a Parquet file instead of a CSV file
+saveAsParquet = IntVar()
+Checkbutton(window, text="Save as a Parquet file instead of a CSV file", variable=saveAsParquet).grid(sticky='w', column=0, row=7, pady=10)
+
 # Create start button
 button_Start = ttk.Button(window, text='Start', command=lambda: start())
-button_Start.grid(sticky='w', column=0, row=7, pady=40)
+button_Start.grid(sticky='w', column=0, row=8, pady=40)
 
 # Keep window open until it's closed
 mainloop()
 
+outputFormat = 'parquet' if saveAsParquet == 1 else 'csv'
 
 # Store path of csv file to filename variable
-filename = os.path.join(csvDirectory, 'licenses_and_terms_metadata.csv')
-
-print('Creating CSV file')
-
-# Create CSV file
-with open(filename, mode='w', newline='') as metadatafile:
-    metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-    
-    # Create header row
-    metadatafile.writerow([
-        'dataset_pid', 'dataset_pid_url', 'dataset_version_number', 
-        'dataset_version_create_time', 'license_name', 'license_uri', 
-        'terms_of_use', 'confidentiality_declaration', 'special_permissions', 
-        'restrictions', 'citation_requirements', 'depositor_requirements', 
-        'conditions', 'disclaimer', 'terms_of_access', 'data_access_place', 
-        'original_archive', 'availability_status', 'contact_for_access', 
-        'size_of_collection', 'study_completion'])
+filename = get_metadata_table_file_path(csvDirectory, 'licenses_and_terms_metadata', outputFormat)
+
+print('Creating %s file' % (outputFormat.upper()))
+
+# Create the file with a header row, and keep it open while rows are written
+metadatafile = MetadataTableWriter(filename, [
+    'dataset_pid', 'dataset_pid_url', 'dataset_version_number', 
+    'dataset_version_create_time', 'license_name', 'license_uri', 
+    'terms_of_use', 'confidentiality_declaration', 'special_permissions', 
+    'restrictions', 'citation_requirements', 'depositor_requirements', 
+    'conditions', 'disclaimer', 'terms_of_access', 'data_access_place', 
+    'original_archive', 'availability_status', 'contact_for_access', 
+    'size_of_collection', 'study_completion'], outputFormat)
 
 print('Getting metadata:')
 
 
 # Save count of files in the given directory and initialize count variable to track progress of script and for debugging
 # path, dirs, files = next(os.walk(jsonDirectory))
-fileCount = len(glob.glob(os.path.join(jsonDirectory, '*(latest_version).json')))
+fileCount = count_dataset_exports(jsonDirectory, latestVersionOnly=True)
 count = 0
 
-# For each JSON file in the given directory...
-for file in glob.glob(os.path.join(jsonDirectory, '*(latest_version).json')):  # For each JSON file in a folder
+# For each JSON file in the given directory, or each export in a bundle of exports...
+for file, datasetMetadata in iterate_dataset_exports(jsonDirectory, latestVersionOnly=True):
     count += 1
 
     # Save the name of the file to print to the terminal with the current and total counts
     filePid = file.rsplit('/')[-1]
 
-    # Open each file in read mode
-    with open(file, 'r') as f1:
-
-        # Copy content to datasetMetadata variable
-        datasetMetadata = f1.read()
-
-        # Load content in variable as a json object
-        datasetMetadata = json.loads(datasetMetadata)
-
     # Print count of files opened, total file count, and name of file
     print(f'{count} of {fileCount}: {filePid}', end='\r', flush=True)
 
@@ -179,24 +175,15 @@ for file in glob.glob(os.path.join(jsonDirectory, '*(latest_version).json')):  #
         sizeOfCollection = improved_get(datasetMetadata, 'data.datasetVersion.sizeOfCollection')
         studyCompletion = improved_get(datasetMetadata, 'data.datasetVersion.studyCompletion')
 
-        # Append fields to the csv file
-        with open(filename, mode='a', newline='') as metadatafile:
-
-            # Convert all characters to utf-8
-            def to_utf8(lst):
-                return [unicode(elem).encode('utf-8') for elem in lst]
-
-            # Set how values are written to a row in the CSV file
-            metadatafile = csv.writer(metadatafile, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-            # Write new row
-            metadatafile.writerow([
-                datasetPid, datasetPersistentUrl, datasetVersionNumber, 
-                datasetVersionCreateTime, licenseName, licenseUri,
-                termsOfUse, confidentialityDeclaration, specialPermissions, 
-                restrictions, citationRequirements, depositorRequirements, 
-                conditions, disclaimer, termsOfAccess, dataAccessPlace, 
-                originalArchive, availabilityStatus, contactForAccess, 
-                sizeOfCollection, studyCompletion])
-            
+        # Write new row
+        metadatafile.writerow([
+            datasetPid, datasetPersistentUrl, datasetVersionNumber, 
+            datasetVersionCreateTime, licenseName, licenseUri,
+            termsOfUse, confidentialityDeclaration, specialPermissions, 
+            restrictions, citationRequirements, depositorRequirements, 
+            conditions, disclaimer, termsOfAccess, dataAccessPlace, 
+            originalArchive, availabilityStatus, contactForAccess, 
+            sizeOfCollection, studyCompletion])
+
+metadatafile.close()
 print(f'Finished: {count} of {fileCount}')
@@ -13,6 +13,12 @@ from tkinter import ttk
 from tkinter import *
 from urllib.parse import urlparse
 
+# This script uses functions in a Python script at https://github.com/jggautier/dataverse-scripts/tree/main/dataverse_repository_curation_assistant
+# Copy that directory to your computer and add the directory path to sys.path.append
+sys.path.append('')
+
+from dataverse_repository_curation_assistant_functions import *
+
 ####################################################################################
 
 # Create GUI for getting user input
@@ -39,10 +45,14 @@ def retrieve_input():
     global dataverseUrl
     global apiKey
     global get_subdataverses
+    global update_inventory
 
     # Record if user wants to search in subdataverses
     get_subdataverses = get_subdataverses.get()
 
+    # Record if user wants to add only new datasets to the CSV file from the last run
+    update_inventory = update_inventory.get()
+
     # Store what entered in the api key text box as a global variable
     apiKey = entry_apikey.get().rstrip()
 
@@ -120,6 +130,12 @@ label_browseDirectory.grid(sticky='w', column=0, row=12, pady=2)
 button_browseDirectory = ttk.Button(window, text='Browse', command=lambda: retrieve_directory())
 button_browseDirectory.grid(sticky='w', column=0, row=13)
 
+# Create "Only add new datasets" checkbox
+update_inventory = IntVar()
+Checkbutton(
+    window, text='Only add datasets that are new since the last time this folder was chosen (whole repository only)',
+    variable=update_inventory).grid(sticky='w', column=0, row=14)
+
 # Create start button
 button_Submit = ttk.Button(window, text='Start', command=lambda: retrieve_input())
 button_Submit.grid(sticky='w', column=0, row=15, pady=40)
@@ -140,12 +156,10 @@ try:
 except IndexError:
     alias = ''
 
-# Get alias of the root dataverse (assumming the root dataverse's ID is 1, which isn't the case with UVA Dataverse)
-url = f'%s/api/dataverses/1' % (installationUrl)
-response = requests.get(url)
-dataverse_data = response.json()
-root_alias = dataverse_data['data']['alias']
-installation_name = dataverse_data['data']['name']
+# Get alias and name of the root dataverse from the local index of collection trees
+root_dataverse = get_root_collection_info(installationUrl, apiKey=apiKey)
+root_alias = root_dataverse['alias']
+installation_name = root_dataverse['name']
 
 ####################################################################################
 
@@ -154,104 +168,68 @@ installation_name = dataverse_data['data']['name']
 
 if not alias or alias == root_alias:
 
-    # Create CSV file
-    csv_file = 'dataset_pids_%s_%s.csv' % (installation_name.replace(' ', '_'), current_time)
-    csv_file_path = os.path.join(directory, csv_file)
-
-    with open(csv_file_path, mode='w', newline='') as f:
-        f = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        f.writerow(['persistent_id', 'persistentUrl', 'dataverse_name', 'dataverse_alias', 'publication_date'])
-
-    # Report count of datasets
+    fieldnames = ['persistent_id', 'persistentUrl', 'dataverse_name', 'dataverse_alias', 'publication_date', 'version_state']
+
+    # Page through the Search API results asynchronously, 1000 datasets at a time. Pages that break because of
+    # misindexed datasets are split in half until the misindexed datasets are found (See https://github.com/IQSS/dataverse/issues/4225)
+    searchApiUrl = '%s/api/v1/search' % (installationUrl)
+    searchApiParams = {
+        'q': '*',
+        'fq': ['-metadataSource:"Harvested"'],
+        'type': ['dataset'],
+        'sort': 'date',
+        'order': 'desc'}
     if apiKey:
-        url = '%s/api/v1/search?q=*&fq=-metadataSource:"Harvested"&type=dataset&per_page=1&start=0&sort=date&order=desc&key=%s' % (installationUrl, apiKey)
-        response = requests.get(url)
-        data = response.json()
-        total = data['data']['total_count']
-        print('\nSaving %s dataset PIDs\n(Search API returns the draft and published version of a dataset. List will be de-duplicated at the end):' % (total))
+        headers = {'X-Dataverse-key': apiKey}
+        print('\nSaving dataset PIDs\n(Search API returns the draft and published version of a dataset. List will be de-duplicated at the end):')
     else:
-        url = '%s/api/v1/search?q=*&fq=-metadataSource:"Harvested"&type=dataset&per_page=1&start=0&sort=date&order=desc' % (installationUrl)
-        response = requests.get(url)
-        data = response.json()
-        total = data['data']['total_count']
-        print('\nSaving %s dataset PIDs:' % (total))
-
-    # Initialization for paginating through Search API results and showing progress
-    start = 0
-    condition = True
-    count = 0
-
-    # Create variable for storing count of misindexed datasets
-    misindexed_datasets_count = 0
-
-    while condition:
-        try:
-            per_page = 10
-            if apiKey:
-                url = '%s/api/v1/search?q=*&fq=-metadataSource:"Harvested"&type=dataset&per_page=%s&start=%s&sort=date&order=desc&key=%s' % (installationUrl, per_page, start, apiKey)
-            else:
-                url = '%s/api/v1/search?q=*&fq=-metadataSource:"Harvested"&type=dataset&per_page=%s&start=%s&sort=date&order=desc' % (installationUrl, per_page, start)
-
-            response = requests.get(url)
-            data = response.json()
-
-            # For each item object...
-            for i in data['data']['items']:
-                persistent_id = i['global_id']
-                persistent_url = i['url']
-                dataverse_name = i['name_of_dataverse']
-                dataverse_alias = i['identifier_of_dataverse']
-                publicationDate = i.get('published_at', 'UNPUBLISHED')
-
-                with open(csv_file_path, mode='a', encoding='utf-8', newline='') as open_csv_file:
-                    open_csv_file = csv.writer(open_csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-                    # Create new row with dataset and file info
-                    open_csv_file.writerow([persistent_id, persistent_url, dataverse_name, dataverse_alias, publicationDate])
-
-                    count += 1
-                    print('%s of %s' % (count, total), end='\r', flush=True)
+        headers = {}
+        print('\nSaving dataset PIDs:')
 
-            # Update variables to paginate through the search results
-            start = start + per_page
+    def get_row(i):
+        return dict(zip(fieldnames, [
+            i['global_id'], i['url'], i['name_of_dataverse'],
+            i['identifier_of_dataverse'], i.get('published_at', 'UNPUBLISHED'), i.get('versionState', '')]))
 
-        # Print error message if misindexed datasets break the Search API call, and try the next page. (See https://github.com/IQSS/dataverse/issues/4225)
-        except urllib.error.URLError:
-            try:
-                per_page = 1
-                if apiKey:
-                    url = '%s/api/v1/search?q=*&fq=-metadataSource:"Harvested"&type=dataset&per_page=%s&start=%s&sort=date&order=desc&key=%s' % (installationUrl, per_page, start, apiKey)
-                else:
-                    url = '%s/api/v1/search?q=*&fq=-metadataSource:"Harvested"&type=dataset&per_page=%s&start=%s&sort=date&order=desc' % (installationUrl, per_page, start)
+    misindexedStarts = []
 
-                response = requests.get(url)
-                data = response.json()
+    # Add only the datasets published or created since the last run to a CSV file without a timestamp in its name,
+    # which is kept between runs. Rows are identified by the dataset's PID and version state, so that when a dataset
+    # is republished, its new row replaces the old one. When a draft is published or a dataset is deaccessioned,
+    # the rows of its older version states are removed (see get_superseded_dataset_keys)
+    if update_inventory == 1:
+        csv_file = 'dataset_pids_%s.csv' % (installation_name.replace(' ', '_'))
+        csv_file_path = os.path.join(directory, csv_file)
 
-                # For each item object...
-                for i in data['data']['items']:
-                    persistent_id = i['global_id']
-                    persistent_url = i['url']
-                    dataverse_name = i['name_of_dataverse']
-                    dataverse_alias = i['identifier_of_dataverse']
-                    publicationDate = i.get('published_at', 'unpublished')
+        inventory_rows, rows = sync_search_api_inventory(
+            searchApiUrl, searchApiParams, csv_file_path, ['persistent_id', 'version_state'],
+            rowFunction=get_row,
+            supersededKeysFunction=lambda row: get_superseded_dataset_keys(row['persistent_id'], row['version_state']),
+            misindexedStarts=misindexedStarts,
+            headers=headers)
 
-                    with open(csv_file_path, mode='a', encoding='utf-8', newline='') as open_csv_file:
-                        open_csv_file = csv.writer(open_csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        print('\nDataset PIDs in the CSV file: %s' % (len(inventory_rows)))
 
-                        # Create new row with dataset and file info
-                        open_csv_file.writerow([persistent_id, persistent_url, dataverse_name, dataverse_alias, publicationDate])
+    else:
+        # Create CSV file
+        csv_file = 'dataset_pids_%s_%s.csv' % (installation_name.replace(' ', '_'), current_time)
+        csv_file_path = os.path.join(directory, csv_file)
 
-                        print('%s of %s' % (count, total), end='\r', flush=True)
+        rows = get_search_api_rows(
+            searchApiUrl, searchApiParams,
+            rowFunction=get_row,
+            misindexedStarts=misindexedStarts,
+            headers=headers)
 
-                    # Update variables to paginate through the search results
-                    start = start + per_page
+        with open(csv_file_path, mode='w', encoding='utf-8', newline='') as open_csv_file:
+            open_csv_file = csv.DictWriter(open_csv_file, fieldnames=fieldnames, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+            open_csv_file.writeheader()
 
-            except urllib.error.URLError:
-                misindexed_datasets_count += 1
-                start = start + per_page
+            # Create new row with dataset and file info
+            open_csv_file.writerows(rows)
 
-        # Stop paginating when there are no more results
-        condition = start < total
+    count = len(rows)
+    misindexed_datasets_count = len(misindexedStarts)
 
     print('\nDataset PIDs written to the CSV file: %s' % (count))
 
@@ -270,46 +248,16 @@ else:
         f = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         f.writerow(['persistent_id', 'persistentUrl', 'dataverse_name', 'dataverse_alias', 'publication_date'])
 
-    # Get ID of given dataverse alias
-    if apiKey:
-        url = '%s/api/dataverses/%s?key=%s' % (installationUrl, alias, apiKey)
-    else:
-        url = '%s/api/dataverses/%s' % (installationUrl, alias)
-
-    response = requests.get(url)
-    data = response.json()
-    parent_dataverse_id = data['data']['id']
-
-    # Create list and add ID of given dataverse
-    dataverse_ids = [parent_dataverse_id]
-
-    # If user wants datasets in subdataverses, search for and include IDs of subdataverses (excludes linked dataverses)
-
-    # Get each subdataverse in the given dataverse
+    # Crawl the given dataverse, and if user wants datasets in subdataverses, all of its subdataverses (excludes linked dataverses).
+    # The dataverses in each level of the tree are crawled at the same time, and the datasets each dataverse owns are kept
     if get_subdataverses == 1:
-        print('\nGetting dataverse IDs in %s:' % (alias))
-
-        for dataverse_id in dataverse_ids:
-
-            sys.stdout.write('.')
-            sys.stdout.flush()
-
-            if apiKey:
-                url = '%s/api/dataverses/%s/contents?key=%s' % (installationUrl, dataverse_id, apiKey)
-            else:
-                url = '%s/api/dataverses/%s/contents' % (installationUrl, dataverse_id)
-
-            response = requests.get(url)
-            data = response.json()
-
-            for i in data['data']:
-                if i['type'] == 'dataverse':
-                    dataverse_id = i['id']
-                    dataverse_ids.extend([dataverse_id])
-
-        print('\n\nFound 1 dataverse and %s subdataverses' % (len(dataverse_ids) - 1))
+        print('\nGetting dataverses and datasets in %s' % (alias))
+        tree = get_collection_tree(installationUrl, alias, apiKey=apiKey, includeDatasets=True)
+        print('\nFound 1 dataverse and %s subdataverses' % (len(tree.collections) - 1))
+    else:
+        tree = get_collection_tree(installationUrl, alias, apiKey=apiKey, includeDatasets=True, maxDepth=0)
 
-    # For each dataverse in the list, add the PIDs of all datasets to a CSV file - excludes linked and harvested datasets
+    # For each dataverse in the tree, add the PIDs of all datasets to a CSV file - excludes linked and harvested datasets
 
     print('\nWriting dataset IDs to %s:' % (csv_file_path))
 
@@ -318,43 +266,17 @@ else:
     with open(csv_file_path, mode='a', encoding='utf-8', newline='') as open_csv_file:
         open_csv_file = csv.writer(open_csv_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
 
-        for dataverse_id in dataverse_ids:
-
-            # Get name of dataverse
-            if apiKey:
-                url = '%s/api/dataverses/%s?key=%s' % (installationUrl, dataverse_id, apiKey)
-            else:
-                url = '%s/api/dataverses/%s' % (installationUrl, dataverse_id)
-            response = requests.get(url, timeout=10)
-            data = response.json()
-            dataverse_name = data['data']['name']
-            dataverse_alias = data['data']['alias']
-
-            # Get content of dataverse
-            if apiKey:
-                url = '%s/api/dataverses/%s/contents?key=%s' % (installationUrl, dataverse_id, apiKey)
-            else:
-                url = '%s/api/dataverses/%s/contents' % (installationUrl, dataverse_id)
-
-            response = requests.get(url)
-            data = response.json()
-
-            for i in data['data']:
-                if i['type'] == 'dataset':
-                    protocol = i['protocol']
-                    authority = i['authority']
-                    identifier = i['identifier']
-                    persistent_id = '%s:%s/%s' % (protocol, authority, identifier)
-                    persistent_url = i['persistentUrl']
-                    publicationDate = i.get('publicationDate', 'unpublished')
-
-                    count += 1
-
-                    # Create new line with dataset PID
-                    open_csv_file.writerow([persistent_id, persistent_url, dataverse_name, dataverse_alias, publicationDate])
-
-                    # As a progress indicator, print a dot each time a row is written
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
-
-    print('\n\nDataset PIDs written to the CSV file: %s' % (count))
+        for dataverse, i in tree.get_datasets():
+            protocol = i['protocol']
+            authority = i['authority']
+            identifier = i['identifier']
+            persistent_id = '%s:%s/%s' % (protocol, authority, identifier)
+            persistent_url = i['persistentUrl']
+            publicationDate = i.get('publicationDate', 'unpublished')
+
+            count += 1
+
+            # Create new line with dataset PID
+            open_csv_file.writerow([persistent_id, persistent_url, dataverse['name'], dataverse['alias'], publicationDate])
+
+    print('\nDataset PIDs written to the CSV file: %s' % (count))
@@ -4,6 +4,7 @@ from bs4 import BeautifulSoup
 import contextlib
 import csv
 from csv import DictReader
+import glob
 import joblib
 from joblib import Parallel, delayed
 import json
@@ -30,87 +31,32 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
-def get_dataset_info_dict(start, headers, installationName, misindexedDatasetsCount, getCollectionInfo=True):
-    searchApiUrl = f'{installationUrl}/api/search'
-    try:
-        perPage = 10
-
-        params = {
-            'q': '*',
-            'fq': ['-metadataSource:"Harvested"'],
-            'type': ['dataset'],
-            'per_page': perPage,
-            'start': start}
-
-        response = requests.get(
-            searchApiUrl,
-            params=params,
-            headers=headers,
-            verify=False)
-
-        searchApiUrlData = response.json()
-
-        # For each dataset, write the dataset info to the CSV file
-        for i in searchApiUrlData['data']['items']:
-
-            datasetPids.append(i['global_id'])
-
-            if getCollectionInfo == False:
-                newRow = {
-                    'dataverse_installation_name': installationName,
-                    'dataset_pid': i['global_id'],
-                    'dataset_pid_url': i['url']}
-            elif getCollectionInfo == True:
-                newRow = {
-                    'dataverse_installation_name': installationName,
-                    'dataset_pid': i['global_id'],
-                    'dataset_pid_url': i['url'],
-                    'dataverse_collection_alias': i.get('identifier_of_dataverse', 'NA'),
-                    'dataverse_collection_name': i.get('name_of_dataverse', 'NA')}
-            datasetInfoDict.append(dict(newRow))
-
-    # Print error message if misindexed datasets break the Search API call, and try the next page.
-    # See https://github.com/IQSS/dataverse/issues/4225
-
-    except Exception as e:
-        print(f'per_page=10 url broken when start is {start}')
-
-        # This code hasn't been tested because I haven't encountered Search API results with misindexed objects
-        # since rewriting this code to use the joblib library
-        for i in range(10):
-            try:
-                perPage = 1
-                params['start'] = start + i
-
-                response = requests.get(
-                    searchApiUrl,
-                    params=params,
-                    headers=headers,
-                    verify=False)
-
-                response = requests.get(searchApiUrl)
-                data = response.json()
-
-                # For each dataset, write the dataset info to the CSV file
-                for i in data['data']['items']:
+# Turn an item from the Search API results into a row of dataset info
+# If a dictionary is given as datasetFingerprints, the dataset's version and update time are added to it,
+# so that datasets that haven't changed since the last run aren't downloaded again
+def get_dataset_info_row(item, installationName, getCollectionInfo=True, datasetFingerprints=None):
+    if datasetFingerprints is not None:
+        add_search_api_dataset_fingerprint(datasetFingerprints, item)
 
-                    datasetPids.append(i['global_id'])
+    if getCollectionInfo == False:
+        newRow = {
+            'dataverse_installation_name': installationName,
+            'dataset_pid': item['global_id'],
+            'dataset_pid_url': item['url']}
+    elif getCollectionInfo == True:
+        newRow = {
+            'dataverse_installation_name': installationName,
+            'dataset_pid': item['global_id'],
+            'dataset_pid_url': item['url'],
+            'dataverse_collection_alias': item.get('identifier_of_dataverse', 'NA'),
+            'dataverse_collection_name': item.get('name_of_dataverse', 'NA')}
 
-                    newRow = {
-                        'dataset_pid': i['global_id'],
-                        'dataset_pid_url': i['url'],
-                        'dataverse_collection_alias': i.get('identifier_of_dataverse', 'NA'),
-                        'dataverse_collection_name': i.get('name_of_dataverse', 'NA')}
-                    datasetInfoDict.append(dict(newRow))
-
-            except Exception:
-                print(f'per_page=10 url broken when start is {start}')
-                misindexedDatasetsCount += 1
+    return newRow
 
 
 def get_dataverse_collection_info_web_scraping(installationUrl, datasetPid, datasetPidCollectionAliasDict):
     pageUrl = f'{installationUrl}/dataset.xhtml?persistentId={datasetPid}'
-    response = requests.get(pageUrl)
+    response = api_get(pageUrl)
     soup = BeautifulSoup(response.text, 'html.parser')
     mydivs = soup.find_all('a', {'class': 'dataverseHeaderDataverseName'})
     dataverseHeaderDataverseName = str(mydivs[0])
@@ -127,11 +73,7 @@ def get_dataverse_collection_info_web_scraping(installationUrl, datasetPid, data
     return datasetPidCollectionAliasDict
 
 
-def check_export(file, filesListFromExports):
-    with open(file, 'r') as f:
-        datasetMetadata = f.read()
-        datasetMetadata = json.loads(datasetMetadata)
-
+def check_export(datasetMetadata, filesListFromExports):
     # Check if JSON includes datasetPersistentId key
     datasetPidInJson = improved_get(datasetMetadata, 'data.datasetVersion.datasetPersistentId')
     if datasetPidInJson is None:
@@ -143,13 +85,13 @@ def check_export(file, filesListFromExports):
 
 def check_exports(jsonDirectory, spreadsheetFilePath):
     filesListFromExports = []
-    jsonFileCountTotal = len(glob.glob(os.path.join(jsonDirectory, '*(latest_version).json')))
+    jsonFileCountTotal = count_dataset_exports(jsonDirectory, latestVersionOnly=True)
 
     with tqdm_joblib(tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=jsonFileCountTotal)) as progress_bar:
         Parallel(n_jobs=4, backend='threading')(delayed(check_export)(
-            file=file,
+            datasetMetadata=datasetMetadata,
             filesListFromExports=filesListFromExports
-            ) for file in glob.glob(os.path.join(jsonDirectory, '*(latest_version).json')))
+            ) for file, datasetMetadata in iterate_dataset_exports(jsonDirectory, latestVersionOnly=True))
 
     datasetsDF = pd.read_csv(spreadsheetFilePath)
     datasetPidList = datasetsDF['dataset_pid'].values.tolist()
@@ -171,6 +113,27 @@ headers = {
     'User-Agent': userAgent,
     'From': emailAddress}
 
+# Enter the most API calls per second to make to each installation and how many calls can be made at once
+# after a quiet period. Set requestsPerSecond to 0 to not limit the rate. Calls that an installation
+# throttles are resent after waiting as long as the installation asks in its Retry-After header
+requestsPerSecond = 10
+burst = 20
+
+# Enter the path of a directory for keeping an inventory of each installation's dataset PIDs between runs.
+# If a path is entered, only datasets published or created since the last run are looked for, they're added to
+# the installation's inventory, and only their metadata is downloaded. Leave blank to look for all datasets
+inventoryDirectory = ''
+
+# Enter 'bundle' to save each installation's metadata exports in one compressed NDJSON file
+# (dataset_exports.ndjson.gz) instead of in a JSON file for each dataset version,
+# or 'sharded' to save the JSON files in subdirectories listed in a manifest.csv file
+exportStorage = 'files'
+
+# To resume an interrupted run, enter the path of the all_installation_metadata directory it created.
+# Installations that were finished are skipped, and for the others, metadata that was already downloaded isn't downloaded again.
+# Leave blank to start a new run
+resumeFromDirectory = ''
+
 # Get directory that this Python script is in
 currrentWorkingDirectory = os.getcwd()
 
@@ -181,8 +144,11 @@ apiKeysFilePath = str(Path(currrentWorkingDirectory + '/' + 'dvinstallations_ext
 currentTime = time.strftime('%Y.%m.%d_%H.%M.%S')
 
 # Create the main directory that will store a directory for each installation
-allInstallationsMetadataDirectory = str(Path(currrentWorkingDirectory + '/' + f'all_installation_metadata_{currentTime}'))
-os.mkdir(allInstallationsMetadataDirectory)
+if resumeFromDirectory:
+    allInstallationsMetadataDirectory = str(Path(resumeFromDirectory))
+else:
+    allInstallationsMetadataDirectory = str(Path(currrentWorkingDirectory + '/' + f'all_installation_metadata_{currentTime}'))
+    os.mkdir(allInstallationsMetadataDirectory)
 
 # Read CSV file containing apikeys into a dataframe and convert to list to compare each installation name
 apiKeysDF = pd.read_csv(apiKeysFilePath).set_index('hostname')
@@ -191,7 +157,7 @@ installationsRequiringApiKeyList = apiKeysDF.index.tolist()
 # Get JSON data that the Dataverse installations map uses
 print('Getting Dataverse installation data...')
 mapDataUrl = 'https://raw.githubusercontent.com/IQSS/dataverse-installations/main/data/data.json'
-response = requests.get(mapDataUrl, headers=headers)
+response = api_get(mapDataUrl, headers=headers)
 mapdata = response.json()
 
 countOfInstallations = len(mapdata['installations'])
@@ -212,9 +178,16 @@ headerRow = [
 
 installationInfoFilePath = f'{allInstallationsMetadataDirectory}/installations_report.csv'
 
-with open(installationInfoFilePath, mode='w', newline='', encoding='utf-8') as installationInfo:
-    installationInfoWriter = csv.writer(installationInfo)
-    installationInfoWriter.writerow(headerRow)
+# When resuming, get the names of the installations whose metadata was already downloaded
+finishedInstallationNames = []
+if resumeFromDirectory and os.path.isfile(installationInfoFilePath):
+    installationInfoDF = pd.read_csv(installationInfoFilePath, encoding='utf-8-sig', na_filter=False)
+    finishedInstallationNames = installationInfoDF[
+        installationInfoDF['Able_to_get_metadata?'].astype(str) == 'True']['Installation_name'].values.tolist()
+else:
+    with open(installationInfoFilePath, mode='w', newline='', encoding='utf-8') as installationInfo:
+        installationInfoWriter = csv.writer(installationInfo)
+        installationInfoWriter.writerow(headerRow)
 
 installationProgressCount = 0
 
@@ -227,15 +200,22 @@ for installation in mapdata['installations']:
     
     print(f'\nChecking {installationProgressCount} of {countOfInstallations} installations: {installationName}')
 
+    if installationName in finishedInstallationNames:
+        print('Metadata was downloaded in the run being resumed. Skipping installation')
+        continue
+
+    set_installation_defaults(
+        f'https://{hostname}', verify=False, requestsPerSecond=requestsPerSecond, burst=burst)
+
     try:
         installationUrl = f'https://{hostname}'
-        response = requests.get(installationUrl, headers=headers, timeout=60, verify=False)
+        response = api_get(installationUrl, headers=headers, timeout=60, verify=False, maxRetries=0)
         installationStatus = response.status_code
 
         # If installationStatus is bad and there're redirects, get the url of the final redirect
         if installationStatus != 200 and len(response.history) > 1:
             installationUrl = response.url
-            response = requests.get(installationUrl, headers=headers, timeout=60, verify=False)
+            response = api_get(installationUrl, headers=headers, timeout=60, verify=False, maxRetries=0)
             installationStatus = response.status_code
     
     except Exception as e:
@@ -244,7 +224,7 @@ for installation in mapdata['installations']:
     if installationStatus != 200:
         try:
             installationUrl = f'http://{hostname}'
-            response = requests.get(installationUrl, headers=headers, timeout=60, verify=False)
+            response = api_get(installationUrl, headers=headers, timeout=60, verify=False, maxRetries=0)
             installationStatus = response.status_code
             # If there's one or more redirects, get the url of the final redirect
             if installationStatus != 200 and len(response.history) > 1:
@@ -267,6 +247,10 @@ for installation in mapdata['installations']:
     # If there's a good response from the installation, check if Search API works by searching for installation's non-harvested datasets
     if installationStatus == 200:
 
+        # The installation may have redirected to a URL with a different hostname
+        set_installation_defaults(
+            installationUrl, verify=False, requestsPerSecond=requestsPerSecond, burst=burst)
+
         apiTokenUsed = False
 
         # If the installation is in the dataframe of API keys, add API key to header dictionary
@@ -288,7 +272,7 @@ for installation in mapdata['installations']:
         getInstallationVersionApiStatus = check_api_endpoint(getInstallationVersionApiUrl, headers, verify=False, json_response=True)
 
         if getInstallationVersionApiStatus == 'OK':
-            response = requests.get(getInstallationVersionApiUrl, headers=headers, timeout=20, verify=False)
+            response = api_get(getInstallationVersionApiUrl, headers=headers, timeout=20, verify=False)
             getInstallationVersionApiData = response.json()
             dataverseVersion = getInstallationVersionApiData['data']['version']
             dataverseVersion = str(dataverseVersion.lstrip('v'))
@@ -304,7 +288,7 @@ for installation in mapdata['installations']:
 
         # If Search API works, from Search API query results, get count of local (non-harvested) datasets
         if searchApiStatus == 'OK':
-            response = requests.get(searchApiCheckUrl, headers=headers, timeout=20, verify=False)
+            response = api_get(searchApiCheckUrl, headers=headers, timeout=20, verify=False)
             searchApiData = response.json()
             datasetCount = searchApiData['data']['total_count']
         else:
@@ -363,10 +347,19 @@ for installation in mapdata['installations']:
             # Save time and date when script started downloading from the installation to append it to the installation's directory and files
             currentTime = time.strftime('%Y.%m.%d_%H.%M.%S')
 
-            # Create directory for the installation
+            # Create directory for the installation, or when resuming, reuse the directory
+            # and time of the installation's interrupted download, if there is one
             installationNameTemp = installationName.replace(' ', '_').replace('|', '-')
-            installationDirectory = f'{allInstallationsMetadataDirectory}/{installationNameTemp}_{currentTime}'
-            os.mkdir(installationDirectory)
+            previousInstallationDirectories = sorted(glob.glob(
+                glob.escape(allInstallationsMetadataDirectory) + '/' + glob.escape(installationNameTemp) + '_*'))
+            resumeInstallation = bool(resumeFromDirectory) and len(previousInstallationDirectories) > 0
+            if resumeInstallation:
+                installationDirectory = previousInstallationDirectories[-1]
+                currentTime = installationDirectory.split(f'{installationNameTemp}_')[-1]
+                print(f'Resuming download that started at {currentTime}')
+            else:
+                installationDirectory = f'{allInstallationsMetadataDirectory}/{installationNameTemp}_{currentTime}'
+            os.makedirs(installationDirectory, exist_ok=True)
 
             # Check if endpoint for getting installation's metadatablock files works and if so save metadatablock files
             # in a directory
@@ -383,10 +376,10 @@ for installation in mapdata['installations']:
 
                 # Create a directory for the installation's metadatablock files
                 metadatablockFileDirectoryPath = f'{installationDirectory}/metadatablocks_v{dataverseVersion}'
-                os.mkdir(metadatablockFileDirectoryPath)
+                os.makedirs(metadatablockFileDirectoryPath, exist_ok=True)
 
                 # Download metadatablock JSON files
-                response = requests.get(metadatablocksApiEndpointUrl, headers=headers, timeout=20, verify=False)
+                response = api_get(metadatablocksApiEndpointUrl, headers=headers, timeout=20, verify=False)
                 metadatablockData = response.json()
 
                 # Get list of the installation's metadatablock names
@@ -399,7 +392,7 @@ for installation in mapdata['installations']:
 
                 for metadatablockName in metadatablockNames:
                     metadatablockApiEndpointUrl = f'{metadatablocksApiEndpointUrl}/{metadatablockName}'
-                    response = requests.get(metadatablockApiEndpointUrl, headers=headers, timeout=20, verify=False)
+                    response = api_get(metadatablockApiEndpointUrl, headers=headers, timeout=20, verify=False)
                     metadata = response.json()
 
                     # If the metadatablock has fields, download the metadatablock data into a JSON file
@@ -414,29 +407,51 @@ for installation in mapdata['installations']:
             # Dataverse Collection, and write them to a CSV file, and use the "Get dataset JSON" 
             # endpoint to get those datasets' metadata
 
-            # Create start variables to paginate through SearchAPI results
-            start = 0
-            apiCallsCount = round(datasetCount/10)
-            startsList = [0]
-            for apiCall in range(apiCallsCount):
-                start = start + 10
-                startsList.append(start)
-            startsListCount = len(startsList)
-
-            print(f'\nSearching through {startsListCount} Search API page(s) to save info of {datasetCount} dataset(s) to CSV file:')
-
-            misindexedDatasetsCount = 0
-            datasetInfoDict = []
-            datasetPids = []
+            print(f'\nSearching through Search API results to save info of {datasetCount} dataset(s) to CSV file:')
 
             if searchAPIIncludesCollectionInfo == False:
                 getCollectionInfo = False
             else:
                 getCollectionInfo = True
 
-            with tqdm_joblib(tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=startsListCount)) as progress_bar:
-                Parallel(n_jobs=4, backend='threading')(delayed(get_dataset_info_dict)(
-                    start, headers, installationName, misindexedDatasetsCount, getCollectionInfo) for start in startsList)   
+            # Page through the Search API results asynchronously, 1000 datasets at a time. Installations with many datasets
+            # are split into slices by publication date so that no slice has to be paged through too deeply.
+            # Pages that break because of misindexed datasets are split in half until the misindexed datasets are found
+            # (See https://github.com/IQSS/dataverse/issues/4225)
+            misindexedStarts = []
+            datasetFingerprints = {}
+            searchApiParams = {
+                'q': '*',
+                'fq': ['-metadataSource:"Harvested"'],
+                'type': ['dataset']}
+
+            if inventoryDirectory:
+                os.makedirs(inventoryDirectory, exist_ok=True)
+                inventoryFilePath = str(Path(inventoryDirectory + '/' + f'dataset_pids_{installationNameTemp}.csv'))
+
+                # Add the datasets that are newer than the ones found in the last run to the installation's inventory
+                datasetInventory, datasetInfoDict = sync_search_api_inventory(
+                    f'{installationUrl}/api/search'.replace('//api', '/api'), searchApiParams,
+                    inventoryFilePath, ['dataset_pid'],
+                    rowFunction=lambda item: get_dataset_info_row(
+                        item, installationName, getCollectionInfo, datasetFingerprints),
+                    misindexedStarts=misindexedStarts,
+                    headers=headers,
+                    verify=False)
+                print(f'Datasets new since the last run: {len(datasetInfoDict)} (datasets in inventory: {len(datasetInventory)})')
+
+            else:
+                datasetInfoDict = get_search_api_rows(
+                    f'{installationUrl}/api/search'.replace('//api', '/api'), searchApiParams,
+                    rowFunction=lambda item: get_dataset_info_row(
+                        item, installationName, getCollectionInfo, datasetFingerprints),
+                    partition=True,
+                    misindexedStarts=misindexedStarts,
+                    headers=headers,
+                    verify=False)
+
+            datasetPids = [row['dataset_pid'] for row in datasetInfoDict]
+            misindexedDatasetsCount = len(misindexedStarts)
 
             # Get new dataset count based on number of PIDs saved from Search API
             datasetCount = len(datasetPids)
@@ -453,7 +468,11 @@ for installation in mapdata['installations']:
             # Create dataframe from datasetInfoDict, which lists dataset basic info from Search API.
             # And remove duplicate rows from the dataframe. At least one repository has two published versions of the same dataset indexed. 
             # See https://dataverse.rhi.hi.is/dataverse/root/?q=1.00002
-            datasetPidsFileDF = pd.DataFrame(datasetInfoDict).set_index('dataset_pid').drop_duplicates()
+            # Columns are set so that the dataframe can be created even when no datasets are new since the last run
+            datasetPidsFileDF = pd.DataFrame(
+                datasetInfoDict,
+                columns=list(get_dataset_info_row(firstItem, installationName, getCollectionInfo).keys())
+                ).set_index('dataset_pid').drop_duplicates()
 
             # If Search API results don't include collection identifiers of each dataset,
             # scrape each dataset page to get them, then merge them with datasetPidsFileDF
@@ -462,7 +481,7 @@ for installation in mapdata['installations']:
                 
                 datasetPidCollectionAliasDict = []
                 with tqdm_joblib(tqdm(bar_format='{l_bar}{bar:10}{r_bar}{bar:-10b}', total=datasetCount)) as progress_bar:
-                    Parallel(n_jobs=4, backend='threading')(delayed(get_dataverse_collection_info_web_scraping)(
+                    Parallel(n_jobs=get_max_concurrency(installationUrl), backend='threading')(delayed(get_dataverse_collection_info_web_scraping)(
                         installationUrl,
                         datasetPid,
                         datasetPidCollectionAliasDict
@@ -483,7 +502,7 @@ for installation in mapdata['installations']:
 
             # Create directory for dataset JSON metadata
             dataverseJsonMetadataDirectory = f'{installationDirectory}/Dataverse_JSON_metadata_{currentTime}'
-            os.mkdir(dataverseJsonMetadataDirectory)
+            os.makedirs(dataverseJsonMetadataDirectory, exist_ok=True)
 
             # For each dataset PID, download dataset's Dataverse JSON metadata export
             print('\nDownloading Dataverse JSON metadata to Dataverse_JSON_metadata folder:')
@@ -505,12 +524,15 @@ for installation in mapdata['installations']:
                 installationUrl=installationUrl, 
                 datasetPidList=datasetPids, 
                 exportFormat='dataverse_json',
-                n_jobs=4,
                 timeout=60,
                 verify=False, 
                 allVersions=True, 
                 header=headers, 
-                apiKey='')
+                apiKey='',
+                singleRequest=True,
+                resume=resumeInstallation,
+                datasetFingerprints=datasetFingerprints,
+                storage=exportStorage)
 
             endJSONMetadataExportDownloadTime = convert_to_local_tz(datetime.now(), shortDate=False)
 
@@ -1,13 +1,20 @@
 # Join (full outer join) CSV files in a given directory
 
+import csv
 from functools import reduce
 import glob
 import os
-import pandas as pd
+import sys
 from tkinter import filedialog, Label, Tk, PanedWindow, Entry, mainloop, Listbox
 from tkinter import MULTIPLE, StringVar, Scrollbar, N, S, E, W
 from tkmacosx import Button
 
+# This script uses functions in a Python script at https://github.com/jggautier/dataverse-scripts/tree/main/dataverse_repository_curation_assistant
+# Copy that directory to your computer and add the directory path to sys.path.append
+sys.path.append('')
+
+from dataverse_repository_curation_assistant_functions import join_csv_files_on_columns
+
 
 # Function called when button is pressed for browsing for CSV files
 def retrieve_csv_files():
@@ -24,11 +31,11 @@ def retrieve_csv_files():
         foreground='green', wraplength=500, justify='left')
     label_showFileCount.grid(sticky='w', row=2)
 
-    # Get names of columns that exist in all chosen CSV files
-    dataframes = [pd.read_csv(table, sep=',') for table in filesList]
+    # Get names of columns that exist in all chosen CSV files, reading only the header row of each file
     columnLists = []
-    for dataframe in dataframes:
-        columnLists.append(dataframe.columns)
+    for table in filesList:
+        with open(table, mode='r', newline='', encoding='utf-8-sig') as f:
+            columnLists.append(next(csv.reader(f), []))
     commonColumns = list(reduce(set.intersection, map(set, columnLists)))
 
     # Add names of common columns to list box
@@ -55,27 +62,16 @@ def join_csv_files(filesList, indexList, joinedFileDirectory):
     # Create CSV file in the directory that the user selected
     filename = os.path.join(joinedFileDirectory, 'joined.csv')
 
-    print('Creating a dataframe for each CSV file...')
-
-    # Create a dataframe of each CSV file in the 'filesList' list
-    dataframes = [pd.read_csv(table, sep=',', na_filter = False) for table in filesList]
-
-    # For each dataframe, set the indexes (or the common columns across the dataframes to join on)
-    for dataframe in dataframes:
-        dataframe.set_index(indexList, inplace=True)
-        # dataframe.set_index(indexList, inplace=True)
-
-    print('Joining dataframes into one dataframe...')
-
-    # Full outer join all dataframes and save to the 'joined' variable
-    joined = reduce(lambda left, right: left.join(right, how='outer'), dataframes)
+    if not indexList:
+        raise ValueError('Choose the columns to join on and try again.')
 
-    print('Exporting joined dataframe to a CSV file...')
+    print('Sorting and joining the CSV files...')
 
-    # Export joined dataframe to a CSV file
-    joined.to_csv(filename)
+    # Full outer join all CSV files, sorting each file by the chosen columns and merging them
+    # a few rows at a time, and export the joined rows to a CSV file as they're joined
+    rowCount = join_csv_files_on_columns(filesList, indexList, filename)
 
-    print('Joined dataframe exported to %s' % (filename))
+    print('%s joined rows exported to %s' % (rowCount, filename))
 
 
 # Function called when button is pressed to join given CSV files
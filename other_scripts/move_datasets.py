@@ -1,13 +1,23 @@
 # Move given datasets into a given Dataverse collection
 
 from csv import DictReader
-import requests
+import sys
+
+# This script uses functions in a Python script at https://github.com/jggautier/dataverse-scripts/tree/main/dataverse_repository_curation_assistant
+# Copy that directory to your computer and add the directory path to sys.path.append
+sys.path.append('')
+
+from dataverse_repository_curation_assistant_functions import *
 
 repositoryURL = ''  # Base URL of the Dataverse repository, e.g. https://demo.dataverse.org
 apikey = ''
 datasetPIDFile = ''  # Path to .csv or .txt file containing dataset PIDs
 alias = '' # Collection to move the datasets into
 
+# Most API calls per second to make to the repository. Set to 0 to not limit the rate.
+# Calls that the repository throttles are resent after waiting as long as the repository asks
+requestsPerSecond = 5
+
 datasetPIDs = []
 if '.csv' in datasetPIDFile:
     with open(datasetPIDFile, mode='r', encoding='utf-8') as f:
@@ -23,15 +33,12 @@ elif '.txt' in datasetPIDFile:
 total = len(datasetPIDs)
 count = 0
 
+set_installation_defaults(repositoryURL, apiKey=apikey, requestsPerSecond=requestsPerSecond)
+
 for datasetPID in datasetPIDs:
     url = f'{repositoryURL}/api/datasets/:persistentId/move/{alias}'
     params = {'persistentId': datasetPID}
-    req = requests.post(
-        url,
-        params=params,
-        headers={
-            'X-Dataverse-key': apikey
-        })
+    req = api_post(url, params=params)
     count += 1
 
     if req.status_code == 200: